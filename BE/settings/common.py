@@ -269,6 +269,32 @@ NOSE_ARGS = ['--exclude-dir=libs/dal', '--exclude-dir=data_importer']
 # Matching Settings
 MATCH_MIN_THRESHOLD = 0.2
 MATCH_MED_THRESHOLD = 0.4
+# Where each org's system matching index is kept between runs; workers on
+# one host share it. Only the app's user may be able to write to it.
+# Unset, a directory of the user's own in the system temp dir is used.
+MATCH_INDEX_DIR = None
+# Only compare buildings sharing a street number, postal code or ID prefix.
+MATCH_BLOCKING = True
+# How system matching searches: 'ngram' (in the worker, see MatchIndex) or
+# 'trigram' (in PostgreSQL, with pg_trgm). Orgs can be given their own,
+# by PK.
+MATCH_ENGINE = 'ngram'
+MATCH_ENGINES_BY_ORG = {}
+
+# Import Settings
+# How raw rows are written: 'orm' (batched INSERTs) or 'copy' (PostgreSQL
+# COPY through a staging table).
+RAW_SAVE_MODE = 'orm'
+# Bytes per read when streaming uploads from storage.
+IMPORT_READ_SIZE = 1024 * 1024
+# Where local copies of uploads are kept for readers that need to seek.
+# Only the app's user may be able to write to it. Unset, a directory of
+# the user's own in the system temp dir is used.
+IMPORT_FILE_CACHE_DIR = None
+# Most chunk tasks a single import, mapping or delete keeps queued at once.
+IMPORT_TASK_WINDOW = 8
+# Skip rows an earlier import of the org already mapped and merged.
+IMPORT_SKIP_UNCHANGED_ROWS = True
 
 
 # django-passwords settings: passwords should requre alphnumberic and 8
@@ -2,8 +2,12 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+import errno
 import logging
+import os
 import re
+import stat
+import tempfile
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
@@ -17,3 +21,42 @@ for k, v in settings.DOMAIN_URLCONFS.items():
 def de_camel_case(name):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1 \2', name)
     return re.sub('([a-z0-9])([A-Z])', r'\1 \2', s1)
+
+
+def is_private(path):
+    """Whether only this process's user could have written to ``path``."""
+    info = os.stat(path)
+    return info.st_uid == os.getuid() and not (
+        info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    )
+
+
+def get_private_dir(path, name):
+    """Return a directory only this process's user can write to.
+
+    :param path: str, the configured directory, or None.
+    :param name: str, name of the directory to use in the system temp dir
+        if ``path`` is None. The user's id is added to it.
+    :rtype: str, the directory, created if need be; None if it belongs to
+        someone else or others can write to it, so nothing in it can be
+        trusted.
+
+    """
+    in_temp_dir = not path
+    if in_temp_dir:
+        path = os.path.join(
+            tempfile.gettempdir(), '{0}-{1}'.format(name, os.getuid())
+        )
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.exception('could not make directory %s', path)
+            return None
+    # Anyone could have linked the name in the temp dir to a directory of
+    # ours, which would pass for private.
+    if (in_temp_dir and os.path.islink(path)) or not is_private(path):
+        logger.error('not using %s, others can write to it', path)
+        return None
+
+    return path
@@ -6,6 +6,7 @@ import csv
 import datetime
 import hashlib
 import math
+import os
 import tempfile
 # import time
 import sys
@@ -15,10 +16,12 @@ try:
 except ImportError:
     import json
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.cache import cache
+from django.core.files import File
 from django.core.urlresolvers import reverse
 from django.db import models, IntegrityError
 from django.db.models import Q
@@ -26,8 +29,16 @@ from django.db.models.signals import post_save
 from django.utils.timesince import timesince
 from django.contrib.auth.models import User
 
-from BE.utils import de_camel_case
+from BE.utils import de_camel_case, get_private_dir, is_private
 from data_importer.managers import NotDeletedManager
+from data_importer.streams import (
+    RANGE_FORMATS,
+    XLS,
+    StorageStream,
+    get_compression,
+    get_file_format,
+    open_stream,
+)
 from organizations.models import Organization
 
 from superperms.orgs.models import Organization as SuperOrganization
@@ -809,6 +820,20 @@ class ImportFile(NotDeletableModel):
     source_type = models.CharField(
         null=True, blank=True, max_length=63,
     )
+    # Chunk sizes picked for this file, and the throughput a single chunk
+    # task got, for tuning later imports. See seed.utils.chunking.
+    raw_save_chunk_size = models.IntegerField(blank=True, null=True)
+    raw_save_rows_per_second = models.FloatField(blank=True, null=True)
+    mapping_chunk_size = models.IntegerField(blank=True, null=True)
+    mapping_rows_per_second = models.FloatField(blank=True, null=True)
+    # JSON of the mapping plan the file's rows were last mapped with, so a
+    # remap can tell which fields changed. See seed.tasks.get_mapping_plan.
+    mapping_plan = models.TextField(blank=True, null=True)
+    # Workbook uploads, written out as CSV once so workers can read them in
+    # byte ranges. See ``stage_csv``.
+    staged_file = models.FileField(
+        upload_to="data_imports/staged", max_length=500, blank=True, null=True
+    )
 
     def __unicode__(self):
         return "%s" % self.file.name
@@ -823,25 +848,162 @@ class ImportFile(NotDeletableModel):
             # If we're deleting.
 
     @property
-    def local_file(self):
-        if not hasattr(self, "_local_file"):
-            temp_file = tempfile.NamedTemporaryFile(mode='w+b', bufsize=1024, delete=False)
-            for chunk in self.file.chunks(1024):
-                temp_file.write(chunk)
-            temp_file.flush()
-            temp_file.close()
-            self.file.close()
-            self._local_file = open(temp_file.name, 'rU')
+    def file_format(self):
+        """One of the ``streams`` formats, e.g. ``streams.CSV``."""
+        return get_file_format(self.file.name)
+
+    @property
+    def compression(self):
+        """``streams.GZIP`` or ``streams.ZIP`` for compressed uploads."""
+        return get_compression(self.file.name)
 
-        self._local_file.seek(0)
-        return self._local_file
+    def open_stream(self, start=0, end=None):
+        """Stream the contents of the file straight from storage, as CSV.
+
+        Lines come out with universal newlines, so the stream can be handed
+        to csv readers directly. Compressed uploads and Excel workbooks are
+        decoded on the fly; workbooks can't be read in byte ranges.
+
+        """
+        local_path = None
+        if self.file_format == XLS:
+            local_path = self.local_upload_path
+        return open_stream(
+            self.file, start=start, end=end, local_path=local_path
+        )
+
+    @property
+    def csv_file(self):
+        """The stored CSV of this file that can be read in byte ranges.
+
+        That's the upload itself for plain and compressed CSV files, which
+        are decompressed as they're read, and the staged copy ``stage_csv``
+        makes of workbooks.
+
+        """
+        if self.file_format in RANGE_FORMATS:
+            return self.file
+
+        return self.staged_file
+
+    def stage_csv(self):
+        """Write a workbook upload out as CSV, in storage.
+
+        Workbooks are parsed from the start however little of them is
+        read, so each worker reading its own range of one would parse it
+        again. The CSV is spooled through a local temp file, never held in
+        memory, and kept until ``cleanup_local_file`` is called. Does
+        nothing for other files, or if the file is already staged.
+
+        """
+        if self.file_format in RANGE_FORMATS or self.staged_file:
+            return
+
+        with tempfile.TemporaryFile() as temp_file:
+            with self.open_stream() as stream:
+                data = stream.read(stream.read_size)
+                while data:
+                    temp_file.write(data)
+                    data = stream.read(stream.read_size)
+            temp_file.seek(0)
+            name = os.path.basename(self.file.name) + '.csv'
+            self.staged_file.save(name, File(temp_file), save=False)
+        ImportFile.objects.filter(pk=self.pk).update(
+            staged_file=self.staged_file.name
+        )
+
+    @property
+    def local_file_path(self):
+        """Where the upload is copied to, if it's not on local disk.
+
+        Copies are shared by the tasks on a host, in a directory only the
+        app's user can write to: ``settings.IMPORT_FILE_CACHE_DIR``, or
+        one of its own in the system temp dir. If that directory isn't
+        safe to use, this instance keeps its copy in a new temp dir.
+
+        """
+        cache_dir = get_private_dir(
+            getattr(settings, 'IMPORT_FILE_CACHE_DIR', None), 'seed-imports'
+        )
+        if cache_dir is None:
+            if getattr(self, '_local_dir', None) is None:
+                self._local_dir = tempfile.mkdtemp(prefix='seed-imports-')
+            cache_dir = self._local_dir
+        return os.path.join(cache_dir, 'seed-import-{0}-{1}'.format(
+            self.pk, hashlib.md5(self.file.name).hexdigest()
+        ))
+
+    def _write_local_copy(self, path, stream):
+        """Copy ``stream`` to ``path``, unless another task already has."""
+        if os.path.exists(path) and is_private(path):
+            stream.close()
+            return
+
+        # Write to a scratch name first so other workers never open a
+        # partial copy.
+        temp_file = tempfile.NamedTemporaryFile(
+            mode='w+b',
+            dir=os.path.dirname(path),
+            prefix=os.path.basename(path) + '.',
+            suffix='.part',
+            delete=False,
+        )
+        with stream:
+            data = stream.read(stream.read_size)
+            while data:
+                temp_file.write(data)
+                data = stream.read(stream.read_size)
+        temp_file.close()
+        os.rename(temp_file.name, path)
+
+    @property
+    def local_upload_path(self):
+        """The path of the upload, as uploaded, on local disk.
+
+        Files in local storage are used in place; others are copied to
+        local disk until ``cleanup_local_file`` is called.
+
+        """
+        try:
+            return self.file.path
+        except NotImplementedError:
+            pass
+
+        path = self.local_file_path
+        self._write_local_copy(path, StorageStream(self.file))
+        return path
+
+    def remove_local_copy(self):
+        """Remove this host's local copy of the file, if any.
+
+        Call it from each task that may have read a workbook, once it's
+        done with it; no other task cleans up after it on its host.
+
+        """
+        try:
+            os.remove(self.local_file_path)
+        except OSError:
+            pass
+        if getattr(self, '_local_dir', None) is not None:
+            os.rmdir(self._local_dir)
+            self._local_dir = None
+
+    def cleanup_local_file(self):
+        """Remove the local and staged copies of the file, if any."""
+        self.remove_local_copy()
+        if self.staged_file:
+            self.staged_file.delete(save=False)
+            ImportFile.objects.filter(pk=self.pk).update(staged_file=None)
 
     @property
     def data_rows(self):
         """Iterable of rows, made of iterable of column values of the raw data"""
-        csv_reader = csv.reader(self.local_file)
-        for row in csv_reader:
-            yield row
+        try:
+            with self.open_stream() as stream:
+                for row in csv.reader(stream):
+                    yield row
+        finally:
+            self.remove_local_copy()
 
     @property
     def cleaned_data_rows(self):
@@ -936,12 +1098,9 @@ class ImportFile(NotDeletableModel):
     #     self.num_coercion_errors = num_coercion_errors
 
     def cache_first_rows(self):
-        self.file.seek(0)
-
         counter = 0
-        csv_reader = csv.reader(self.local_file)
         NUM_LINES_TO_CAPTURE = 6
-        for row in csv_reader:
+        for row in self.data_rows:
             counter += 1
             if counter <= NUM_LINES_TO_CAPTURE:
                 if counter == 1:
@@ -1232,6 +1391,29 @@ class ImportFile(NotDeletableModel):
         return reverse("data_importer:force_restart_cleaning", args=(self.pk, ))
 
 
+class ImportChunk(models.Model):
+    """Records that one chunk of an import stage has been committed.
+
+    Written in the same transaction as the chunk's rows, so a stage that
+    dies part way through can be resumed by re-dispatching only the chunks
+    without a record.
+
+    """
+    import_file = models.ForeignKey(ImportFile, related_name='chunks')
+    stage = models.CharField(max_length=32)
+    index = models.IntegerField()
+    num_rows = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('import_file', 'stage', 'index')
+
+    def __unicode__(self):
+        return u'%s chunk %s of %s' % (
+            self.stage, self.index, self.import_file_id
+        )
+
+
 class TableColumnMapping(models.Model):
     app = models.CharField(max_length=64, default='')
     source_string = models.TextField()
@@ -0,0 +1,321 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+"""
+"""
+Row readers for Excel workbooks that never hold more than one sheet.
+
+Both readers yield ``(sheet name, rows)`` pairs, sheet by sheet, where rows
+is an iterator of lists of unicode cell values.
+"""
+import datetime
+import posixpath
+import re
+import zipfile
+from xml.etree import cElementTree
+
+import xlrd
+
+
+XLSX_DATE_FORMAT_IDS = set(range(14, 23)) | set([45, 46, 47])
+# Quoted text, escaped characters and [colour]/[condition] sections of a
+# number format, none of which say whether a cell is a date.
+NUMBER_FORMAT_NOISE = re.compile(r'"[^"]*"|\\.|\[[^\]]*\]')
+DATE_FORMAT_CODES = re.compile(r'[dmyhs]', re.IGNORECASE)
+
+EPOCH_1900 = datetime.datetime(1899, 12, 30)
+EPOCH_1904 = datetime.datetime(1904, 1, 1)
+
+
+def _local(tag):
+    """Strip the namespace from an ElementTree tag."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(elem, name):
+    return [child for child in elem if _local(child.tag) == name]
+
+
+def _attr(elem, name):
+    """Get an attribute by local name, whatever its namespace."""
+    for key, value in elem.attrib.items():
+        if _local(key) == name:
+            return value
+    return None
+
+
+def format_number(value):
+    """Render a float the way it was typed, 12.0 as u'12'."""
+    if value == int(value) and abs(value) < 1e15:
+        return unicode(int(value))
+    return unicode(repr(value))
+
+
+def format_datetime(value):
+    if value.time() == datetime.time(0):
+        return unicode(value.date().isoformat())
+    return unicode(value.isoformat(' '))
+
+
+def format_bool(value):
+    return u'TRUE' if value else u'FALSE'
+
+
+def column_index(ref):
+    """Return the 0-based column of a cell reference like u'AB12'."""
+    index = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord('A') + 1
+    return index - 1
+
+
+def is_date_format(format_id, format_code=None):
+    if format_id in XLSX_DATE_FORMAT_IDS:
+        return True
+    if format_code:
+        return bool(DATE_FORMAT_CODES.search(
+            NUMBER_FORMAT_NOISE.sub('', format_code)
+        ))
+    return False
+
+
+class XlsxReader(object):
+    """Reads the sheets of an .xlsx workbook with ``iterparse``.
+
+    Only the shared strings and the cell styles are held in memory; sheet
+    rows are parsed and dropped one at a time.
+
+    """
+    def __init__(self, fileobj):
+        self.archive = zipfile.ZipFile(fileobj)
+        self.names = set(self.archive.namelist())
+        self.epoch = EPOCH_1900
+        self.sheets = self._read_workbook()
+        self.shared_strings = self._read_shared_strings()
+        self.date_styles = self._read_date_styles()
+
+    def _parse(self, name):
+        if name not in self.names:
+            return None
+        with self.archive.open(name) as f:
+            return cElementTree.parse(f).getroot()
+
+    def _read_workbook(self):
+        """Return a list of (sheet name, member name) in workbook order."""
+        workbook = self._parse('xl/workbook.xml')
+        for pr in _children(workbook, 'workbookPr'):
+            if pr.get('date1904') in ('1', 'true'):
+                self.epoch = EPOCH_1904
+
+        targets = {}
+        rels = self._parse('xl/_rels/workbook.xml.rels')
+        for rel in rels if rels is not None else []:
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl', target))
+            targets[rel.get('Id')] = target
+
+        sheets = []
+        for container in _children(workbook, 'sheets'):
+            for sheet in _children(container, 'sheet'):
+                target = targets.get(_attr(sheet, 'id'))
+                if target in self.names:
+                    sheets.append((sheet.get('name'), target))
+
+        return sheets
+
+    def _read_shared_strings(self):
+        strings = []
+        name = 'xl/sharedStrings.xml'
+        if name not in self.names:
+            return strings
+
+        with self.archive.open(name) as f:
+            for event, elem in cElementTree.iterparse(f):
+                if _local(elem.tag) == 'si':
+                    strings.append(self._text(elem))
+                    elem.clear()
+
+        return strings
+
+    def _read_date_styles(self):
+        """Return the set of cell style indexes that format dates."""
+        styles = self._parse('xl/styles.xml')
+        if styles is None:
+            return set()
+
+        format_codes = {}
+        for container in _children(styles, 'numFmts'):
+            for fmt in _children(container, 'numFmt'):
+                format_id = int(fmt.get('numFmtId'))
+                format_codes[format_id] = fmt.get('formatCode')
+
+        date_styles = set()
+        for container in _children(styles, 'cellXfs'):
+            for index, xf in enumerate(_children(container, 'xf')):
+                format_id = int(xf.get('numFmtId', 0))
+                if is_date_format(format_id, format_codes.get(format_id)):
+                    date_styles.add(index)
+
+        return date_styles
+
+    def _text(self, elem):
+        """Text of a string item, skipping phonetic runs."""
+        if _local(elem.tag) == 't':
+            return elem.text or u''
+        return u''.join(
+            self._text(child) for child in elem if _local(child.tag) != 'rPh'
+        )
+
+    def _cell_value(self, cell):
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            return u''.join(self._text(i) for i in _children(cell, 'is'))
+
+        values = _children(cell, 'v')
+        value = values[0].text if values else None
+        if value is None or cell_type == 'e':
+            return u''
+        if cell_type == 's':
+            return self.shared_strings[int(value)]
+        if cell_type == 'b':
+            return format_bool(value == '1')
+        if cell_type in ('str', 'd'):
+            return unicode(value)
+
+        number = float(value)
+        if int(cell.get('s', 0)) in self.date_styles:
+            return format_datetime(
+                self.epoch + datetime.timedelta(days=number)
+            )
+        return format_number(number)
+
+    def iter_rows(self, member):
+        with self.archive.open(member) as f:
+            sheet_data = None
+            for event, elem in cElementTree.iterparse(
+                f, events=('start', 'end')
+            ):
+                tag = _local(elem.tag)
+                if event == 'start':
+                    if tag == 'sheetData':
+                        sheet_data = elem
+                    continue
+                if tag != 'row':
+                    continue
+
+                row = []
+                for cell in _children(elem, 'c'):
+                    ref = cell.get('r')
+                    index = column_index(ref) if ref else len(row)
+                    row.extend([u''] * (index - len(row)))
+                    row.append(self._cell_value(cell))
+                # Drop the parsed row so memory stays flat.
+                elem.clear()
+                if sheet_data is not None:
+                    sheet_data.clear()
+                yield row
+
+    def iter_sheets(self):
+        for name, member in self.sheets:
+            yield name, self.iter_rows(member)
+
+    def close(self):
+        self.archive.close()
+
+
+def iter_xlsx_sheets(fileobj):
+    """Yield ``(sheet name, rows)`` for each sheet of an .xlsx workbook.
+
+    :param fileobj: seekable file of the workbook, closed when done.
+
+    """
+    try:
+        reader = XlsxReader(fileobj)
+        for sheet in reader.iter_sheets():
+            yield sheet
+        reader.close()
+    finally:
+        fileobj.close()
+
+
+def iter_xls_sheets(path):
+    """Yield ``(sheet name, rows)`` for each sheet of an .xls workbook.
+
+    :param path: str, local path of the workbook. xlrd maps the file
+        rather than reading it all, and only one sheet is loaded at a time.
+
+    """
+    book = xlrd.open_workbook(path, on_demand=True)
+    try:
+        for index, name in enumerate(book.sheet_names()):
+            sheet = book.sheet_by_index(index)
+            yield name, _iter_xls_rows(book, sheet)
+            book.unload_sheet(index)
+    finally:
+        book.release_resources()
+
+
+def _iter_xls_rows(book, sheet):
+    for index in xrange(sheet.nrows):
+        row = []
+        for cell in sheet.row(index):
+            if cell.ctype == xlrd.XL_CELL_DATE:
+                try:
+                    value = format_datetime(datetime.datetime(
+                        *xlrd.xldate_as_tuple(cell.value, book.datemode)
+                    ))
+                except xlrd.XLDateError:
+                    value = format_number(cell.value)
+            elif cell.ctype == xlrd.XL_CELL_NUMBER:
+                value = format_number(cell.value)
+            elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                value = format_bool(cell.value)
+            elif cell.ctype == xlrd.XL_CELL_TEXT:
+                value = cell.value
+            else:
+                value = u''
+            row.append(value)
+        yield row
+
+
+def iter_workbook_rows(sheets):
+    """Combine the sheets of a workbook into one table of rows.
+
+    :param sheets: iterable of (sheet name, rows), as from the readers above.
+
+    The first row of the first non-empty sheet is the header. Later sheets
+    with the same header row are appended to the table; sheets with some
+    other header hold other data and are skipped. Blank rows are dropped.
+
+    """
+    header = None
+    for name, rows in sheets:
+        rows = (_trim(row) for row in rows)
+        rows = (row for row in rows if row)
+        for row in rows:
+            if header is None:
+                header = row
+                yield header
+            elif row != header:
+                # Not a continuation of the first sheet.
+                break
+            for row in rows:
+                yield _fit(row, len(header))
+            break
+
+
+def _trim(row):
+    """Drop trailing empty cells."""
+    while row and not row[-1]:
+        row.pop()
+    return row
+
+
+def _fit(row, width):
+    """Pad a row out to the header's width."""
+    return row + [u''] * (width - len(row))
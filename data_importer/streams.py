@@ -0,0 +1,521 @@
+"""
+:copyright: (c) 2014 Building Energy Inc
+:license: see LICENSE for more details.
+"""
+"""
+Readers that parse import files straight off their storage backend.
+"""
+import csv
+import zipfile
+import zlib
+from cStringIO import StringIO
+from itertools import islice
+
+from django.conf import settings
+
+from data_importer.spreadsheets import (
+    iter_workbook_rows, iter_xls_sheets, iter_xlsx_sheets
+)
+
+
+# Bytes per read from the storage backend.
+DEFAULT_READ_SIZE = 1024 * 1024
+# Bytes per read when all we want is the header row.
+HEADER_READ_SIZE = 64 * 1024
+# Number of rows to sample when estimating row sizes.
+SAMPLE_ROWS = 100
+
+# Upload formats, see ``get_file_format``.
+CSV = 'csv'
+GZIP = 'gzip'
+ZIP = 'zip'
+XLSX = 'xlsx'
+XLS = 'xls'
+FILE_FORMAT_EXTENSIONS = (
+    ('.gz', GZIP),
+    ('.zip', ZIP),
+    ('.xlsx', XLSX),
+    ('.xls', XLS),
+)
+# Formats ``open_stream`` can read in byte ranges of their CSV.
+RANGE_FORMATS = (CSV, GZIP, ZIP)
+
+
+def get_read_size():
+    return getattr(settings, 'IMPORT_READ_SIZE', DEFAULT_READ_SIZE)
+
+
+def open_storage_file(field_file, offset=0):
+    """Open a stored file for reading, starting at byte ``offset``.
+
+    S3 backed files are read directly off their key; reading the storage's
+    own File would spool the whole object to a temp file first.
+
+    """
+    f = field_file.storage.open(field_file.name, 'rb')
+    key = getattr(f, 'key', None)
+    if key is not None:
+        if offset >= key.size:
+            return StringIO('')
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+        key.open_read(headers=headers)
+        return key
+
+    if offset:
+        f.seek(offset)
+    return f
+
+
+class BufferedStream(object):
+    """Base for buffered readers that hand out universal newline text.
+
+    Reads ``read_size`` bytes at a time from whatever subclasses open in
+    ``_open``. ``read`` returns the bytes as they are, ``readline`` and
+    iteration translate '\r\n' and '\r' to '\n', as if the file were
+    opened with 'rU', so csv readers can iterate over the stream directly.
+    ``tell`` reports offsets into the untranslated bytes.
+
+    """
+    def __init__(self, start=0, read_size=None):
+        self.read_size = read_size or get_read_size()
+        self.closed = False
+        self._raw = None
+        self._open(start)
+
+    def _open(self, offset):
+        """(Re-)open the source so the next read starts at ``offset``."""
+        raise NotImplementedError
+
+    def _read_block(self, size):
+        """Return up to ``size`` more bytes, '' at the end of the source."""
+        raise NotImplementedError
+
+    def _reset(self, offset):
+        self._buf = ''
+        self._buf_offset = offset  # Offset of the start of ``_buf``.
+        self._i = 0  # Read position within ``_buf``.
+        self._eof = False
+
+    def _fill(self):
+        """Read another block into the buffer, False if there's no more."""
+        if self._eof:
+            return False
+
+        data = self._read_block(self.read_size)
+        if not data:
+            self._eof = True
+            return False
+
+        self._buf_offset += self._i
+        self._buf = self._buf[self._i:] + data
+        self._i = 0
+        return True
+
+    def size(self):
+        raise IOError('{0} has no known size.'.format(type(self).__name__))
+
+    def tell(self):
+        return self._buf_offset + self._i
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self.size()
+
+        if self._buf_offset <= offset <= self._buf_offset + len(self._buf):
+            self._i = offset - self._buf_offset
+        else:
+            self._open(offset)
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) - self._i < size:
+            if not self._fill():
+                break
+
+        if size < 0:
+            size = len(self._buf) - self._i
+        data = self._buf[self._i:self._i + size]
+        self._i += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            buf, i = self._buf, self._i
+            nl = buf.find('\n', i)
+            cr = buf.find('\r', i, nl if nl >= 0 else len(buf))
+            if cr >= 0:
+                # Make sure we can tell a '\r\n' from a lone '\r'.
+                if cr + 1 == len(buf) and self._fill():
+                    continue
+                self._i = cr + 1
+                if buf[cr + 1:cr + 2] == '\n':
+                    self._i += 1
+                return buf[i:cr] + '\n'
+            if nl >= 0:
+                self._i = nl + 1
+                return buf[i:self._i]
+            if not self._fill():
+                self._i = len(buf)
+                return buf[i:]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StorageStream(BufferedStream):
+    """Buffered reader over a file in a storage backend.
+
+    The stream can be limited to the byte range ``start:end``. Seeking
+    outside of the buffer re-opens the stored file at the new offset
+    rather than keeping a copy of it around.
+
+    """
+    def __init__(self, field_file, start=0, end=None, read_size=None):
+        self.field_file = field_file
+        self.start = start
+        self.end = end
+        super(StorageStream, self).__init__(start=start, read_size=read_size)
+
+    def _open(self, offset):
+        if self._raw is not None:
+            self._raw.close()
+        self._raw = open_storage_file(self.field_file, offset)
+        self._reset(offset)
+
+    def _read_block(self, size):
+        if self.end is not None:
+            size = min(size, self.end - self._buf_offset - len(self._buf))
+            if size <= 0:
+                return ''
+
+        return self._raw.read(size)
+
+    def size(self):
+        return self.field_file.size
+
+
+class DecodedStream(BufferedStream):
+    """Base for streams over CSV decoded from some other stored format.
+
+    Offsets are into the decoded bytes, and the stream can be limited to
+    the range ``start:end`` of them. Compressed files and workbooks can
+    only be read front to back, so opening the stream at ``start``, or
+    seeking backwards past the buffer, decodes from the beginning of the
+    file and drops what comes before. Nothing is written to disk.
+
+    """
+    def __init__(self, source, start=0, end=None, read_size=None):
+        self.source = source
+        self.end = end
+        super(DecodedStream, self).__init__(start=start, read_size=read_size)
+
+    def _fill(self):
+        if self.end is not None and (
+            self._buf_offset + len(self._buf) >= self.end
+        ):
+            return False
+        if not super(DecodedStream, self)._fill():
+            return False
+        if self.end is not None:
+            self._buf = self._buf[:self.end - self._buf_offset]
+        return True
+
+    def _open_source(self):
+        """Open ``source`` for decoding, see ``_read_block``."""
+        raise NotImplementedError
+
+    def _open(self, offset):
+        if self._raw is not None:
+            self.close()
+        self._open_source()
+        self.closed = False
+        self._reset(0)
+        while self.tell() < offset and self._fill():
+            self._i = min(offset - self._buf_offset, len(self._buf))
+
+
+class GzipStream(DecodedStream):
+    """Stream over the decompressed contents of a stored gzip file."""
+    def _open_source(self):
+        self._raw = StorageStream(self.source, read_size=self.read_size)
+        self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_block(self, size):
+        while True:
+            if self._zlib.unused_data:
+                # Start of the next member of a concatenated gzip file.
+                data = self._zlib.unused_data
+                self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                data = self._raw.read(size)
+            if not data:
+                return self._zlib.flush()
+
+            decompressed = self._zlib.decompress(data)
+            if decompressed:
+                return decompressed
+
+
+class ZipStream(DecodedStream):
+    """Stream over the CSV inside a stored zip archive.
+
+    The archive is read in place through a seekable StorageStream; only the
+    central directory and the member itself are fetched.
+
+    """
+    def _open_source(self):
+        self._archive_stream = StorageStream(
+            self.source, read_size=self.read_size
+        )
+        self._archive = zipfile.ZipFile(self._archive_stream)
+        self._raw = self._archive.open(get_zip_member(self._archive))
+
+    def _read_block(self, size):
+        return self._raw.read(size)
+
+    def close(self):
+        super(ZipStream, self).close()
+        if getattr(self, '_archive', None) is not None:
+            self._archive.close()
+            self._archive_stream.close()
+            self._archive = None
+
+
+class SpreadsheetStream(DecodedStream):
+    """Stream over the rows of a workbook, written out as CSV.
+
+    ``source`` is a callable returning the workbook's ``(sheet name, rows)``
+    pairs, see ``spreadsheets``. Rows are only read as the stream is.
+
+    """
+    def _open_source(self):
+        self._raw = StringIO()
+        self._rows = iter_workbook_rows(self.source())
+
+    def _read_block(self, size):
+        out = StringIO()
+        writer = csv.writer(out)
+        for row in self._rows:
+            writer.writerow([value.encode('utf-8') for value in row])
+            if out.tell() >= size:
+                break
+
+        return out.getvalue()
+
+    def close(self):
+        super(SpreadsheetStream, self).close()
+        if getattr(self, '_rows', None) is not None:
+            self._rows.close()
+            self._rows = None
+
+
+def get_zip_member(archive):
+    """Return the name of the CSV to import from a zip archive."""
+    names = [
+        name for name in archive.namelist()
+        if not name.endswith('/') and not name.startswith('__MACOSX/')
+    ]
+    csv_names = [name for name in names if name.lower().endswith('.csv')]
+    if not (csv_names or names):
+        raise ValueError('Zip archive has no files to import.')
+
+    return (csv_names or names)[0]
+
+
+def get_file_format(name):
+    """Return the format of an upload by its file name, CSV by default."""
+    name = (name or '').lower()
+    for extension, file_format in FILE_FORMAT_EXTENSIONS:
+        if name.endswith(extension):
+            return file_format
+
+    return CSV
+
+
+def get_compression(name):
+    """Return the compression of a file by its name, None if it's plain."""
+    file_format = get_file_format(name)
+    if file_format in (GZIP, ZIP):
+        return file_format
+
+    return None
+
+
+def open_stream(field_file, start=0, end=None, local_path=None,
+                read_size=None):
+    """Return a stream over the contents of a stored file, as CSV.
+
+    :param field_file: FieldFile of the upload.
+    :param start: (optional) int, offset to start reading at.
+    :param end: (optional) int, offset to stop reading at.
+    :param local_path: (optional) str, the path of a local copy of the
+        file. Only .xls files, which xlrd reads by mapping them into memory,
+        need one.
+    :param read_size: (optional) int, bytes per read.
+
+    Offsets are into the CSV, decompressed for gzip and zip files, which
+    are decoded from the start of the file up to ``start`` on the fly.
+    Workbooks can't be read in byte ranges, see ``RANGE_FORMATS``.
+
+    """
+    file_format = get_file_format(field_file.name)
+    if file_format == CSV:
+        return StorageStream(
+            field_file, start=start, end=end, read_size=read_size
+        )
+    if file_format == GZIP:
+        return GzipStream(
+            field_file, start=start, end=end, read_size=read_size
+        )
+    if file_format == ZIP:
+        return ZipStream(
+            field_file, start=start, end=end, read_size=read_size
+        )
+
+    if start or end is not None:
+        raise ValueError(
+            "Workbooks can't be read in byte ranges: {0}".format(
+                field_file.name
+            )
+        )
+    if file_format == XLSX:
+        return SpreadsheetStream(
+            lambda: iter_xlsx_sheets(StorageStream(field_file))
+        )
+
+    return SpreadsheetStream(lambda: iter_xls_sheets(local_path))
+
+
+def iter_csv_records(stream):
+    """Yield ``(start, end, lines, row)`` for each CSV record in ``stream``.
+
+    ``start`` and ``end`` are raw byte offsets into the stored file,
+    ``lines`` the record's text and ``row`` its parsed fields. Records are
+    split by the csv module itself, so quoted fields with embedded newlines
+    stay in one record, exactly as a csv reader over the whole file would
+    see them. Blank lines come out as records with an empty row, see
+    ``is_blank``.
+
+    """
+    state = {'end': stream.tell(), 'lines': []}
+
+    def lines():
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            state['end'] = stream.tell()
+            state['lines'].append(line)
+            yield line
+
+    start = stream.tell()
+    for row in csv.reader(lines()):
+        record_lines, state['lines'] = state['lines'], []
+        yield start, state['end'], record_lines, row
+        start = state['end']
+
+
+def is_blank(row):
+    """csv.DictReader, and so MCMParser, skips rows without any fields."""
+    return row == []
+
+
+def read_header(field_file):
+    """Return ``(lines, end)`` for the header record of a stored CSV file."""
+    with open_stream(field_file, read_size=HEADER_READ_SIZE) as stream:
+        for start, end, lines, row in iter_csv_records(stream):
+            return lines, end
+
+    return [], 0
+
+
+def sample_row_bytes(stream, num_rows=SAMPLE_ROWS):
+    """Return the average size in bytes of the first data rows of a file.
+
+    :param stream: a stream at the start of the file, see ``open_stream``.
+    :rtype: float, or None if the file has no data rows.
+
+    """
+    records = islice(iter_csv_records(stream), 1, num_rows + 1)
+    sizes = [end - start for start, end, _, row in records
+             if not is_blank(row)]
+    if not sizes:
+        return None
+
+    return float(sum(sizes)) / len(sizes)
+
+
+def scan_row_ranges(field_file, rows_per_range):
+    """Split a stored CSV file into byte ranges of whole rows.
+
+    :param field_file: FieldFile of the CSV, plain or compressed, see
+        ``RANGE_FORMATS``.
+    :param rows_per_range: int, number of data rows in each range.
+    :rtype: tuple, (header row, list of (start, end, num_rows) tuples)
+
+    Only record boundaries are kept, no rows, so the scan runs in constant
+    memory regardless of the size of the file. The header row is left out
+    of the ranges, and blank lines are not counted as rows.
+
+    """
+    header = []
+    ranges = []
+    with open_stream(field_file) as stream:
+        records = iter_csv_records(stream)
+        for start, end, lines, row in records:
+            header = row
+            break
+        else:
+            return header, ranges
+
+        range_start = range_end = end
+        count = 0
+        for start, end, lines, row in records:
+            if is_blank(row):
+                continue
+            count += 1
+            range_end = end
+            if count == rows_per_range:
+                ranges.append((range_start, range_end, count))
+                range_start, count = range_end, 0
+
+        if count:
+            ranges.append((range_start, range_end, count))
+
+    return header, ranges
+
+
+def open_csv_slice(field_file, start, end):
+    """Return a file with the header and the rows in ``start:end``.
+
+    The rows of a range from ``scan_row_ranges`` are small enough to hold
+    in memory, and a parser over the returned file sees a complete CSV
+    file of its own.
+
+    """
+    header_lines = read_header(field_file)[0]
+    with open_stream(field_file, start=start, end=end) as stream:
+        body = ''.join(stream)
+
+    return StringIO(''.join(header_lines) + body)
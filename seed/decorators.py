@@ -11,6 +11,9 @@ from landing.models import SEEDUser as User
 SEED_CACHE_PREFIX = 'SEED:{0}'
 LOCK_CACHE_PREFIX = SEED_CACHE_PREFIX + ':LOCK'
 PROGRESS_CACHE_PREFIX = SEED_CACHE_PREFIX + ':PROG'
+WINDOW_CACHE_PREFIX = SEED_CACHE_PREFIX + ':WINDOW'
+STATS_CACHE_PREFIX = SEED_CACHE_PREFIX + ':STATS'
+MATCH_CACHE_PREFIX = SEED_CACHE_PREFIX + ':MATCH'
 
 
 def _get_cache_key(prefix, import_file_pk):
@@ -30,6 +33,21 @@ def get_prog_key(func_name, import_file_pk):
     )
 
 
+def get_window_key(name, window_id):
+    """Makes a key like 'SEED:next:WINDOW:<window_id>'."""
+    return _get_cache_key(WINDOW_CACHE_PREFIX.format(name), window_id)
+
+
+def get_stats_key(name, pk):
+    """Makes a key like 'SEED:raw_save_rows:STATS:45'."""
+    return _get_cache_key(STATS_CACHE_PREFIX.format(name), pk)
+
+
+def get_match_key(name, run_id):
+    """Makes a key like 'SEED:shard0:MATCH:<run_id>'."""
+    return _get_cache_key(MATCH_CACHE_PREFIX.format(name), run_id)
+
+
 def increment_cache(key, increment):
     """Increment cache by value increment, never exceed 100."""
     value = cache.get(key) or 0.0
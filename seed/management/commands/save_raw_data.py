@@ -3,18 +3,52 @@ Helper function to take an uploaded file and save new buildings from it.
 
 Bypasses celery, for timing purposes.
 """
+import time
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from django.test.utils import override_settings
 
+from data_importer.models import ImportFile
 from seed.tasks import save_raw_data
+from seed.utils.ingest import RAW_SAVE_MODES, get_raw_save_mode
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--mode',
+                    choices=RAW_SAVE_MODES,
+                    default=None,
+                    help='Raw save mode, defaults to settings.RAW_SAVE_MODE.'),
+        make_option('--map',
+                    action='store_true',
+                    dest='map_on_save',
+                    default=False,
+                    help='Map rows as they are saved.'),
+        make_option('--resume',
+                    action='store_true',
+                    default=False,
+                    help='Only save chunks a previous run did not finish.'),
+        )
 
     help = 'Runs an import job sans celery'
 
     @override_settings(CELERY_ALWAYS_EAGER=True)
     def handle(self, *args, **options):
         pk = int(args[0])
-        print "Importing file %s" % pk
-        print save_raw_data(pk)
+        mode = get_raw_save_mode(options.get('mode'))
+        print "Importing file %s (mode: %s)" % (pk, mode)
+
+        start = time.time()
+        print save_raw_data(
+            pk,
+            raw_save_mode=mode,
+            map_on_save=options.get('map_on_save'),
+            resume=options.get('resume')
+        )
+        elapsed = time.time() - start
+
+        num_rows = ImportFile.objects.get(pk=pk).num_rows or 0
+        print "Saved %s rows in %.2fs (%.1f rows/sec)" % (
+            num_rows, elapsed, num_rows / elapsed if elapsed else 0.0
+        )
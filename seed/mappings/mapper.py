@@ -44,18 +44,32 @@ def get_attr_source(field_values, value):
 
 def get_source_id(source_inst, attr):
     """Get the ID we save for our model source from ``models`` module."""
-    default = 2  # BuildingSnapshot
     # Because we cannot FK directly to BuildingSnapshots we have to
     # painstakingly copy whatever the original reference to this field
     # out of the BS and into the BuildingAttributeVariant.
     if isinstance(source_inst, models.BuildingSnapshot):
         source_inst = getattr(source_inst, '{0}_source'.format(attr))
 
+    return get_source_class_id(source_inst.__class__)
+
+
+def get_source_class_id(source_class):
+    """Get the ID we save for sources of a class, see ``get_source_id``."""
+    default = 2  # BuildingSnapshot
     return getattr(
-        models, '{0}_SOURCE'.format(source_inst.__class__.__name__), default
+        models, '{0}_SOURCE'.format(source_class.__name__), default
     )
 
 
+def get_snapshot_source_id(snapshot, attr):
+    """As ``get_source_id`` for a snapshot, without fetching its source."""
+    source_class = type(None)
+    if getattr(snapshot, '{0}_source_id'.format(attr)) is not None:
+        source_class = models.BuildingSnapshot
+
+    return get_source_class_id(source_class)
+
+
 def merge_extra_data(b1, b2, default=None):
     """Merge extra_data field between two BuildinSnapshots, return result.
 
@@ -103,6 +117,43 @@ def merge_building(
     """
     default = default or b1
     match_type = match_type or models.SYSTEM_MATCH
+    for attr, attribute_values in merge_attributes(
+        snapshot, can_attrs, default
+    ):
+        save_variant(snapshot, attr, attribute_values)
+
+    snapshot.extra_data, snapshot.extra_data_sources = merge_extra_data(
+        b1, b2, default=default
+    )
+    snapshot.match_type = match_type
+    snapshot.source_type = models.COMPOSITE_BS
+    canonical_building = models.get_or_create_canonical(b1, b2)
+    snapshot.canonical_building = canonical_building
+    snapshot.confidence = conf
+    snapshot.save()
+
+    canonical_building.canonical_snapshot = snapshot
+    canonical_building.save()
+    b1.children.add(snapshot)
+    b2.children.add(snapshot)
+
+    return snapshot
+
+
+def merge_attributes(snapshot, can_attrs, default):
+    """Set the merged attribute values, and their sources, on a snapshot.
+
+    :param snapshot: BuildingSnapshot inst, the child being merged into.
+    :param can_attrs: dict of dicts, from ``get_building_attrs``.
+    :param default: BuildingSnapshot inst, whose values win differences.
+    :rtype: list of (attr, dict of values keyed on BuildingSnapshot inst),
+        the differing attributes to save variants of, see ``save_variant``.
+
+    Nothing is saved here, so this can merge unsaved snapshots too. The
+    snapshot's ``match_key`` is set from the merged values.
+
+    """
+    variants = []
     for attr in can_attrs:
         # Do we have any differences between these fields?
         attr_values = list(set([
@@ -113,9 +164,9 @@ def merge_building(
         # Two, differing values are set.
         if len(attr_values) > 1:
             # If we have more than one value for this field,
-            # save each of the field options in the DB,
+            # keep each of the field options as a variant,
             # but opt for the default when there is a difference.
-            save_variant(snapshot, attr, can_attrs[attr])
+            variants.append((attr, can_attrs[attr]))
             attr_source = default
             attr_value = can_attrs[attr][default]
 
@@ -139,22 +190,11 @@ def merge_building(
             setattr(snapshot, attr, attr_value)
             setattr(snapshot, '{0}_source'.format(attr), attr_source)
 
-    snapshot.extra_data, snapshot.extra_data_sources = merge_extra_data(
-        b1, b2, default=default
-    )
-    snapshot.match_type = match_type
-    snapshot.source_type = models.COMPOSITE_BS
-    canonical_building = models.get_or_create_canonical(b1, b2)
-    snapshot.canonical_building = canonical_building
-    snapshot.confidence = conf
-    snapshot.save()
-
-    canonical_building.canonical_snapshot = snapshot
-    canonical_building.save()
-    b1.children.add(snapshot)
-    b2.children.add(snapshot)
+    snapshot.match_key = models.make_match_key([
+        getattr(snapshot, field) for field in models.BS_VALUES_LIST[1:]
+    ])
 
-    return snapshot
+    return variants
 
 
 def get_building_attrs(data_set_buildings):
@@ -4,9 +4,11 @@
 """
 # system imports
 import json
+import re
+import string
 
 # django imports
-from django.db import models
+from django.db import connection, models
 from django.core import serializers
 from django.utils.translation import ugettext_lazy as _
 
@@ -26,7 +28,7 @@ from superperms.orgs.models import (
     Organization as SuperOrganization,
 )
 
-from seed.utils.time import convert_datestr
+from seed.utils.time import DateConverter, convert_datestr
 
 
 PROJECT_NAME_MAX_LENGTH = 255
@@ -67,6 +69,15 @@ SEARCH_CONFIDENCE_RANGES = {
 }
 
 
+# Date attributes given as strings by mapping, parsed by ``clean``.
+DATE_FIELD_NAMES = (
+    'year_ending',
+    'generation_date',
+    'release_date',
+    'recent_sale_date'
+)
+
+
 BS_VALUES_LIST = [
     'pk',  # needed for matching not to blow up
     'tax_lot_id',
@@ -74,6 +85,9 @@ BS_VALUES_LIST = [
     'custom_id_1',
     'address_line_1',
 ]
+PUNCT_REGEX = re.compile('[{0}]'.format(
+    re.escape(string.punctuation)
+))
 
 
 NATURAL_GAS = 1
@@ -135,6 +149,26 @@ ENERGY_UNITS = (
 ###
 
 
+def make_match_key(values):
+    """Take iterable of str and NoneTypes and reduce to space sep. str.
+
+    Made from the values of ``BS_VALUES_LIST`` after the PK, this is the
+    string matching compares, see ``BuildingSnapshot.match_key``.
+
+    """
+    words = []
+    for value in values:
+        if not value:
+            continue
+        if not isinstance(value, basestring):
+            # Unsaved snapshots can hold numbers the database would store
+            # as strings.
+            value = unicode(value)
+        words.append(PUNCT_REGEX.sub('', value.lower()))
+
+    return ' '.join(words)
+
+
 def get_ancestors(building):
     """gets all the non-raw, non-composite ancestors of a building
 
@@ -165,12 +199,16 @@ def find_unmatched_building_values(import_file):
 
     NB: This does not return a queryset!
 
+    Snapshots already matched into a child are left out, so a matching
+    run that died part way through picks up where it stopped.
+
     """
     return BuildingSnapshot.objects.filter(
         ~models.Q(source_type__in=[COMPOSITE_BS, ASSESSED_RAW, PORTFOLIO_RAW]),
         match_type=None,
         import_file=import_file,
         canonical_building=None,
+        children=None,
     ).values_list(*BS_VALUES_LIST)
 
 
@@ -246,6 +284,69 @@ def set_initial_sources(snapshot):
     return snapshot
 
 
+def reserve_pks(model, count):
+    """Reserve ``count`` primary keys from a model's PK sequence.
+
+    :param model: Model class, e.g. BuildingSnapshot.
+    :param count: int, the number of PKs we want.
+    :rtype: list of int, sorted.
+
+    Lets us know PKs before we bulk insert, so self-referencing columns can
+    be written in the same statement as the rest of the row.
+
+    """
+    if count < 1:
+        return []
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+        'FROM generate_series(1, %s)',
+        [model._meta.db_table, model._meta.pk.column, count]
+    )
+
+    return sorted([row[0] for row in cursor.fetchall()])
+
+
+def get_date_converters():
+    """Return a ``DateConverter`` for each of ``DATE_FIELD_NAMES``."""
+    return dict((field, DateConverter()) for field in DATE_FIELD_NAMES)
+
+
+def clean_snapshots(snapshots, date_converters=None):
+    """Clean a batch of unsaved snapshots, as ``BuildingSnapshot.clean``.
+
+    :param snapshots: list of BuildingSnapshot inst.
+    :param date_converters: (optional) dict, from ``get_date_converters``.
+        Pass the same ones for every batch of an import, so each date
+        field's format is only learned once.
+
+    The batch is cleaned a column at a time. A column of dates nearly
+    always repeats a few values, and each distinct one is parsed once.
+
+    """
+    if date_converters is None:
+        date_converters = get_date_converters()
+    for field in DATE_FIELD_NAMES:
+        convert_date = date_converters.get(field, convert_datestr)
+        parsed = {}
+        for snapshot in snapshots:
+            value = getattr(snapshot, field)
+            if value and isinstance(value, basestring):
+                if value not in parsed:
+                    parsed[value] = convert_date(value)
+                setattr(snapshot, field, parsed[value])
+
+    for snapshot in snapshots:
+        if snapshot.custom_id_1 and len(snapshot.custom_id_1) > 128:
+            snapshot.custom_id_1 = snapshot.custom_id_1[:128]
+        snapshot.match_key = make_match_key(
+            [getattr(snapshot, field) for field in BS_VALUES_LIST[1:]]
+        )
+
+    return snapshots
+
+
 def get_or_create_canonical(b1, b2=None):
     """Gets most trusted Canonical Building.
 
@@ -528,6 +629,33 @@ def get_column_mapping(column_raw, organization, source_type=ASSESSED_RAW):
         return None
 
 
+def get_column_mapping_index(organization, source_type=ASSESSED_RAW):
+    """Returns every previous mapping of an Org's source type, in one query.
+
+    :param organization: inst, Organization.
+    :param source_type: int, one of the ``SEED_DATA_SOURCES``.
+
+    :returns dict: raw column to ``get_column_mapping``'s result for it.
+
+    Look raw columns up in it with ``get_indexed_column_mapping`` rather
+    than querying for each one.
+
+    """
+    source_mappings = ColumnMapping.objects.filter(
+        super_organization=organization, source_type=source_type
+    ).values_list('column_raw', 'column_mapped')
+
+    return {
+        column_raw: (column_mapped, 1.0)
+        for column_raw, column_mapped in source_mappings
+    }
+
+
+def get_indexed_column_mapping(column_raw, index):
+    """Callable provided to MCM, ``get_column_mapping`` from an index."""
+    return index.get(column_raw)
+
+
 def get_column_mappings(organization, source_type=ASSESSED_RAW):
     """Returns dict of all the column mappings for an Org's given source type
 
@@ -1043,6 +1171,23 @@ class BuildingSnapshot(TimeStampedModel):
         ImportRecord, null=True, blank=True, related_name='+'
     )
 
+    # Hash of the normalized raw row, set on raw and mapped snapshots.
+    row_fingerprint = models.CharField(
+        max_length=40, null=True, blank=True, db_index=True
+    )
+    # Set on raw snapshots whose row is unchanged since an earlier import;
+    # points at the mapped snapshot already merged for that row.
+    duplicate_of = models.ForeignKey(
+        'BuildingSnapshot',
+        related_name='+',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL
+    )
+    # The normalized ID and address string matching compares, set when
+    # the snapshot is cleaned. Trigram indexed for the database engine.
+    match_key = models.TextField(null=True, blank=True)
+
     #
     ## JSON data
     ###
@@ -1054,20 +1199,22 @@ class BuildingSnapshot(TimeStampedModel):
 
     objects = ExpressionManager()
 
+    class Meta(TimeStampedModel.Meta):
+        # Mapping reads an import's raw rows by ranges of PK.
+        index_together = [['import_file', 'source_type', 'id']]
+
     def clean(self, *args, **kwargs):
         super(BuildingSnapshot, self).clean(*args, **kwargs)
-        date_field_names = (
-            'year_ending',
-            'generation_date',
-            'release_date',
-            'recent_sale_date'
-        )
-        if self.custom_id_1 and len(self.custom_id_1) > 128:
-            self.custom_id_1 = self.custom_id_1[:128]
-        for field in date_field_names:
-            value = getattr(self, field)
-            if value and isinstance(value, basestring):
-                setattr(self, field, convert_datestr(value))
+        self.clean_values()
+
+    def clean_values(self, date_converters=None):
+        """Truncate over-long IDs, parse date strings, set ``match_key``.
+
+        :param date_converters: (optional) dict, callable to parse each date
+            field's strings with, defaults to ``convert_datestr``.
+
+        """
+        clean_snapshots([self], date_converters or {})
 
     def to_dict(self, fields=None):
         """
@@ -26,7 +26,7 @@
             params: {category: 'data_imports'}
         },
         validation: {
-            allowedExtensions: ['csv']
+            allowedExtensions: ['csv', 'gz', 'zip', 'xlsx', 'xls']
         },
         /**
          * showMessage: callback override for error messages, e.g. 
@@ -4,11 +4,14 @@
 """
 import calendar
 import datetime
+from collections import OrderedDict
 from dateutil import parser
+import hashlib
 import json
-import re
-import string
+import logging
 import os
+import time
+import uuid
 
 from django.core.mail import send_mail
 from django.conf import settings
@@ -17,10 +20,11 @@ from django.utils.encoding import force_bytes
 from django.template import loader
 from django.core.cache import cache
 from django.core.files.storage import DefaultStorage
+from django.db import IntegrityError, transaction
 from django.db.models.loading import get_model
 from django.core.urlresolvers import reverse_lazy
 
-from celery.task import task, chord
+from celery.task import task
 
 from landing.models import SEEDUser as User
 from mcm import cleaners, mapper, reader
@@ -28,50 +32,107 @@ from mcm.mappings import espm as espm_mapping
 from mcm.data.ESPM import espm as espm_schema
 from mcm.data.SEED import seed as seed_schema
 from mcm.utils import batch
-import ngram
 
 from data_importer.models import (
     ImportFile, ImportRecord, STATUS_READY_TO_MERGE, ROW_DELIMITER
 )
+from data_importer.streams import (
+    open_csv_slice,
+    sample_row_bytes,
+    scan_row_ranges,
+)
 
 from seed.models import (
     ASSESSED_RAW,
     PORTFOLIO_RAW,
     ASSESSED_BS,
     PORTFOLIO_BS,
+    BS_VALUES_LIST,
     get_column_mappings,
     find_unmatched_building_values,
-    find_canonical_building_values,
     SYSTEM_MATCH,
     POSSIBLE_MATCH,
     initialize_canonical_building,
-    set_initial_sources,
-    save_snapshot_match,
     BuildingSnapshot,
     CanonicalBuilding,
     Compliance,
+    clean_snapshots,
+    get_date_converters,
     Project,
     ProjectBuilding,
 )
 
-from seed.decorators import lock_and_track, get_prog_key, increment_cache
+from seed.decorators import (
+    get_match_key,
+    get_prog_key,
+    get_window_key,
+    increment_cache,
+    lock_and_track,
+)
 from seed.utils.buildings import get_source_type, get_search_query
+from seed.utils.cleaning import MemoizedCleaner
+from seed.utils.chunking import (
+    DELETE,
+    DELETE_CANONICAL,
+    MAPPING,
+    RAW_SAVE,
+    clear_checkpoints,
+    get_done_chunks,
+    get_history_throughput,
+    is_chunk_done,
+    pk_ranges,
+    plan_chunk_size,
+    pop_throughput,
+    record_chunk,
+    save_checkpoint,
+    save_history_throughput,
+)
+from seed.utils.ingest import (
+    INSERT_BATCH_SIZE,
+    flag_unchanged_rows,
+    get_raw_save_mode,
+    row_fingerprint,
+    save_raw_data_rows,
+    skip_unchanged_rows,
+    update_mapped_fields,
+)
+from seed.utils.match_engines import get_match_engine
+from seed.utils.match_index import find_exact_matches
+from seed.utils.merging import save_snapshot_matches
 
 from superperms.orgs.models import Organization
 
 from . import exporter
 
+logger = logging.getLogger(__name__)
 
 # Maximum number of possible matches under which we'll allow a system match.
 MAX_SEARCH = 5
 # Minimum confidence of two buildings being related.
 MIN_CONF = .80
+# Default number of chunk tasks an import keeps queued at once.
+DEFAULT_TASK_WINDOW = 8
+# Seconds the state of a windowed dispatch is kept for.
+WINDOW_CACHE_TIMEOUT = 60 * 60 * 24
 # Knows how to clean floats for ESPM data.
 ASSESSED_CLEANER = cleaners.Cleaner(seed_schema.schema)
 PORTFOLIO_CLEANER = cleaners.Cleaner(espm_schema.schema)
-PUNCT_REGEX = re.compile('[{0}]'.format(
-    re.escape(string.punctuation)
-))
+# Cleaner for each mapped source type.
+MAPPING_CLEANERS = {
+    ASSESSED_BS: ASSESSED_CLEANER,
+    PORTFOLIO_BS: PORTFOLIO_CLEANER,
+}
+# Mapping plans already compiled by this worker, by (file pk, version),
+# least recently used first.
+_compiled_plans = OrderedDict()
+# Most compiled plans a worker keeps, for imports mapped side by side.
+COMPILED_PLANS_SIZE = 4
+# Unmatched buildings each matching task searches for.
+MATCH_SHARD_SIZE = 1000
+# Seconds a matching shard's results wait for the rest of the run.
+MATCH_CACHE_TIMEOUT = 60 * 60 * 24
+# Matches saved together; all of a canonical building's go in one batch.
+MERGE_BATCH_SIZE = 500
 
 
 @task
@@ -360,6 +421,142 @@ def add_cache_increment_parameter(tasks):
     return tasks
 
 
+def skip_done_chunks(tasks, file_pk, stage, prog_key, resume=False):
+    """Number a stage's chunk tasks, leaving out those already committed.
+
+    :param tasks: list of subtasks, every chunk of the stage in order, with
+        their cache increment already added.
+    :param resume: (optional) bool, keep the checkpoints of an earlier
+        attempt at the stage. Otherwise they're cleared and every chunk runs.
+    :rtype: list of subtasks still to run.
+
+    Each task gets its position as the ``chunk_index`` kwarg, which it
+    checkpoints along with its rows. Chunk boundaries must be the same as
+    on the first attempt for the indexes to line up.
+
+    """
+    if resume:
+        done = get_done_chunks(file_pk, stage)
+    else:
+        clear_checkpoints(file_pk, stage)
+        done = set()
+
+    remaining = []
+    for index, _task in enumerate(tasks):
+        _task.kwargs = dict(_task.kwargs, chunk_index=index)
+        if index not in done:
+            remaining.append(_task)
+
+    cache.set(prog_key, 100.0 * len(done) / (len(tasks) or 1))
+
+    return remaining
+
+
+def dispatch_windowed(tasks, callback, window=None):
+    """Run ``tasks``, then ``callback``, with few tasks queued at a time.
+
+    :param tasks: list of subtasks.
+    :param callback: subtask, called with ``None`` for the results once
+        every task has finished.
+    :param window: (optional) int, the most tasks to keep queued at once,
+        defaults to ``settings.IMPORT_TASK_WINDOW``.
+
+    Takes the place of ``chord(tasks)(callback)``, which queues every task
+    at once and lets a big import starve everything else on the queue.
+    The tasks wait in the cache and each one that finishes, or fails,
+    queues the next. As with a chord, every task runs but the callback
+    doesn't if any of them failed; the failures are logged.
+
+    """
+    if not tasks:
+        return callback.delay(None)
+
+    if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+        return callback.delay([_task.apply().get() for _task in tasks])
+
+    window = window or getattr(
+        settings, 'IMPORT_TASK_WINDOW', DEFAULT_TASK_WINDOW
+    )
+    window_id = uuid.uuid4().hex
+    state = dict(
+        (get_window_key('task{0}'.format(i), window_id), _task)
+        for i, _task in enumerate(tasks)
+    )
+    state[get_window_key('total', window_id)] = len(tasks)
+    state[get_window_key('callback', window_id)] = callback
+    state[get_window_key('next', window_id)] = min(window, len(tasks))
+    state[get_window_key('done', window_id)] = 0
+    state[get_window_key('failed', window_id)] = 0
+    cache.set_many(state, WINDOW_CACHE_TIMEOUT)
+
+    for _task in tasks[:window]:
+        _queue_windowed(_task, window_id)
+
+
+def _queue_windowed(_task, window_id):
+    """Queue a task of a windowed dispatch, to advance the window after."""
+    _task.apply_async(
+        link=_advance_window.subtask((window_id,)),
+        link_error=_fail_window_task.subtask((window_id,))
+    )
+
+
+@task
+def _advance_window(result, window_id):
+    """Queue the next task of a windowed dispatch, or its callback."""
+    _settle_window_task(window_id)
+
+
+@task
+def _fail_window_task(task_id, window_id):
+    """Count a failed task of a windowed dispatch, and queue the next."""
+    logger.error('task %s of window %s failed', task_id, window_id)
+    _settle_window_task(window_id, failed=True)
+
+
+def _settle_window_task(window_id, failed=False):
+    total = cache.get(get_window_key('total', window_id))
+    if total is None:
+        # Expired, or cleaned up already.
+        return
+
+    try:
+        index = cache.incr(get_window_key('next', window_id)) - 1
+        if failed:
+            cache.incr(get_window_key('failed', window_id))
+        # Only the last task to finish sees the full count.
+        done = cache.incr(get_window_key('done', window_id))
+    except ValueError:
+        # Some of the window's keys were evicted; its other tasks can't be
+        # found anymore either.
+        logger.error('window %s expired before it finished', window_id)
+        return
+
+    if index < total:
+        _task = cache.get(get_window_key('task{0}'.format(index), window_id))
+        if _task is None:
+            logger.error('window %s lost task %s', window_id, index)
+        else:
+            _queue_windowed(_task, window_id)
+
+    if done == total:
+        callback = cache.get(get_window_key('callback', window_id))
+        num_failed = cache.get(get_window_key('failed', window_id))
+        cache.delete_many(
+            [get_window_key('task{0}'.format(i), window_id)
+             for i in range(total)] +
+            [get_window_key(name, window_id)
+             for name in ('total', 'callback', 'next', 'done', 'failed')]
+        )
+        if num_failed:
+            logger.error(
+                '%s of %s tasks of window %s failed, not calling %s',
+                num_failed, total, window_id, callback['task']
+            )
+            return
+        callback.delay(None)
+
+
 @task
 def finish_import_record(import_record_pk):
     """Set all statuses to Done, etc."""
@@ -409,25 +606,20 @@ def filter_concat_configs(mappings):
     return mappings, concats
 
 
-@task
-def map_row_chunk(
-    chunk, file_pk, source_type, prog_key, increment, *args, **kwargs
-):
-    """Does the work of matching a mapping to a source type and saving
+def get_mapping_plan(import_file, source_type):
+    """Resolve how rows of ``import_file`` get mapped, once per import.
 
-    :param chunk: list of dict of str. One row's worth of parse data.
-    :param file_pk: int, the PK for an ImportFile obj.
-    :param source_type: int, represented by either ASSESSED_RAW, or
-        PORTFOLIO_RAW.
-    :param cleaner: (optional), the cleaner class you want to send
-    to mapper.map_row. (e.g. turn numbers into floats.).
-    :param raw_ids: (optional kwarg), the list of ids in chunk order.
+    :param import_file: ImportFile inst.
+    :param source_type: int, ASSESSED_RAW or PORTFOLIO_RAW.
+    :rtype: dict, plain data so it can travel with chunk tasks.
+
+    The org's column mappings are read here rather than in each chunk, so
+    every chunk maps with the same version of them. ``version`` changes
+    whenever the mapping does.
 
     """
-    import_file = ImportFile.objects.get(pk=file_pk)
     save_type = PORTFOLIO_BS
     mapping = espm_mapping.MAP
-    map_cleaner = PORTFOLIO_CLEANER
 
     # Default to PM so we don't unnecessarily query for mapping
     if source_type == ASSESSED_RAW:
@@ -436,12 +628,66 @@ def map_row_chunk(
         )[0]
         mapping = get_column_mappings(org)
         save_type = ASSESSED_BS
-        map_cleaner = ASSESSED_CLEANER
 
     # Pull out any columns meant to be concatenated together.
-    mapping, concats = filter_concat_configs(mapping)
+    mapping, concats = filter_concat_configs(dict(mapping))
+    version = hashlib.sha1(json.dumps(
+        [save_type, sorted(mapping.items()), concats], sort_keys=True
+    )).hexdigest()
+
+    return {
+        'file_pk': import_file.pk,
+        'super_org_pk': import_file.import_record.super_organization_id,
+        'save_type': save_type,
+        'mapping': mapping,
+        'concats': concats,
+        'version': version,
+    }
+
+
+def compile_mapping_plan(plan):
+    """Return (mapping, concats, save type, cleaner, date converters).
+
+    The last few compiled plans are kept per worker process, so only the
+    first chunk of an import a worker sees pays for it. Their cleaner
+    remembers the values it has cleaned, and their date converters the
+    format of each date field, across all the import's chunks the worker
+    maps.
 
-    for row in chunk:
+    """
+    key = (plan['file_pk'], plan['version'])
+    try:
+        compiled = _compiled_plans.pop(key)
+    except KeyError:
+        compiled = (
+            plan['mapping'],
+            plan['concats'],
+            plan['save_type'],
+            MemoizedCleaner(MAPPING_CLEANERS[plan['save_type']]),
+            get_date_converters(),
+        )
+        if len(_compiled_plans) >= COMPILED_PLANS_SIZE:
+            _compiled_plans.popitem(last=False)
+    _compiled_plans[key] = compiled
+
+    return compiled
+
+
+def map_rows(rows, plan, *args, **kwargs):
+    """Map raw rows and save the mapped BuildingSnapshots.
+
+    :param rows: list of dict, raw rows as stored in ``extra_data``.
+    :param plan: dict, from ``get_mapping_plan``.
+
+    Extra args are handed on to ``mapper.map_row``. The snapshots are
+    cleaned and inserted together, in batches.
+
+    """
+    (
+        mapping, concats, save_type, map_cleaner, date_converters
+    ) = compile_mapping_plan(plan)
+    snapshots = []
+    for row in rows:
         model = mapper.map_row(
             row,
             mapping,
@@ -452,12 +698,92 @@ def map_row_chunk(
             **kwargs
         )
 
-        model.import_file = import_file
+        model.import_file_id = plan['file_pk']
         model.source_type = save_type
-        model.clean()
-        model.super_organization = import_file.import_record.super_organization
-        model.save()
+        model.row_fingerprint = row_fingerprint(row)
+        model.super_organization_id = plan['super_org_pk']
+        snapshots.append(model)
+
+    BuildingSnapshot.objects.bulk_create(
+        clean_snapshots(snapshots, date_converters),
+        batch_size=INSERT_BATCH_SIZE
+    )
+
+
+def can_map_on_save(import_file, plan):
+    """Whether rows of ``import_file`` can be mapped as they're saved.
+
+    PM files always map with the ESPM mapping; other files need the org's
+    column mappings to have been saved already.
 
+    """
+    if get_source_type(import_file) != ASSESSED_RAW:
+        return True
+
+    return bool(plan['mapping'])
+
+
+def get_rows_to_map(file_pk, source_type):
+    """The raw snapshots of an import that mapping works through.
+
+    Rows flagged as unchanged since an earlier import are already merged,
+    and left out.
+
+    """
+    return BuildingSnapshot.objects.filter(
+        import_file=file_pk,
+        source_type=source_type,
+        duplicate_of=None,
+    )
+
+
+@task
+def map_row_chunk(
+    first_pk, last_pk, file_pk, source_type, prog_key, increment, *args,
+    **kwargs
+):
+    """Does the work of matching a mapping to a source type and saving
+
+    :param first_pk: int, PK of the chunk's first raw BuildingSnapshot.
+    :param last_pk: int, PK of its last. The chunk is the file's raw
+        snapshots of ``source_type`` in between, see ``_map_data``.
+    :param file_pk: int, the PK for an ImportFile obj.
+    :param source_type: int, represented by either ASSESSED_RAW, or
+        PORTFOLIO_RAW.
+    :param cleaner: (optional), the cleaner class you want to send
+    to mapper.map_row. (e.g. turn numbers into floats.).
+    :param plan: (optional kwarg), dict, from ``get_mapping_plan``. Looked
+        up here if it isn't passed.
+    :param chunk_index: (optional kwarg), int, checkpoint the chunk under
+        this index, see ``skip_done_chunks``.
+
+    """
+    start = time.time()
+    chunk_index = kwargs.pop('chunk_index', None)
+    plan = kwargs.pop('plan', None)
+    if is_chunk_done(file_pk, MAPPING, chunk_index):
+        increment_cache(prog_key, increment)
+        return
+
+    if plan is None:
+        plan = get_mapping_plan(
+            ImportFile.objects.get(pk=file_pk), source_type
+        )
+    chunk = [
+        obj.extra_data for obj in get_rows_to_map(file_pk, source_type).filter(
+            pk__gte=first_pk, pk__lte=last_pk
+        ).order_by('pk').only('extra_data')
+    ]
+    try:
+        with transaction.atomic():
+            map_rows(chunk, plan, *args, **kwargs)
+            save_checkpoint(file_pk, MAPPING, chunk_index, len(chunk))
+    except IntegrityError:
+        # Another attempt at this chunk won the race and committed first.
+        if not is_chunk_done(file_pk, MAPPING, chunk_index):
+            raise
+
+    record_chunk(MAPPING, file_pk, len(chunk), time.time() - start)
     increment_cache(prog_key, increment)
 
 
@@ -468,6 +794,8 @@ def _map_data(file_pk, *args, **kwargs):
     @lock_and_track returns a progress_key
 
     :param file_pk: int, the id of the import_file we're working with.
+    :param resume: (optional kwarg), bool, only map the chunks an earlier,
+        unfinished attempt didn't commit.
 
     """
     import_file = ImportFile.objects.get(pk=file_pk)
@@ -480,7 +808,12 @@ def _map_data(file_pk, *args, **kwargs):
     # If we haven't finished saving, we shouldn't proceed with mapping
     # Re-queue this task.
     if not import_file.raw_save_done:
-        map_data.apply_async(args=[file_pk], countdown=60, expires=120)
+        map_data.apply_async(
+            args=[file_pk],
+            kwargs={'resume': kwargs.get('resume')},
+            countdown=60,
+            expires=120
+        )
         return {'status': 'error', 'message': 'waiting for raw data save.'}
 
     source_type_dict = {
@@ -489,24 +822,40 @@ def _map_data(file_pk, *args, **kwargs):
     }
     source_type = source_type_dict.get(import_file.source_type, ASSESSED_RAW)
 
-    qs = BuildingSnapshot.objects.filter(
-        import_file=import_file,
-        source_type=source_type,
-    ).iterator()
+    resume = bool(kwargs.get('resume')) and import_file.mapping_chunk_size
+    if resume:
+        # Same chunks as the first attempt, so the checkpoints line up.
+        chunk_size = import_file.mapping_chunk_size
+    else:
+        chunk_size = plan_chunk_size(
+            num_columns=import_file.num_columns,
+            rows_per_second=get_history_throughput(
+                MAPPING, import_file.source_type
+            ),
+        )
+        import_file.mapping_chunk_size = chunk_size
 
     prog_key = get_prog_key('map_data', file_pk)
+    if resume and import_file.mapping_plan:
+        plan = json.loads(import_file.mapping_plan)
+    else:
+        plan = get_mapping_plan(import_file, source_type)
+        import_file.mapping_plan = json.dumps(plan)
+        import_file.save()
+    # Only the bounds of each chunk go through the broker; the chunk
+    # tasks read their own rows.
     tasks = []
-    for chunk in batch(qs, 100):
-        serialized_data = [obj.extra_data for obj in chunk]
+    for first_pk, last_pk, num_rows in pk_ranges(
+        get_rows_to_map(file_pk, source_type), chunk_size
+    ):
         tasks.append(map_row_chunk.subtask(
-            (serialized_data, file_pk, source_type, prog_key)
+            (first_pk, last_pk, file_pk, source_type, prog_key),
+            {'plan': plan}
         ))
 
     tasks = add_cache_increment_parameter(tasks)
-    if tasks:
-        chord(tasks, interval=15)(finish_mapping.subtask([file_pk]))
-    else:
-        finish_mapping.task(file_pk)
+    tasks = skip_done_chunks(tasks, file_pk, MAPPING, prog_key, resume)
+    dispatch_windowed(tasks, finish_mapping.subtask([file_pk]))
 
     return {'status': 'success'}
 
@@ -520,44 +869,98 @@ def map_data(file_pk, *args, **kwargs):
 
 
 @task
-def _save_raw_data_chunk(chunk, file_pk, prog_key, increment, *args, **kwargs):
-    """Save the raw data to the database."""
+def _save_raw_data_chunk(file_pk, start, end, prog_key, increment, *args,
+                         **kwargs):
+    """Parse and save the rows in one byte range of the file.
+
+    :param start: int, offset of the first row in the range.
+    :param end: int, offset just past the last row in the range, both in
+        the CSV of ``ImportFile.csv_file``, decompressed if it's
+        compressed.
+    :param raw_save_mode: (optional kwarg), one of ``ingest.RAW_SAVE_MODES``.
+    :param map_on_save: (optional kwarg), bool, also map and save the rows.
+    :param plan: (optional kwarg), dict, the mapping plan to map them with,
+        from ``get_mapping_plan``.
+    :param chunk_index: (optional kwarg), int, checkpoint the chunk under
+        this index, see ``skip_done_chunks``.
+
+    """
+    started = time.time()
+    chunk_index = kwargs.get('chunk_index')
+    if is_chunk_done(file_pk, RAW_SAVE, chunk_index):
+        increment_cache(prog_key, increment)
+        return
+
     import_file = ImportFile.objects.get(pk=file_pk)
+    csvfile = open_csv_slice(import_file.csv_file, start, end)
+    parser = reader.MCMParser(csvfile)
+    # Same as ``_save_raw_data``, the parser hands back the header row
+    # after a rewind.
+    csvfile.seek(0)
+    rows = parser.next()
+    rows.next()  # skip header row
+    chunk = list(rows)
+
     # Save our "column headers" and sample rows for F/E.
     source_type = get_source_type(import_file)
-    for c in chunk:
-        raw_bs = BuildingSnapshot()
-        raw_bs.import_file = import_file
-        raw_bs.extra_data = c
-        raw_bs.source_type = source_type
-
-        # We require a save to get our PK
-        # We save here to set our initial source PKs.
-        raw_bs.save()
-        super_org = import_file.import_record.super_organization
-        raw_bs.super_organization = super_org
-
-        set_initial_sources(raw_bs)
-        raw_bs.save()
+    super_org = import_file.import_record.super_organization
+    mapped = None
+    try:
+        with transaction.atomic():
+            pks = save_raw_data_rows(
+                chunk,
+                import_file,
+                source_type,
+                super_org,
+                mode=kwargs.get('raw_save_mode')
+            )
+            unchanged = set()
+            if skip_unchanged_rows():
+                unchanged = flag_unchanged_rows(
+                    pks, chunk, import_file, source_type, super_org
+                )
+            if kwargs.get('map_on_save'):
+                mapping_started = time.time()
+                mapped = [
+                    r for pk, r in zip(pks, chunk) if pk not in unchanged
+                ]
+                map_rows(mapped, kwargs['plan'])
+                mapping_time = time.time() - mapping_started
+            save_checkpoint(file_pk, RAW_SAVE, chunk_index, len(chunk))
+    except IntegrityError:
+        # Another attempt at this chunk won the race and committed first.
+        if not is_chunk_done(file_pk, RAW_SAVE, chunk_index):
+            raise
+        mapped = None
+    record_chunk(RAW_SAVE, file_pk, len(chunk), time.time() - started)
+    if mapped:
+        # Sizes later mapping chunks, as the ones ``map_data`` runs do.
+        record_chunk(MAPPING, file_pk, len(mapped), mapping_time)
 
     # Indicate progress
     increment_cache(prog_key, increment)
 
 
 @task
-def finish_raw_save(results, file_pk):
+def finish_raw_save(results, file_pk, mapped=False):
     import_file = ImportFile.objects.get(pk=file_pk)
     import_file.raw_save_done = True
+    import_file.raw_save_rows_per_second = pop_throughput(RAW_SAVE, file_pk)
     import_file.save()
+    import_file.cleanup_local_file()
     prog_key = get_prog_key('save_raw_data', file_pk)
     cache.set(prog_key, 100)
+    if mapped:
+        finish_mapping(results, file_pk)
 
 
 @task
 def finish_mapping(results, file_pk):
     import_file = ImportFile.objects.get(pk=file_pk)
     import_file.mapping_done = True
+    import_file.mapping_rows_per_second = pop_throughput(MAPPING, file_pk)
     import_file.save()
+    import_file.cleanup_local_file()
     finish_import_record(import_file.import_record.pk)
     prog_key = get_prog_key('map_data', file_pk)
     cache.set(prog_key, 100)
@@ -598,32 +1001,90 @@ def cache_first_rows(import_record, parser):
 @task
 @lock_and_track
 def _save_raw_data(file_pk, *args, **kwargs):
-    """Chunk up the CSV and save data into the DB raw."""
+    """Chunk up the CSV and save data into the DB raw.
+
+    :param raw_save_mode: (optional kwarg), one of ``ingest.RAW_SAVE_MODES``,
+        defaults to ``settings.RAW_SAVE_MODE``.
+    :param map_on_save: (optional kwarg), bool, map rows as they're saved
+        instead of in a separate ``map_data`` pass. Ignored unless the org's
+        column mappings have been saved already.
+    :param resume: (optional kwarg), bool, only save the chunks an earlier,
+        unfinished attempt didn't commit. Whether rows are mapped as they're
+        saved is kept from that attempt.
+
+    """
     import_file = ImportFile.objects.get(pk=file_pk)
     if import_file.raw_save_done:
         return {'status': 'warning', 'message': 'raw data already saved'}
-    parser = reader.MCMParser(import_file.local_file)
+    raw_save_mode = get_raw_save_mode(kwargs.get('raw_save_mode'))
+    resume = bool(kwargs.get('resume')) and import_file.raw_save_chunk_size
+    plan = None
+    if resume:
+        map_on_save = BuildingSnapshot.objects.filter(
+            import_file=import_file,
+            source_type__in=(ASSESSED_BS, PORTFOLIO_BS),
+        ).exists()
+    else:
+        map_on_save = bool(kwargs.get('map_on_save'))
+    if map_on_save and resume and import_file.mapping_plan:
+        plan = json.loads(import_file.mapping_plan)
+    elif map_on_save:
+        plan = get_mapping_plan(import_file, get_source_type(import_file))
+        map_on_save = can_map_on_save(import_file, plan)
+        import_file.mapping_plan = json.dumps(plan) if map_on_save else None
+    stream = import_file.open_stream()
+    parser = reader.MCMParser(stream)
     cache_first_rows(import_file, parser)
-    import_file.save()
-    import_file.num_rows = 0
+    import_file.num_columns = len(parser.csvreader.unicode_fieldnames)
+    stream.close()
 
     prog_key = get_prog_key('save_raw_data', file_pk)
-    rows = parser.next()
-    rows.next()  # skip header row
-
+    if resume:
+        # Same chunks as the first attempt, so the checkpoints line up.
+        chunk_size = import_file.raw_save_chunk_size
+    else:
+        with import_file.open_stream() as stream:
+            avg_row_bytes = sample_row_bytes(stream)
+        chunk_size = plan_chunk_size(
+            num_columns=import_file.num_columns,
+            avg_row_bytes=avg_row_bytes,
+            rows_per_second=get_history_throughput(
+                RAW_SAVE, import_file.source_type
+            ),
+        )
+    import_file.raw_save_chunk_size = chunk_size
+    if map_on_save:
+        import_file.mapping_chunk_size = chunk_size
+
+    options = {
+        'raw_save_mode': raw_save_mode,
+        'map_on_save': map_on_save,
+        'plan': plan,
+    }
+    import_file.num_rows = 0
     tasks = []
-    for chunk in batch(rows, 100):
-        import_file.num_rows += len(chunk)
-        tasks.append(_save_raw_data_chunk.subtask((chunk, file_pk, prog_key)))
+    # Workbooks can't be read in byte ranges, so they're written out as
+    # CSV in storage once, up front. Compressed files are decompressed by
+    # each worker up to its own range.
+    import_file.stage_csv()
+    # Done with the workbook; chunks, on whichever host, read the CSV.
+    import_file.remove_local_copy()
+    # Workers parse their own slice of the file; only the row boundaries
+    # go through the broker.
+    ranges = scan_row_ranges(import_file.csv_file, chunk_size)[1]
+    for start, end, num_rows in ranges:
+        import_file.num_rows += num_rows
+        tasks.append(_save_raw_data_chunk.subtask(
+            (file_pk, start, end, prog_key), options
+        ))
 
     tasks = add_cache_increment_parameter(tasks)
-    import_file.num_columns = len(parser.csvreader.unicode_fieldnames)
+    tasks = skip_done_chunks(tasks, file_pk, RAW_SAVE, prog_key, resume)
     import_file.save()
 
-    if tasks:
-        chord(tasks, interval=15)(finish_raw_save.subtask([file_pk]))
-    else:
-        finish_raw_save.task(file_pk)
+    dispatch_windowed(
+        tasks, finish_raw_save.subtask([file_pk], {'mapped': map_on_save})
+    )
 
     return {'status': 'success'}
 
@@ -635,36 +1096,13 @@ def save_raw_data(file_pk, *args, **kwargs):
     return {'status': 'success'}
 
 
-def _stringify(values):
-    """Take iterable of str and NoneTypes and reduce to space sep. str."""
-    return ' '.join(
-        [PUNCT_REGEX.sub('', value.lower()) for value in values if value]
-    )
-
-
-def handle_results(results, b_idx, can_rev_idx, unmatched_list):
-    """Seek IDs and save our snapshot match.
-
-    :param results: list of tuples. [('match', 0.99999),...]
-    :param b_idx: int, the index of the current building in the unmatched_list.
-    :param can_rev_idx: dict, reverse index from match -> canonical PK.
-    :unmatched_list: list of dicts, the result of a values_list query for
-        unmatched BSes.
-
-    """
-    match_string, confidence = results[0]  # We always care about closest match
-    match_type = SYSTEM_MATCH
+def get_match_type(confidence):
+    """Whether a match is good enough to be a system match."""
     # If we passed the minimum threshold, we're here, but we need to
     # distinguish probable matches from good matches.
     if confidence < getattr(settings, 'MATCH_MED_THRESHOLD', 0.7):
-        match_type = POSSIBLE_MATCH
-
-    can_snap_pk = can_rev_idx[match_string]
-    building_pk = unmatched_list[b_idx][0]  # First element is PK
-
-    save_snapshot_match(
-        can_snap_pk, building_pk, confidence=confidence, match_type=match_type
-    )
+        return POSSIBLE_MATCH
+    return SYSTEM_MATCH
 
 
 @task
@@ -700,8 +1138,13 @@ def _finish_matching(import_file, progress_key):
 @task
 @lock_and_track
 def _match_buildings(file_pk):
-    """ngram search against all of the canonical_building snapshots for org."""
-    min_threshold = settings.MATCH_MIN_THRESHOLD
+    """ngram search against all of the canonical_building snapshots for org.
+
+    The unmatched buildings are searched for in shards, by
+    ``match_buildings_shard`` tasks, then ``finish_match_buildings`` saves
+    what they found.
+
+    """
     import_file = ImportFile.objects.get(pk=file_pk)
     prog_key = get_prog_key('match_buildings', file_pk)
     org = Organization.objects.filter(
@@ -715,62 +1158,286 @@ def _match_buildings(file_pk):
         _finish_matching(import_file, prog_key)
         return
 
-    # Here we want all the values not related to the BS id for doing comps.
-    unmatched_ngrams = [
-        _stringify(list(values)[1:]) for values in unmatched_buildings
-    ]
-
-    canonical_buildings = find_canonical_building_values(org)
-    if not canonical_buildings:
+    # E.g. brings the index the shards will load up to date.
+    engine = get_match_engine(org)
+    if not engine.prepare():
         # There are no canonical_buildings for this organization, all unmatched
         # buildings will then become canonicalized.
         hydrated_unmatched_buildings = BuildingSnapshot.objects.filter(
             pk__in=[item[0] for item in unmatched_buildings]
         )
-        num_unmatched = len(unmatched_ngrams) or 1
+        num_unmatched = len(unmatched_buildings) or 1
         increment = 1.0 / num_unmatched * 100
         for (i, unmatched) in enumerate(hydrated_unmatched_buildings):
             initialize_canonical_building(unmatched)
             if i % 100 == 0:
                 increment_cache(prog_key, increment * 100)
 
+        engine.finish()
         _finish_matching(import_file, prog_key)
         return
 
-    # This allows us to retrieve the PK for a given NGram after a match.
-    can_rev_idx = {
-        _stringify(value[1:]): value[0] for value in canonical_buildings
-    }
-    n = ngram.NGram(
-        [_stringify(values[1:]) for values in canonical_buildings]
+    exact_matches, shards = get_match_shards(
+        org, [values[0] for values in unmatched_buildings]
     )
+    run_id = uuid.uuid4().hex
+    # Kept out of the callback's arguments, which sit in the cache and the
+    # broker until the last shard is done.
+    cache.set_many({
+        get_match_key('exact', run_id): exact_matches,
+        get_match_key('shards', run_id): shards,
+    }, MATCH_CACHE_TIMEOUT)
+    # Searching is the first half of the progress bar, saving the second.
+    increment = 50.0 / (len(shards) or 1)
 
-    # For progress tracking
-
-    num_unmatched = len(unmatched_ngrams) or 1
-    increment = 1.0 / num_unmatched * 100
-
-    # PKs when we have a match.
     import_file.mapping_completion = 0
     import_file.save()
-    for i, building in enumerate(unmatched_ngrams):
-        results = n.search(building, min_threshold)
-        if results:
-            handle_results(results, i, can_rev_idx, unmatched_buildings)
+    cache.set(prog_key, 0)
+    tasks = [
+        match_buildings_shard.subtask(
+            (org.pk, run_id, i, shard, prog_key, increment)
+        )
+        for i, shard in enumerate(shards)
+    ]
+    dispatch_windowed(
+        tasks,
+        finish_match_buildings.subtask(
+            (file_pk, org.pk, run_id, prog_key)
+        )
+    )
+
+    return {'status': 'success'}
+
 
+def get_match_shards(org, building_pks):
+    """Split unmatched buildings into those matched exactly and shards.
+
+    :param org: Organization inst.
+    :param building_pks: list of int, unmatched BuildingSnapshot PKs.
+    :rtype: tuple, list of exact matches as ``find_exact_matches`` returns
+        them and list of lists of the other PKs, sorted.
+
+    """
+    building_pks = sorted(building_pks)
+    # Buildings sharing IDs with a canonical building need no searching.
+    exact_matches = find_exact_matches(org, building_pks)
+    exact_pks = set(match[0] for match in exact_matches)
+    building_pks = [pk for pk in building_pks if pk not in exact_pks]
+    shards = [
+        building_pks[i:i + MATCH_SHARD_SIZE]
+        for i in range(0, len(building_pks), MATCH_SHARD_SIZE)
+    ]
+
+    return exact_matches, shards
+
+
+@task
+def match_buildings_shard(
+    org_pk, run_id, shard_index, building_pks, prog_key, increment
+):
+    """Search for one shard's matches, see ``MatchEngine.search``.
+
+    The results wait in the cache for ``finish_match_buildings``. Every
+    shard of a run searches the same canonical buildings: nothing is saved
+    until they have all finished.
+
+    """
+    org = Organization.objects.get(pk=org_pk)
+    stats = {}
+    matches = get_match_engine(org).search(building_pks, stats)
+    cache.set(
+        get_match_key('shard{0}'.format(shard_index), run_id),
+        (matches, stats),
+        MATCH_CACHE_TIMEOUT
+    )
+    increment_cache(prog_key, increment)
+
+
+@task
+def finish_match_buildings(results, file_pk, org_pk, run_id, prog_key):
+    """Save the matches the shards of a run found, and any exact ones.
+
+    Buildings that matched the same canonical snapshot are all merged into
+    it, one after another: best match first, then lowest PK. Each merges
+    into the snapshot the one before it made, so the result doesn't depend
+    on which shard finished first. Buildings that matched nothing get
+    canonical buildings of their own. Buildings matched since the run
+    started are left alone.
+
+    """
+    import_file = ImportFile.objects.get(pk=file_pk)
+    org = Organization.objects.get(pk=org_pk)
+    engine = get_match_engine(org)
+
+    unmatched_pks = set(
+        values[0] for values in find_unmatched_building_values(import_file)
+    )
+    run_keys = [
+        get_match_key('exact', run_id), get_match_key('shards', run_id)
+    ]
+    found = cache.get_many(run_keys)
+    if len(found) == len(run_keys):
+        exact_matches, shards = [found[key] for key in run_keys]
+    else:
+        # Expired from the cache. Nothing has been saved yet, so splitting
+        # the buildings again gives the same shards.
+        exact_matches, shards = get_match_shards(org, unmatched_pks)
+    cache.delete_many(run_keys)
+
+    keys = [
+        get_match_key('shard{0}'.format(i), run_id)
+        for i in range(len(shards))
+    ]
+    found = cache.get_many(keys)
+    matches = list(exact_matches)
+    stats = {'exact': len(exact_matches)}
+    for key, building_pks in zip(keys, shards):
+        if key in found:
+            shard_matches, shard_stats = found[key]
+            for name, value in shard_stats.iteritems():
+                stats[name] = stats.get(name, 0) + value
         else:
-            hydrated_building = BuildingSnapshot.objects.get(
-                pk=unmatched_buildings[i][0]
+            # Expired from the cache. Nothing has been saved yet, so
+            # searching again finds the same matches.
+            shard_matches = engine.search(building_pks, stats)
+        matches.extend(shard_matches)
+    cache.delete_many(keys)
+
+    claims = {}
+    new_canonicals = []
+    for building_pk, snapshot_pk, confidence in matches:
+        if building_pk not in unmatched_pks:
+            continue
+        if snapshot_pk is None:
+            new_canonicals.append(building_pk)
+        else:
+            claims.setdefault(snapshot_pk, []).append(
+                (-confidence, building_pk)
             )
-            initialize_canonical_building(hydrated_building)
 
-        if i % 100 == 0:
+    num_unmatched = len(matches) or 1
+    increment = 1.0 / num_unmatched * 50
+    done = 0
+    merge_batch = []
+    for i, snapshot_pk in enumerate(sorted(claims)):
+        for neg_confidence, building_pk in sorted(claims[snapshot_pk]):
+            confidence = -neg_confidence
+            merge_batch.append((
+                snapshot_pk,
+                building_pk,
+                confidence,
+                get_match_type(confidence)
+            ))
+        if len(merge_batch) >= MERGE_BATCH_SIZE or i == len(claims) - 1:
+            save_snapshot_matches(merge_batch)
+            done += len(merge_batch)
+            increment_cache(prog_key, increment * len(merge_batch))
+            import_file.mapping_completion += int(increment * len(merge_batch))
+            import_file.save()
+            merge_batch = []
+
+    for hydrated_building in BuildingSnapshot.objects.filter(
+        pk__in=new_canonicals
+    ).order_by('pk'):
+        initialize_canonical_building(hydrated_building)
+        done += 1
+        if done % 100 == 0:
             increment_cache(prog_key, increment * 100)
             import_file.mapping_completion += int(increment * 100)
             import_file.save()
 
+    match_stats = dict(engine.finish(), **stats)
+    logger.info('matched import file %s: %s', file_pk, match_stats)
     _finish_matching(import_file, prog_key)
-    return {'status': 'success'}
+    return {'status': 'success', 'match_stats': match_stats}
+
+
+def get_remapped_fields(old_plan, new_plan):
+    """Work out which mapped snapshot fields a change of mapping touches.
+
+    :param old_plan: dict, the plan the rows were mapped with, or None.
+    :param new_plan: dict, the plan they should be mapped with now.
+    :rtype: list of field names, empty if nothing changed, or None if the
+        rows have to be mapped again from scratch.
+
+    """
+    if not old_plan or old_plan['save_type'] != new_plan['save_type']:
+        return None
+    if old_plan['version'] == new_plan['version']:
+        return []
+
+    old_mapping, new_mapping = old_plan['mapping'], new_plan['mapping']
+    targets = set()
+    for column in set(old_mapping) | set(new_mapping):
+        old_target = old_mapping.get(column)
+        new_target = new_mapping.get(column)
+        if old_target != new_target:
+            targets.update(t for t in (old_target, new_target) if t)
+    for concat in old_plan['concats'] + new_plan['concats']:
+        if concat not in old_plan['concats'] or (
+            concat not in new_plan['concats']
+        ):
+            targets.add(concat['target'])
+    if not targets:
+        return []
+
+    # Columns that stop or start being mapped move in or out of
+    # extra_data, as do targets that aren't snapshot fields.
+    field_names = set(f.name for f in BuildingSnapshot._meta.fields)
+    fields = targets & field_names
+    # Cleaning derives the match key from these.
+    if fields & set(BS_VALUES_LIST[1:]):
+        fields.add('match_key')
+    return sorted(fields) + [
+        'extra_data', 'extra_data_sources'
+    ]
+
+
+@task
+def remap_row_chunk(
+    first_pk, last_pk, file_pk, source_type, fields, prog_key, increment,
+    *args, **kwargs
+):
+    """Map a chunk of raw rows again, updating only ``fields`` in place.
+
+    Takes the same arguments as ``map_row_chunk``, along with the names of
+    the fields to update, see ``get_remapped_fields``.
+
+    """
+    plan = kwargs.pop('plan')
+    (
+        mapping, concats, save_type, map_cleaner, date_converters
+    ) = compile_mapping_plan(plan)
+    snapshots = {}
+    for obj in get_rows_to_map(file_pk, source_type).filter(
+        pk__gte=first_pk, pk__lte=last_pk
+    ).only('extra_data'):
+        row = obj.extra_data
+        # Identical rows map to identical snapshots; do each once.
+        fingerprint = row_fingerprint(row)
+        if fingerprint not in snapshots:
+            snapshots[fingerprint] = mapper.map_row(
+                row,
+                mapping,
+                BuildingSnapshot,
+                cleaner=map_cleaner,
+                concat=concats,
+                *args,
+                **kwargs
+            )
+
+    clean_snapshots(snapshots.values(), date_converters)
+    with transaction.atomic():
+        update_mapped_fields(file_pk, save_type, snapshots, fields)
+
+    increment_cache(prog_key, increment)
+
+
+@task
+def finish_remap(results, file_pk):
+    ImportFile.objects.filter(pk=file_pk).update(mapping_done=True)
+    prog_key = get_prog_key('map_data', file_pk)
+    cache.set(prog_key, 100)
 
 
 @task
@@ -781,14 +1448,52 @@ def _remap_data(import_file_pk):
     :param import_file_pk: int, the ImportFile primary key.
     :param mapping_cache_key: str, the cache key for this file's mapping prog.
 
+    When a file was mapped with a stored mapping plan, only the fields
+    whose column mappings changed since are mapped again, and updated in
+    place. Otherwise the mapped buildings are deleted and mapped anew.
+
     """
     # Reset mapping progress cache as well.
     import_file = ImportFile.objects.get(pk=import_file_pk)
-    # Delete buildings already mapped for this file.
-    BuildingSnapshot.objects.filter(
+    source_type = get_source_type(import_file)
+    plan = get_mapping_plan(import_file, source_type)
+    mapped = BuildingSnapshot.objects.filter(
         import_file=import_file,
         source_type__in=(ASSESSED_BS, PORTFOLIO_BS)
-    ).exclude(
+    )
+    fields = None
+    if import_file.mapping_done and not mapped.filter(
+        row_fingerprint=None
+    ).exists():
+        old_plan = json.loads(import_file.mapping_plan or 'null')
+        fields = get_remapped_fields(old_plan, plan)
+
+    if fields is not None:
+        import_file.mapping_plan = json.dumps(plan)
+        # Not to be matched until every chunk has been remapped.
+        import_file.mapping_done = False
+        import_file.mapping_completion = None
+        import_file.save()
+
+        prog_key = get_prog_key('map_data', import_file_pk)
+        tasks = []
+        if fields:
+            for first_pk, last_pk, num_rows in pk_ranges(
+                get_rows_to_map(import_file_pk, source_type),
+                import_file.mapping_chunk_size or plan_chunk_size()
+            ):
+                tasks.append(remap_row_chunk.subtask(
+                    (first_pk, last_pk, import_file_pk, source_type, fields,
+                     prog_key),
+                    {'plan': plan}
+                ))
+        tasks = add_cache_increment_parameter(tasks)
+        dispatch_windowed(tasks, finish_remap.subtask([import_file_pk]))
+
+        return {'status': 'success'}
+
+    # Delete buildings already mapped for this file.
+    mapped.exclude(
         children__isnull=False
     ).delete()
 
@@ -801,7 +1506,7 @@ def _remap_data(import_file_pk):
 
 @task
 def remap_data(import_file_pk):
-    """"Delete mapped buildings for current import file, re-map them."""
+    """"Re-map the current import file's buildings, see ``_remap_data``."""
     import_file = ImportFile.objects.get(pk=import_file_pk)
     # Check to ensure that the building has not already been merged.
     mapping_cache_key = get_prog_key('map_data', import_file.pk)
@@ -834,10 +1539,12 @@ def delete_organization_buildings(org_pk, *args, **kwargs):
 
 @task
 @lock_and_track
-def _delete_organization_buildings(org_pk, chunk_size=100, *args, **kwargs):
+def _delete_organization_buildings(org_pk, chunk_size=None, *args, **kwargs):
     """Deletes all BuildingSnapshot instances within an organization
 
     :param org_pk: int, str, the organization pk
+    :param chunk_size: (optional) int, number of snapshots to delete per
+        task, planned from past deletes by default.
     """
     qs = BuildingSnapshot.objects.filter(super_organization=org_pk)
     ids = qs.values_list('id', flat=True)
@@ -855,6 +1562,9 @@ def _delete_organization_buildings(org_pk, chunk_size=100, *args, **kwargs):
     ).values_list('id', flat=True)
     _delete_canonical_buildings.delay(can_ids)
 
+    chunk_size = chunk_size or plan_chunk_size(
+        rows_per_second=get_history_throughput(DELETE)
+    )
     step = float(chunk_size) / len(ids)
     cache.set(deleting_cache_key, 0)
     tasks = []
@@ -865,31 +1575,46 @@ def _delete_organization_buildings(org_pk, chunk_size=100, *args, **kwargs):
                 (del_ids, deleting_cache_key, step, org_pk)
             )
         )
-    chord(tasks, interval=15)(finish_delete.subtask([org_pk]))
+    dispatch_windowed(tasks, finish_delete.subtask([org_pk]))
 
 
 @task
 def _delete_organization_buildings_chunk(del_ids, prog_key, increment,
                                          org_pk, *args, **kwargs):
     """deletes a list of ``del_ids`` and increments the cache"""
+    start = time.time()
     qs = BuildingSnapshot.objects.filter(super_organization=org_pk)
     qs.filter(pk__in=del_ids).delete()
+    record_chunk(DELETE, org_pk, len(del_ids), time.time() - start)
     increment_cache(prog_key, increment * 100)
 
 
 @task
 def finish_delete(results, org_pk):
+    save_history_throughput(DELETE, pop_throughput(DELETE, org_pk))
     prog_key = get_prog_key('delete_organization_buildings', org_pk)
     cache.set(prog_key, 100)
 
 
 @task
-def _delete_canonical_buildings(ids, chunk_size=300):
+def _delete_canonical_buildings(ids, chunk_size=None):
     """deletes CanonicalBuildings
 
     :param ids: list of ids to delete from CanonicalBuilding
     :param chunk_size: number of CanonicalBuilding instances to delete per
-    iteration
+    iteration, planned from past deletes by default.
     """
+    chunk_size = chunk_size or plan_chunk_size(
+        rows_per_second=get_history_throughput(DELETE_CANONICAL)
+    )
+    start = time.time()
+    num_deleted = 0
     for del_ids in batch(ids, chunk_size):
         CanonicalBuilding.objects.filter(pk__in=del_ids).delete()
+        num_deleted += len(del_ids)
+
+    if num_deleted:
+        save_history_throughput(
+            DELETE_CANONICAL,
+            num_deleted / max(time.time() - start, 0.001)
+        )
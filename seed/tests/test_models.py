@@ -2,6 +2,7 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+import time
 from datetime import datetime
 
 from django.test import TestCase
@@ -13,6 +14,8 @@ from landing.models import SEEDUser as User
 from seed import models as seed_models
 from seed.mappings import mapper
 from seed.tests import util
+from seed.utils.time import convert_datestr
+from seed.utils.merging import save_snapshot_matches
 
 
 class TestBuildingSnapshot(TestCase):
@@ -107,6 +110,67 @@ class TestBuildingSnapshot(TestCase):
             bs_model.generation_date, expected_value
         )
 
+    def test_clean_snapshots(self):
+        """Batch cleaning matches cleaning each snapshot."""
+        snapshots = [seed_models.BuildingSnapshot() for i in range(3)]
+        for snapshot, date_str in zip(
+            snapshots, [u'12/31/2013', u'12/31/2013', u'not a date']
+        ):
+            snapshot.year_ending = date_str
+            snapshot.custom_id_1 = u'x' * 200
+
+        seed_models.clean_snapshots(snapshots)
+
+        expected_value = datetime(year=2013, month=12, day=31)
+        for snapshot in snapshots[:2]:
+            self._test_year_month_day_equal(
+                snapshot.year_ending, expected_value
+            )
+        self.assertEqual(snapshots[2].year_ending, None)
+        self.assertEqual(
+            [len(snapshot.custom_id_1) for snapshot in snapshots],
+            [128, 128, 128]
+        )
+
+    def test_clean_snapshots_by_column(self):
+        """Each distinct date of a column is parsed once per batch."""
+        dates = [u'12/31/2013', u'2014-03-04', u'Dec 5, 2012']
+        snapshots = [seed_models.BuildingSnapshot() for i in range(3000)]
+        for i, snapshot in enumerate(snapshots):
+            snapshot.year_ending = dates[i % len(dates)]
+        calls = []
+
+        def convert_date(value):
+            calls.append(value)
+            return convert_datestr(value)
+
+        started = time.time()
+        seed_models.clean_snapshots(snapshots, {'year_ending': convert_date})
+        batch_time = time.time() - started
+
+        self.assertEqual(sorted(calls), sorted(dates))
+        self.assertEqual(
+            [snapshot.year_ending for snapshot in snapshots[:3]],
+            [convert_datestr(value) for value in dates]
+        )
+
+        # Against parsing every cell, as cleaning used to.
+        started = time.time()
+        for i in range(len(snapshots)):
+            convert_datestr(dates[i % len(dates)])
+        cell_time = time.time() - started
+        self.assertLess(batch_time * 2, cell_time)
+
+    def test_clean_match_key(self):
+        """Cleaning stores the normalized string matching compares."""
+        bs_model = seed_models.BuildingSnapshot()
+        bs_model.tax_lot_id = u'12-34'
+        bs_model.address_line_1 = u'555 Database Ln.'
+
+        bs_model.clean()
+
+        self.assertEqual(bs_model.match_key, u'1234 555 database ln')
+
     def test_source_attributions(self):
         """Test that we can point back to an attribute's source.
 
@@ -190,6 +254,32 @@ class TestBuildingSnapshot(TestCase):
             (u'custom_id_1', 1.0)
         )
 
+    def test_get_column_mapping_index(self):
+        """The index answers as ``get_column_mapping`` does."""
+        org1 = Organization.objects.create()
+        org2 = Organization.objects.create()
+        seed_models.ColumnMapping.objects.create(
+            super_organization=org2,
+            source_type=seed_models.ASSESSED_RAW,
+            column_raw=u'Some Weird City ID',
+            column_mapped=u'custom_id_1'
+        )
+        seed_models.ColumnMapping.objects.create(
+            super_organization=org2,
+            source_type=seed_models.ASSESSED_RAW,
+            column_raw=u'Ignored',
+        )
+
+        with self.assertNumQueries(1):
+            index = seed_models.get_column_mapping_index(org2)
+        for column_raw in (u'Some Weird City ID', u'Ignored', u'random'):
+            self.assertEqual(
+                seed_models.get_indexed_column_mapping(column_raw, index),
+                seed_models.get_column_mapping(column_raw, org2)
+            )
+
+        self.assertEqual(seed_models.get_column_mapping_index(org1), {})
+
     def test_get_column_mappings(self):
         """We produce appropriate data structure for mapping"""
         expected = dict(sorted([
@@ -254,6 +344,60 @@ class TestBuildingSnapshot(TestCase):
         refreshed_bs2_canon = refreshed_bs2.canonical_building
         self.assertFalse(refreshed_bs2_canon.active)
 
+    def test_save_snapshot_matches(self):
+        """Matches saved in a batch chain on their canonical snapshot."""
+        bs3 = util.make_fake_snapshot(
+            self.import_file2,
+            {'property_name': 'Another Place', 'tax_lot_id': '435/422'},
+            bs_type=seed_models.PORTFOLIO_BS
+        )
+        canon = self.bs1.canonical_building
+
+        first_pk, second_pk = save_snapshot_matches([
+            (self.bs1.pk, self.bs2.pk, 0.9, seed_models.SYSTEM_MATCH),
+            (self.bs1.pk, bs3.pk, 0.5, seed_models.POSSIBLE_MATCH),
+        ], user=self.fake_user)
+
+        first = seed_models.BuildingSnapshot.objects.get(pk=first_pk)
+        second = seed_models.BuildingSnapshot.objects.get(pk=second_pk)
+        self.assertEqual(
+            sorted(p.pk for p in first.parents.all()),
+            sorted([self.bs1.pk, self.bs2.pk])
+        )
+        self.assertEqual(
+            sorted(p.pk for p in second.parents.all()),
+            sorted([first.pk, bs3.pk])
+        )
+        self.assertEqual(first.source_type, seed_models.COMPOSITE_BS)
+        self.assertEqual(second.match_type, seed_models.POSSIBLE_MATCH)
+        self.assertEqual(second.confidence, 0.5)
+        self.assertEqual(second.last_modified_by, self.fake_user)
+
+        # The batch links the same way saving one match at a time does.
+        self.assertEqual(first.property_name, self.bs1.property_name)
+        self.assertEqual(first.property_name_source, self.bs1)
+        self.assertEqual(second.property_name_source, first)
+        self.assertEqual(second.match_key, first.match_key)
+        self.assertEqual(
+            [m.pk for m in second.meters.all()], [self.meter.pk]
+        )
+        canon = seed_models.CanonicalBuilding.objects.get(pk=canon.pk)
+        self.assertTrue(canon.active)
+        self.assertEqual(canon.canonical_snapshot, second)
+        self.assertEqual(first.canonical_building, canon)
+        self.assertEqual(second.canonical_building, canon)
+
+        variant = first.variants.get(field_name='property_name')
+        self.assertEqual(
+            sorted(o.value for o in variant.options.all()),
+            ['A Place', 'Greenfield Complex']
+        )
+        # Options already saved from the same source aren't added again.
+        variant = second.variants.get(field_name='property_name')
+        self.assertEqual(
+            [o.value for o in variant.options.all()], ['Another Place']
+        )
+
     def test_merge_extra_data_no_data(self):
         """Test edgecase where there is no extra_data to merge."""
         test_extra, test_sources = mapper.merge_extra_data(self.bs1, self.bs2)
@@ -2,15 +2,29 @@
 :copyright: (c) 2014 Building Energy Inc
 :license: see LICENSE for more details.
 """
+import csv
+import gzip
+import json
+import os
+import tempfile
+from cStringIO import StringIO
 from dateutil import parser
 from os import path
 
 from mock import patch
+import xlwt
 
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.files import File
+from django.core.files.base import ContentFile
 
-from data_importer.models import ImportFile, ImportRecord
+from data_importer.models import ImportChunk, ImportFile, ImportRecord
+from data_importer.streams import (
+    GZIP, StorageStream, open_csv_slice, scan_row_ranges
+)
 from landing.models import SEEDUser as User
 from superperms.orgs.models import Organization, OrganizationUser
 from seed.models import (
@@ -24,8 +38,13 @@ from seed.models import (
     CanonicalBuilding,
     ColumnMapping,
     get_ancestors,
+    get_sourced_attributes,
 )
 from seed import tasks
+from seed.decorators import get_window_key
+from seed.utils import chunking, match_index
+from seed.utils.cleaning import MemoizedCleaner
+from seed.utils.ingest import copy_raw_rows, row_fingerprint, save_raw_rows
 from seed.tests import util
 
 
@@ -130,6 +149,254 @@ class TestTasks(TestCase):
                     (k, expected_pk, raw_bldg.extra_data_sources.get(k))
             )
 
+    def test_save_raw_data_records_chunking(self):
+        """The planned chunk size and chunk throughput end up on the file."""
+        tasks._save_raw_data(self.import_file.pk)
+
+        import_file = ImportFile.objects.get(pk=self.import_file.pk)
+        self.assertTrue(import_file.raw_save_done)
+        self.assertGreaterEqual(
+            import_file.raw_save_chunk_size, chunking.MIN_CHUNK_SIZE
+        )
+        self.assertGreater(import_file.raw_save_rows_per_second, 0)
+        self.assertEqual(
+            BuildingSnapshot.objects.filter(import_file=import_file).count(),
+            512
+        )
+
+    def test_plan_chunk_size(self):
+        """Wide rows and slow chunks get smaller chunks."""
+        self.assertEqual(
+            chunking.plan_chunk_size(), chunking.DEFAULT_CHUNK_SIZE
+        )
+        narrow = chunking.plan_chunk_size(num_columns=20, avg_row_bytes=300)
+        wide = chunking.plan_chunk_size(num_columns=400, avg_row_bytes=6000)
+        self.assertGreater(narrow, wide)
+        self.assertEqual(
+            chunking.plan_chunk_size(num_columns=20, rows_per_second=5), 50
+        )
+        self.assertEqual(
+            chunking.plan_chunk_size(num_columns=100000),
+            chunking.MIN_CHUNK_SIZE
+        )
+
+    def test_save_raw_data_gzip(self):
+        """Gzipped uploads are decompressed as they're parsed."""
+        sample = path.join(
+            path.dirname(__file__), 'data', 'portfolio-manager-sample.csv'
+        )
+        data = StringIO()
+        with gzip.GzipFile(fileobj=data, mode='wb') as gz:
+            gz.write(open(sample, 'rb').read())
+        self.import_file.file.save(
+            'portfolio-manager-sample.csv.gz', ContentFile(data.getvalue())
+        )
+        self.assertEqual(self.import_file.compression, GZIP)
+
+        tasks._save_raw_data(self.import_file.pk)
+
+        raw_saved = BuildingSnapshot.objects.filter(
+            import_file=self.import_file,
+            source_type=PORTFOLIO_RAW
+        )
+        self.assertEqual(raw_saved.count(), 512)
+        self.assertIn(
+            self.fake_extra_data, [b.extra_data for b in raw_saved]
+        )
+        # Workers decompressed their ranges of the upload itself.
+        self.assertFalse(
+            ImportFile.objects.get(pk=self.import_file.pk).staged_file
+        )
+
+    def test_scan_row_ranges_gzip(self):
+        """Ranges of a gzipped CSV are the same as those of the plain one."""
+        header, ranges = scan_row_ranges(self.import_file.file, 100)
+        expected = [
+            open_csv_slice(self.import_file.file, start, end).read()
+            for start, end, num_rows in ranges
+        ]
+        data = StringIO()
+        with gzip.GzipFile(fileobj=data, mode='wb') as gz:
+            gz.write(open(self.import_file.file.path, 'rb').read())
+        self.import_file.file.save(
+            'portfolio-manager-sample.csv.gz', ContentFile(data.getvalue())
+        )
+
+        gzip_header, gzip_ranges = scan_row_ranges(self.import_file.file, 100)
+
+        self.assertEqual((gzip_header, gzip_ranges), (header, ranges))
+        self.assertEqual([
+            open_csv_slice(self.import_file.file, start, end).read()
+            for start, end, num_rows in gzip_ranges
+        ], expected)
+
+    def test_save_raw_data_xls(self):
+        """Excel workbooks are read sheet by sheet into raw rows."""
+        sample = path.join(
+            path.dirname(__file__), 'data', 'portfolio-manager-sample.csv'
+        )
+        rows = [
+            [value.decode('utf-8') for value in row]
+            for row in csv.reader(open(sample, 'rU')) if row
+        ]
+        # Split the rows over two sheets, each with the header.
+        workbook = xlwt.Workbook()
+        for name, sheet_rows in (
+            ('first', rows[:200]), ('second', rows[:1] + rows[200:])
+        ):
+            sheet = workbook.add_sheet(name)
+            for i, row in enumerate(sheet_rows):
+                for j, value in enumerate(row):
+                    sheet.write(i, j, value)
+        data = StringIO()
+        workbook.save(data)
+        self.import_file.file.save(
+            'portfolio-manager-sample.xls', ContentFile(data.getvalue())
+        )
+
+        tasks._save_raw_data(self.import_file.pk)
+
+        raw_saved = BuildingSnapshot.objects.filter(
+            import_file=self.import_file,
+            source_type=PORTFOLIO_RAW
+        )
+        self.assertEqual(raw_saved.count(), 512)
+        self.assertIn(
+            self.fake_extra_data, [b.extra_data for b in raw_saved]
+        )
+
+    def test_save_raw_rows_sets_sources_to_self(self):
+        """Bulk saved raw rows are their own source for every attribute."""
+        rows = [self.fake_row, self.fake_extra_data]
+        pks = save_raw_rows(
+            rows, self.import_file, ASSESSED_RAW, self.fake_org
+        )
+
+        self.assertEqual(len(pks), 2)
+        single, plural = get_sourced_attributes(BuildingSnapshot())
+        for pk, row in zip(pks, rows):
+            raw_bs = BuildingSnapshot.objects.get(pk=pk)
+            self.assertDictEqual(raw_bs.extra_data, row)
+            self.assertEqual(raw_bs.source_type, ASSESSED_RAW)
+            self.assertEqual(raw_bs.super_organization, self.fake_org)
+            self.assertEqual(raw_bs.import_file, self.import_file)
+            for attr in single:
+                self.assertEqual(
+                    getattr(raw_bs, '{0}_source_id'.format(attr)), pk
+                )
+            self.assertDictEqual(
+                raw_bs.extra_data_sources, {k: pk for k in row}
+            )
+
+    def test_copy_raw_rows_matches_orm_save(self):
+        """COPY mode saves the same raw snapshots as the ORM mode."""
+        rows = [self.fake_row, self.fake_extra_data]
+        orm_pks = save_raw_rows(
+            rows, self.import_file, PORTFOLIO_RAW, self.fake_org
+        )
+        copy_pks = copy_raw_rows(
+            rows, self.import_file, PORTFOLIO_RAW, self.fake_org
+        )
+
+        self.assertEqual(len(copy_pks), 2)
+        single, plural = get_sourced_attributes(BuildingSnapshot())
+        for orm_pk, copy_pk in zip(orm_pks, copy_pks):
+            orm_bs = BuildingSnapshot.objects.get(pk=orm_pk)
+            copy_bs = BuildingSnapshot.objects.get(pk=copy_pk)
+            self.assertDictEqual(copy_bs.extra_data, orm_bs.extra_data)
+            self.assertEqual(copy_bs.source_type, orm_bs.source_type)
+            self.assertEqual(
+                copy_bs.super_organization, orm_bs.super_organization
+            )
+            self.assertEqual(copy_bs.import_file, orm_bs.import_file)
+            for attr in single:
+                self.assertEqual(
+                    getattr(copy_bs, '{0}_source_id'.format(attr)), copy_pk
+                )
+            self.assertDictEqual(
+                copy_bs.extra_data_sources,
+                {k: copy_pk for k in orm_bs.extra_data}
+            )
+
+    def test_copy_raw_rows_in_one_transaction(self):
+        """Chunks copied in one transaction are each inserted once."""
+        first_pks = copy_raw_rows(
+            [self.fake_row], self.import_file, PORTFOLIO_RAW, self.fake_org
+        )
+        second_pks = copy_raw_rows(
+            [self.fake_extra_data],
+            self.import_file,
+            PORTFOLIO_RAW,
+            self.fake_org
+        )
+
+        self.assertEqual(len(second_pks), 1)
+        self.assertEqual(
+            BuildingSnapshot.objects.filter(
+                import_file=self.import_file
+            ).count(),
+            len(first_pks) + len(second_pks)
+        )
+
+    def test_open_stream_matches_file(self):
+        """Streaming from storage reads the same lines as the file."""
+        with open(self.import_file.file.path, 'rU') as f:
+            expected = list(f)
+        stream = self.import_file.open_stream()
+        # Tiny reads make line endings straddle the read boundaries.
+        stream.read_size = 7
+
+        self.assertEqual(list(stream), expected)
+        self.assertEqual(stream.tell(), self.import_file.file.size)
+
+        stream.seek(0)
+        self.assertEqual(stream.readline(), expected[0])
+
+    def test_local_copy_is_private(self):
+        """Local copies others could have written are never reused."""
+        with open(self.import_file.file.path, 'rb') as f:
+            expected = f.read()
+        with override_settings(IMPORT_FILE_CACHE_DIR=tempfile.mkdtemp()):
+            path = self.import_file.local_file_path
+            with open(path, 'wb') as f:
+                f.write('planted')
+            os.chmod(path, 0o666)
+
+            self.import_file._write_local_copy(
+                path, StorageStream(self.import_file.file)
+            )
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+
+            self.import_file.remove_local_copy()
+            self.assertFalse(os.path.exists(path))
+
+        shared_dir = tempfile.mkdtemp()
+        os.chmod(shared_dir, 0o777)
+        with override_settings(IMPORT_FILE_CACHE_DIR=shared_dir):
+            path = self.import_file.local_file_path
+            self.assertNotEqual(os.path.dirname(path), shared_dir)
+            self.import_file.remove_local_copy()
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_scan_row_ranges(self):
+        """Row ranges cover every data row and parse on their own."""
+        header, ranges = scan_row_ranges(self.import_file.file, 100)
+
+        self.assertEqual(len(ranges), 6)
+        self.assertEqual(sum(num_rows for _, _, num_rows in ranges), 512)
+        self.assertIn('Property Id', header)
+        # Ranges are contiguous, so no rows are lost between them.
+        for (_, end, _), (start, _, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+
+        start, end, num_rows = ranges[-1]
+        rows = list(csv.DictReader(
+            open_csv_slice(self.import_file.file, start, end)
+        ))
+        self.assertEqual(len(rows), num_rows)
+        self.assertEqual(sorted(rows[0].keys()), sorted(header))
+
     def test_map_data(self):
         """Save mappings for assessor data based on user specifications."""
         fake_import_file = ImportFile.objects.create(
@@ -166,6 +433,164 @@ class TestTasks(TestCase):
         )
 
 
+    def test_save_raw_data_map_on_save(self):
+        """Raw and mapped snapshots are written in a single pass."""
+        tasks._save_raw_data(self.import_file.pk, map_on_save=True)
+
+        import_file = ImportFile.objects.get(pk=self.import_file.pk)
+        self.assertTrue(import_file.raw_save_done)
+        self.assertTrue(import_file.mapping_done)
+        # The mapping half of each chunk counts towards mapping throughput.
+        self.assertGreater(import_file.mapping_rows_per_second, 0)
+        for source_type in (PORTFOLIO_RAW, PORTFOLIO_BS):
+            self.assertEqual(BuildingSnapshot.objects.filter(
+                import_file=import_file, source_type=source_type
+            ).count(), 512)
+
+    def test_save_raw_data_resume(self):
+        """Resuming a save only reruns the chunks that never committed."""
+        tasks._save_raw_data(self.import_file.pk)
+        checkpoints = ImportChunk.objects.filter(
+            import_file=self.import_file, stage=chunking.RAW_SAVE
+        )
+        self.assertEqual(sum(c.num_rows for c in checkpoints), 512)
+
+        # Pretend the first chunk's task died before committing: its rows
+        # and checkpoint are rolled back together. It ran first, so its
+        # rows have the lowest PKs.
+        lost = checkpoints.order_by('index')[0]
+        raw_saved = BuildingSnapshot.objects.filter(
+            import_file=self.import_file, source_type=PORTFOLIO_RAW
+        )
+        BuildingSnapshot.objects.filter(pk__in=list(
+            raw_saved.order_by('pk').values_list('pk', flat=True)[
+                :lost.num_rows
+            ]
+        )).delete()
+        lost.delete()
+        ImportFile.objects.filter(pk=self.import_file.pk).update(
+            raw_save_done=False
+        )
+        tasks._save_raw_data(self.import_file.pk, resume=True)
+
+        self.assertTrue(
+            ImportFile.objects.get(pk=self.import_file.pk).raw_save_done
+        )
+        self.assertEqual(raw_saved.count(), 512)
+        self.assertEqual(sum(c.num_rows for c in checkpoints), 512)
+
+    def test_save_raw_data_skips_unchanged_rows(self):
+        """Re-imported rows already merged aren't mapped or matched again."""
+        tasks._save_raw_data(self.import_file.pk, map_on_save=True)
+        tasks._match_buildings(self.import_file.pk)
+
+        reimport = ImportFile.objects.create(
+            import_record=self.import_record,
+            source_type='PORTFOLIO_RAW',
+        )
+        reimport.file = self.import_file.file
+        reimport.save()
+        tasks._save_raw_data(reimport.pk, map_on_save=True)
+
+        raw = BuildingSnapshot.objects.filter(
+            import_file=reimport, source_type=PORTFOLIO_RAW
+        )
+        self.assertEqual(raw.count(), 512)
+        self.assertEqual(raw.filter(duplicate_of=None).count(), 0)
+        self.assertFalse(BuildingSnapshot.objects.filter(
+            import_file=reimport, source_type=PORTFOLIO_BS
+        ).exists())
+
+        first = BuildingSnapshot.objects.filter(
+            import_file=self.import_file, source_type=PORTFOLIO_RAW
+        )
+        self.assertEqual(
+            set(raw.values_list('row_fingerprint', flat=True)),
+            set(first.values_list('row_fingerprint', flat=True))
+        )
+
+    def test_row_fingerprint(self):
+        """Fingerprints ignore column order and stray whitespace."""
+        row = {u'Address 1': u'12 Main  St ', u'Property Id': u'101125'}
+        same = {u'Property Id': u'101125', u'Address 1': u'12 Main St'}
+        other = {u'Property Id': u'101126', u'Address 1': u'12 Main St'}
+
+        self.assertEqual(row_fingerprint(row), row_fingerprint(same))
+        self.assertNotEqual(row_fingerprint(row), row_fingerprint(other))
+
+    def test_pk_ranges(self):
+        """Rows are split into PK ranges without fetching every PK."""
+        tasks._save_raw_data(self.import_file.pk)
+        raw = BuildingSnapshot.objects.filter(
+            import_file=self.import_file, source_type=PORTFOLIO_RAW
+        )
+        pks = sorted(raw.values_list('pk', flat=True))
+
+        ranges = chunking.pk_ranges(raw, 100)
+
+        self.assertEqual([count for _, _, count in ranges], [100] * 5 + [12])
+        self.assertEqual(ranges[0][0], pks[0])
+        self.assertEqual(ranges[-1][1], pks[-1])
+        for first_pk, last_pk, count in ranges:
+            self.assertEqual(
+                raw.filter(pk__gte=first_pk, pk__lte=last_pk).count(), count
+            )
+
+    def test_mapping_plan(self):
+        """Mapping plans are plain data, versioned by the org's mapping."""
+        util.make_fake_mappings(self.fake_mappings, self.fake_org)
+        plan = tasks.get_mapping_plan(self.import_file, ASSESSED_RAW)
+
+        self.assertEqual(plan['save_type'], ASSESSED_BS)
+        self.assertEqual(plan['mapping'][u'Year Built'], 'year_built')
+        self.assertEqual(json.loads(json.dumps(plan)), plan)
+        self.assertEqual(
+            tasks.get_mapping_plan(self.import_file, ASSESSED_RAW)['version'],
+            plan['version']
+        )
+
+        util.make_fake_mappings({'city': u'City'}, self.fake_org)
+        self.assertNotEqual(
+            tasks.get_mapping_plan(self.import_file, ASSESSED_RAW)['version'],
+            plan['version']
+        )
+
+    def test_compile_mapping_plan_interleaved(self):
+        """Chunks of imports mapped side by side reuse their own plans."""
+        plan = tasks.get_mapping_plan(self.import_file, ASSESSED_RAW)
+        other_plan = dict(plan, file_pk=plan['file_pk'] + 1)
+
+        compiled = tasks.compile_mapping_plan(plan)
+        tasks.compile_mapping_plan(other_plan)
+
+        self.assertIs(tasks.compile_mapping_plan(plan), compiled)
+
+    def test_memoized_cleaner(self):
+        """Each distinct value of a column goes through the cleaner once."""
+        calls = []
+
+        class FakeCleaner(object):
+            schema = {'year_built': 'float'}
+
+            def clean_value(self, value, column_name):
+                calls.append((value, column_name))
+                return float(value) if column_name == 'year_built' else value
+
+        cleaner = MemoizedCleaner(FakeCleaner())
+        self.assertEqual(
+            [
+                cleaner.clean_value(value, 'year_built')
+                for value in (u'1990', u'1990', u'2001')
+            ],
+            [1990.0, 1990.0, 2001.0]
+        )
+        self.assertEqual(cleaner.clean_value(u'1990', 'city'), u'1990')
+        self.assertEqual(cleaner.clean_value([u'x'], 'city'), [u'x'])
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(cleaner.hits, 1)
+        self.assertEqual(cleaner.schema, {'year_built': 'float'})
+
     def test_mapping_w_concat(self):
         """When we have a json encoded list as a column mapping, we concat."""
         fake_import_file = ImportFile.objects.create(
@@ -193,6 +618,74 @@ class TestTasks(TestCase):
             mapped_bs.address_line_1, u'1600 Pennsylvania Ave. Someplace Nice'
         )
 
+    def test_remap_updates_changed_fields(self):
+        """Changing a column mapping updates mapped snapshots in place."""
+        fake_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            raw_save_done=True
+        )
+        BuildingSnapshot.objects.create(
+            import_file=fake_import_file,
+            source_type=ASSESSED_RAW,
+            extra_data=self.fake_row
+        )
+        util.make_fake_mappings(self.fake_mappings, self.fake_org)
+        tasks.map_data(fake_import_file.pk)
+        mapped = BuildingSnapshot.objects.get(
+            import_file=fake_import_file, source_type=ASSESSED_BS
+        )
+        self.assertEqual(mapped.property_name, u'The Whitehouse')
+
+        ColumnMapping.objects.filter(column_raw=u'Name').update(
+            column_mapped='property_notes'
+        )
+        tasks._remap_data(fake_import_file.pk)
+
+        remapped = BuildingSnapshot.objects.get(
+            import_file=fake_import_file, source_type=ASSESSED_BS
+        )
+        self.assertEqual(remapped.pk, mapped.pk)
+        self.assertEqual(remapped.property_notes, u'The Whitehouse')
+        self.assertEqual(remapped.property_name, None)
+        self.assertEqual(remapped.address_line_1, mapped.address_line_1)
+        self.assertTrue(
+            ImportFile.objects.get(pk=fake_import_file.pk).mapping_done
+        )
+
+    def test_remap_not_mapped_while_pending(self):
+        """A file isn't done mapping while its chunks are remapped."""
+        fake_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            raw_save_done=True
+        )
+        BuildingSnapshot.objects.create(
+            import_file=fake_import_file,
+            source_type=ASSESSED_RAW,
+            extra_data=self.fake_row
+        )
+        util.make_fake_mappings(self.fake_mappings, self.fake_org)
+        tasks.map_data(fake_import_file.pk)
+        self.assertTrue(
+            ImportFile.objects.get(pk=fake_import_file.pk).mapping_done
+        )
+
+        ColumnMapping.objects.filter(column_raw=u'Name').update(
+            column_mapped='property_notes'
+        )
+        with patch('seed.tasks.dispatch_windowed') as dispatch:
+            tasks._remap_data(fake_import_file.pk)
+
+        pending, callback = dispatch.call_args[0]
+        self.assertEqual(len(pending), 1)
+        self.assertFalse(
+            ImportFile.objects.get(pk=fake_import_file.pk).mapping_done
+        )
+
+        callback.apply((None,))
+        self.assertTrue(
+            ImportFile.objects.get(pk=fake_import_file.pk).mapping_done
+        )
+
     def test_match_buildings(self):
         """Good case for testing our matching system."""
         bs_data = {
@@ -383,6 +876,290 @@ class TestTasks(TestCase):
             0
         )
 
+    def test_match_buildings_exact_ids(self):
+        """Shared IDs match outright, however different the rest is."""
+        snapshot = util.make_fake_snapshot(self.import_file, {
+           'tax_lot_id': '435/422',
+           'pm_property_id': '1243',
+           'address_line_1': '555 Database LN.',
+        }, ASSESSED_BS, is_canon=True)
+        new_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            mapping_done=True
+        )
+        same = util.make_fake_snapshot(new_import_file, {
+           'tax_lot_id': '435-422 ',
+           'address_line_1': '1 Elsewhere Blvd.',
+        }, PORTFOLIO_BS)
+        conflicting = util.make_fake_snapshot(new_import_file, {
+           'tax_lot_id': '435/422',
+           'pm_property_id': '9999',
+           'address_line_1': '1 Elsewhere Blvd.',
+        }, PORTFOLIO_BS)
+
+        self.assertEqual(
+            match_index.find_exact_matches(
+                self.fake_org, [same.pk, conflicting.pk]
+            ),
+            [(same.pk, snapshot.pk, 1.0)]
+        )
+
+        tasks.match_buildings(new_import_file.pk)
+
+        merged = BuildingSnapshot.objects.get(parents=same)
+        self.assertEqual(merged.confidence, 1.0)
+        self.assertEqual(merged.match_type, SYSTEM_MATCH)
+        self.assertIn(snapshot, get_ancestors(merged))
+
+    @patch('seed.tasks.MATCH_SHARD_SIZE', 1)
+    def test_match_buildings_shards(self):
+        """Buildings claiming one canonical merge into it in turn."""
+        bs_data = {
+           'pm_property_id': 1243,
+           'tax_lot_id': '435/422',
+           'custom_id_1': 1243,
+           'address_line_1': '555 Database LN.',
+        }
+        snapshot = util.make_fake_snapshot(
+            self.import_file, bs_data, ASSESSED_BS, is_canon=True
+        )
+        new_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            mapping_done=True
+        )
+        first, second = [
+            util.make_fake_snapshot(new_import_file, bs_data, PORTFOLIO_BS)
+            for i in range(2)
+        ]
+
+        tasks.match_buildings(new_import_file.pk)
+
+        canon = CanonicalBuilding.objects.get(pk=snapshot.canonical_building_id)
+        latest = canon.canonical_snapshot
+        self.assertIn(second.pk, [p.pk for p in latest.parents.all()])
+        merged = latest.parents.exclude(pk=second.pk).get()
+        self.assertEqual(
+            sorted(p.pk for p in merged.parents.all()),
+            [snapshot.pk, first.pk]
+        )
+        self.assertEqual(latest.confidence, 1.0)
+        self.assertTrue(ImportFile.objects.get(
+            pk=new_import_file.pk
+        ).matching_done)
+
+    def test_finish_match_buildings_expired(self):
+        """A run whose cached results expired is searched again."""
+        bs_data = {
+           'pm_property_id': 1243,
+           'tax_lot_id': '435/422',
+           'address_line_1': '555 Database LN.',
+        }
+        snapshot = util.make_fake_snapshot(
+            self.import_file, bs_data, ASSESSED_BS, is_canon=True
+        )
+        new_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            mapping_done=True
+        )
+        new_snapshot = util.make_fake_snapshot(
+            new_import_file, bs_data, PORTFOLIO_BS
+        )
+
+        tasks.finish_match_buildings(
+            [], new_import_file.pk, self.fake_org.pk, 'expired',
+            tasks.get_prog_key('match_buildings', new_import_file.pk)
+        )
+
+        canon = CanonicalBuilding.objects.get(
+            pk=snapshot.canonical_building_id
+        )
+        self.assertEqual(
+            sorted(p.pk for p in canon.canonical_snapshot.parents.all()),
+            [snapshot.pk, new_snapshot.pk]
+        )
+
+    def test_match_buildings_trigram_engine(self):
+        """The database engine matches as the in-process one does."""
+        try:
+            with transaction.atomic():
+                connection.cursor().execute(
+                    'CREATE EXTENSION IF NOT EXISTS pg_trgm'
+                )
+        except DatabaseError:
+            self.skipTest('pg_trgm is not available')
+
+        snapshot = util.make_fake_snapshot(self.import_file, {
+           'address_line_1': '555 Database LN.',
+           'city': 'Gotham City',
+        }, ASSESSED_BS, is_canon=True)
+        new_import_file = ImportFile.objects.create(
+            import_record=self.import_record,
+            mapping_done=True
+        )
+        new_snapshot = util.make_fake_snapshot(new_import_file, {
+           'address_line_1': '555 Database Lane',
+        }, PORTFOLIO_BS)
+
+        with override_settings(MATCH_ENGINE='trigram'):
+            tasks.match_buildings(new_import_file.pk)
+
+        self.assertEqual(
+            BuildingSnapshot.objects.get(pk=snapshot.pk).match_key,
+            u'555 database ln'
+        )
+        merged = BuildingSnapshot.objects.get(parents=new_snapshot)
+        self.assertIn(snapshot, merged.parents.all())
+        self.assertTrue(0.2 <= merged.confidence < 1.0)
+
+    def test_match_index(self):
+        """The index is kept on disk and follows canonical changes."""
+        bs1_data = {
+           'tax_lot_id': '435/422',
+           'address_line_1': '555 Database LN.',
+        }
+        bs2_data = {
+           'tax_lot_id': '1231',
+           'address_line_1': '44444 Hmmm Ave.',
+        }
+        snapshot = util.make_fake_snapshot(
+            self.import_file, bs1_data, ASSESSED_BS, is_canon=True
+        )
+
+        with override_settings(MATCH_INDEX_DIR=tempfile.mkdtemp()):
+            match_index._indexes.clear()
+            index = match_index.get_match_index(self.fake_org)
+            self.assertEqual(len(index), 1)
+            self.assertEqual(index[u'435422 555 database ln'], snapshot.pk)
+
+            new_snapshot = util.make_fake_snapshot(
+                self.import_file, bs2_data, ASSESSED_BS, is_canon=True
+            )
+            snapshot.canonical_building.delete()
+            index = match_index.get_match_index(self.fake_org)
+            self.assertEqual(
+                [r[0] for r in index.search(u'1231 44444 hmmm ave', 0.5)],
+                [u'1231 44444 hmmm ave']
+            )
+            self.assertEqual(index.search(u'435422 555 database ln', 0.5), [])
+
+            loaded = match_index.MatchIndex.load(self.fake_org.pk)
+            self.assertEqual(loaded.strings, index.strings)
+            self.assertEqual(loaded[u'1231 44444 hmmm ave'], new_snapshot.pk)
+            self.assertFalse(loaded.refresh(self.fake_org))
+
+            # Files others could have written are never unpickled.
+            path = match_index.MatchIndex.get_path(self.fake_org.pk)
+            os.chmod(path, 0o666)
+            self.assertEqual(
+                len(match_index.MatchIndex.load(self.fake_org.pk)), 0
+            )
+
+        # Unset, indexes go in a private directory in the temp dir.
+        with override_settings(MATCH_INDEX_DIR=None):
+            index_dir = path.dirname(
+                match_index.MatchIndex.get_path(self.fake_org.pk)
+            )
+            self.assertEqual(
+                path.dirname(index_dir), tempfile.gettempdir()
+            )
+            self.assertEqual(os.stat(index_dir).st_mode & 0o777, 0o700)
+
+        # Never in one others can write to.
+        shared_dir = tempfile.mkdtemp()
+        os.chmod(shared_dir, 0o777)
+        with override_settings(MATCH_INDEX_DIR=shared_dir):
+            self.assertIsNone(
+                match_index.MatchIndex.get_path(self.fake_org.pk)
+            )
+
+    def test_match_index_current(self):
+        """Shards search the index a run refreshed without refreshing it."""
+        util.make_fake_snapshot(self.import_file, {
+           'tax_lot_id': '435/422',
+           'address_line_1': '555 Database LN.',
+        }, ASSESSED_BS, is_canon=True)
+
+        with override_settings(MATCH_INDEX_DIR=tempfile.mkdtemp()):
+            match_index._indexes.clear()
+            index = match_index.get_match_index(self.fake_org)
+            with patch.object(match_index.MatchIndex, 'refresh') as refresh:
+                self.assertIs(
+                    match_index.get_match_index(
+                        self.fake_org, refresh=False
+                    ),
+                    index
+                )
+                # Another worker loads the copy the run saved.
+                match_index._indexes.clear()
+                loaded = match_index.get_match_index(
+                    self.fake_org, refresh=False
+                )
+            self.assertFalse(refresh.called)
+            self.assertEqual(loaded.strings, index.strings)
+
+            match_index.release_match_index(self.fake_org)
+            self.assertNotIn(self.fake_org.pk, match_index._indexes)
+
+    def test_match_index_memory(self):
+        """Workers drop the indexes they used least recently when full."""
+        util.make_fake_snapshot(self.import_file, {
+           'tax_lot_id': '435/422',
+           'address_line_1': '555 Database LN.',
+        }, ASSESSED_BS, is_canon=True)
+        other_org = Organization.objects.create()
+
+        with override_settings(MATCH_INDEX_DIR=tempfile.mkdtemp()):
+            match_index._indexes.clear()
+            with patch('seed.utils.match_index.MAX_LOADED_SNAPSHOTS', 1):
+                match_index.get_match_index(other_org)
+                match_index.get_match_index(self.fake_org)
+                self.assertEqual(
+                    list(match_index._indexes),
+                    [other_org.pk, self.fake_org.pk]
+                )
+            with patch('seed.utils.match_index.MAX_LOADED_SNAPSHOTS', 0):
+                # The index in use is kept however big it is.
+                match_index.get_match_index(other_org)
+                self.assertEqual(list(match_index._indexes), [other_org.pk])
+
+    def test_match_index_blocks(self):
+        """Blocked searches find what a full search does, among fewer."""
+        self.assertEqual(
+            match_index.get_blocks({
+                'address_line_1': u'000015581 SW Sycamore Court',
+                'postal_code': u'10108-9812',
+                'tax_lot_id': u'435/422',
+                'custom_id_1': None,
+            }),
+            frozenset([u'num:15581', u'zip:10108', u'id:4354'])
+        )
+
+        util.make_fake_snapshot(self.import_file, {
+           'tax_lot_id': '435/422',
+           'address_line_1': '555 Database LN.',
+        }, ASSESSED_BS, is_canon=True)
+        util.make_fake_snapshot(self.import_file, {
+           'tax_lot_id': '1231',
+           'address_line_1': '44444 Hmmm Ave.',
+        }, ASSESSED_BS, is_canon=True)
+        with override_settings(MATCH_INDEX_DIR=tempfile.mkdtemp()):
+            match_index._indexes.clear()
+            index = match_index.get_match_index(self.fake_org)
+
+        query, blocks = match_index.describe(
+            [None, None, None, None, '555 Database Lane', None, None]
+        )
+        self.assertEqual(blocks, frozenset([u'num:555']))
+        self.assertEqual(
+            index.search(query, 0.2, blocks)[0],
+            index.search(query, 0.2)[0]
+        )
+        stats = index.get_block_stats()
+        self.assertEqual(stats['searches'], 2)
+        self.assertEqual(stats['blocked'], 1)
+        self.assertEqual(stats['comparisons'], 1 + 2)
+        self.assertEqual(stats['blocks'], 4)
+
     def test_get_ancestors(self):
         """Tests get_ancestors(building), returns all non-composite, non-raw
             BuildingSnapshot instances.
@@ -508,3 +1285,86 @@ class TestTasks(TestCase):
         self.assertGreater(CanonicalBuilding.objects.filter(
             canonical_snapshot__super_organization=fake_org_2
         ).count(), 0)
+
+    @override_settings(CELERY_ALWAYS_EAGER=False)
+    def test_dispatch_windowed(self):
+        """Only ``window`` tasks are queued at once, callback fires once."""
+        queued = []
+
+        def fake_apply_async(sig, args=(), kwargs=None, **options):
+            queued.append((sig, options.get('link')))
+
+        chunks = [
+            tasks._delete_organization_buildings_chunk.subtask(
+                ([], 'fake_cache_key', 1, self.fake_org.pk)
+            ) for _ in range(5)
+        ]
+        callback = tasks.finish_delete.subtask([self.fake_org.pk])
+
+        with patch('celery.canvas.Signature.apply_async', fake_apply_async):
+            tasks.dispatch_windowed(chunks, callback, window=2)
+            self.assertEqual(len(queued), 2)
+
+            finished = 0
+            while finished < len(chunks):
+                sig, link = queued.pop(0)
+                self.assertEqual(sig['task'], chunks[0]['task'])
+                self.assertLessEqual(len(queued), 1)
+                tasks._advance_window(None, *link.args)
+                finished += 1
+
+        # Only the callback is left, and it was queued exactly once.
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(queued[0][0]['task'], callback['task'])
+        self.assertIsNone(queued[0][1])
+
+    @override_settings(CELERY_ALWAYS_EAGER=False)
+    def test_dispatch_windowed_failure(self):
+        """A failed task frees its slot; the callback then doesn't run."""
+        queued = []
+
+        def fake_apply_async(sig, args=(), kwargs=None, **options):
+            queued.append((sig, options.get('link_error')))
+
+        chunks = [
+            tasks._delete_organization_buildings_chunk.subtask(
+                ([], 'fake_cache_key', 1, self.fake_org.pk)
+            ) for _ in range(4)
+        ]
+        callback = tasks.finish_delete.subtask([self.fake_org.pk])
+
+        with patch('celery.canvas.Signature.apply_async', fake_apply_async):
+            tasks.dispatch_windowed(chunks, callback, window=1)
+            for i in range(len(chunks)):
+                sig, link_error = queued.pop(0)
+                self.assertEqual(sig['task'], chunks[0]['task'])
+                if i == 0:
+                    tasks._fail_window_task('fake-task-id', *link_error.args)
+                else:
+                    tasks._advance_window(None, *link_error.args)
+
+        # Every task ran, but not the callback.
+        self.assertEqual(queued, [])
+
+    @override_settings(CELERY_ALWAYS_EAGER=False)
+    def test_dispatch_windowed_evicted(self):
+        """A window whose keys were evicted is given up on quietly."""
+        queued = []
+
+        def fake_apply_async(sig, args=(), kwargs=None, **options):
+            queued.append(options.get('link'))
+
+        chunks = [
+            tasks._delete_organization_buildings_chunk.subtask(
+                ([], 'fake_cache_key', 1, self.fake_org.pk)
+            ) for _ in range(2)
+        ]
+        callback = tasks.finish_delete.subtask([self.fake_org.pk])
+
+        with patch('celery.canvas.Signature.apply_async', fake_apply_async):
+            tasks.dispatch_windowed(chunks, callback, window=1)
+            window_id = queued[0].args[0]
+            cache.delete(get_window_key('next', window_id))
+            tasks._advance_window(None, window_id)
+
+        self.assertEqual(len(queued), 1)
@@ -25,6 +25,7 @@ from seed.models import (
     save_snapshot_match,
 )
 from seed.views.main import DEFAULT_CUSTOM_COLUMNS
+from seed.utils.mapping import suggest_column_mappings
 from seed.utils.constants import ASSESSOR_FIELDS
 from seed.tests import util as test_util
 
@@ -572,6 +573,38 @@ class TestMCMViews(TestCase):
 
         self.assertDictEqual(body, self.suggested_expected)
 
+    def test_get_column_mapping_suggestions_cached(self):
+        """Suggestions are cached until the org's mappings change."""
+        def get_suggestions():
+            resp = self.client.post(
+                reverse_lazy("seed:get_column_mapping_suggestions"),
+                data=json.dumps({
+                    'import_file_id': self.import_file.id,
+                }),
+                content_type='application/json'
+            )
+            return json.loads(resp.content)['suggested_column_mappings']
+
+        first = get_suggestions()
+        with self.assertNumQueries(1):
+            self.assertDictEqual(
+                suggest_column_mappings(
+                    self.import_file.first_row_columns, self.org
+                ),
+                first
+            )
+
+        ColumnMapping.objects.create(
+            super_organization=self.org,
+            source_type=ASSESSED_RAW,
+            column_raw=u'building id',
+            column_mapped=u'custom_id_1'
+        )
+
+        self.assertEqual(
+            get_suggestions()[u'building id'][0], u'custom_id_1'
+        )
+
     def test_get_raw_column_names(self):
         """Good case for ``get_raw_column_names``."""
         resp = self.client.post(
@@ -12,6 +12,7 @@ from seed.utils.organizations import create_organization
 from seed.utils.buildings import (
     get_buildings_for_user, get_buildings_for_user_count
 )
+from seed.utils.time import DateConverter, convert_datestr
 
 from data_importer.models import ImportRecord
 
@@ -104,3 +105,39 @@ class UtilsTests(TestCase):
         BuildingSnapshot.objects.create()
         BuildingSnapshot.objects.create()
         self.assertEqual(get_buildings_for_user_count(self.user), 5)
+
+
+class DateConverterTests(TestCase):
+    def test_matches_dateutil(self):
+        values = [
+            u'12/31/2013', u'1/2/2014', u'12/31/2013', u'2014-03-04',
+            u'13/01/2013', u'Dec 5, 2012', u'not a date', u'2014-03-04',
+        ]
+        convert = DateConverter()
+        self.assertEqual(
+            [convert(value) for value in values],
+            [convert_datestr(value) for value in values]
+        )
+        self.assertEqual(convert(1400000000), None)
+
+    def test_learns_format(self):
+        convert = DateConverter()
+        for day in range(1, 29):
+            convert(u'02/{0}/2014'.format(day))
+        convert(u'02/1/2014')
+
+        self.assertEqual(convert.format, '%m/%d/%Y')
+        self.assertEqual(convert.stats['fallbacks'], 1)
+        self.assertEqual(convert.stats['fast'], 27)
+        self.assertEqual(convert.stats['hits'], 1)
+
+    def test_lru(self):
+        convert = DateConverter(cache_size=2)
+        for value in (u'01/01/2014', u'01/02/2014', u'01/01/2014',
+                      u'01/03/2014', u'01/02/2014'):
+            convert(value)
+
+        self.assertEqual(convert.hits, 1)
+        self.assertEqual(
+            list(convert.cache), [u'01/03/2014', u'01/02/2014']
+        )
@@ -0,0 +1,191 @@
+from django.core.cache import cache
+from django.db import connection
+
+from data_importer.models import ImportChunk, ImportFile
+from seed.decorators import get_stats_key
+
+
+DEFAULT_CHUNK_SIZE = 100
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 5000
+# A chunk should hold about this many cells...
+TARGET_CHUNK_CELLS = 10000
+# ... about this many bytes of raw row data...
+TARGET_CHUNK_BYTES = 512 * 1024
+# ... and take about this many seconds to process.
+TARGET_CHUNK_SECONDS = 10
+
+# Pipeline stages we plan chunks for. Imports keep their history on
+# ImportFile (``<stage>_chunk_size``, ``<stage>_rows_per_second``).
+RAW_SAVE = 'raw_save'
+MAPPING = 'mapping'
+DELETE = 'delete'
+DELETE_CANONICAL = 'delete_canonical'
+
+# Number of past imports to average throughput over.
+HISTORY_SIZE = 5
+# Seconds per-chunk timings are kept while a job runs.
+STATS_CACHE_TIMEOUT = 60 * 60 * 24
+# Seconds the throughput of jobs with no ImportFile (deletes) is kept.
+HISTORY_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def plan_chunk_size(num_columns=None, avg_row_bytes=None,
+                    rows_per_second=None, default=DEFAULT_CHUNK_SIZE):
+    """Pick the number of rows to hand each chunk task.
+
+    :param num_columns: (optional) int, columns per row.
+    :param avg_row_bytes: (optional) float, average raw size of a row.
+    :param rows_per_second: (optional) float, measured throughput of a
+        single chunk task, see ``get_history_throughput``.
+    :param default: (optional) int, chunk size if nothing else is known.
+    :rtype: int
+
+    Each known measure caps the chunk size, wide rows and slow chunks
+    getting smaller chunks, and the tightest cap wins.
+
+    """
+    limits = []
+    if num_columns:
+        limits.append(float(TARGET_CHUNK_CELLS) / num_columns)
+    if avg_row_bytes:
+        limits.append(TARGET_CHUNK_BYTES / avg_row_bytes)
+    if rows_per_second:
+        limits.append(rows_per_second * TARGET_CHUNK_SECONDS)
+
+    size = min(limits) if limits else default
+
+    return int(max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size)))
+
+
+def pk_ranges(queryset, chunk_size):
+    """Split a queryset into consecutive ranges of ``chunk_size`` rows.
+
+    :param queryset: QuerySet, the rows to split up.
+    :param chunk_size: int, rows per range; the last range may be short.
+    :rtype: list of (first pk, last pk, number of rows) tuples, in order.
+
+    The rows are numbered by the database, so only the bounds of each range
+    come back rather than every PK. A range's rows are then those of the
+    queryset with PKs between its bounds, inclusive.
+
+    """
+    sql, params = queryset.order_by().values_list(
+        'pk', flat=True
+    ).query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT min(pk), max(pk), count(*) FROM ('
+        'SELECT pk, (row_number() OVER (ORDER BY pk) - 1) / %s AS chunk '
+        'FROM ({0}) AS rows (pk)'
+        ') AS numbered GROUP BY chunk ORDER BY chunk'.format(sql),
+        [chunk_size] + list(params)
+    )
+
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def record_chunk(stage, pk, num_rows, seconds):
+    """Add the timing of one finished chunk to a job's running totals.
+
+    :param stage: str, e.g. ``RAW_SAVE``.
+    :param pk: int, the ImportFile (or Organization, for deletes) pk.
+    :param num_rows: int, rows processed by the chunk.
+    :param seconds: float, time the chunk took.
+
+    """
+    totals = (
+        (get_stats_key(stage + '_rows', pk), num_rows),
+        (get_stats_key(stage + '_ms', pk), int(seconds * 1000)),
+    )
+    for key, value in totals:
+        cache.add(key, 0, STATS_CACHE_TIMEOUT)
+        cache.incr(key, value)
+
+
+def pop_throughput(stage, pk):
+    """Return a job's rows per second per chunk task, and reset its totals.
+
+    :rtype: float, or None if no chunks were recorded.
+
+    """
+    rows_key = get_stats_key(stage + '_rows', pk)
+    ms_key = get_stats_key(stage + '_ms', pk)
+    rows, ms = cache.get(rows_key), cache.get(ms_key)
+    cache.delete_many([rows_key, ms_key])
+    if not rows:
+        return None
+
+    return rows * 1000.0 / max(ms, 1)
+
+
+def get_history_throughput(stage, source_type=None):
+    """Return the average chunk throughput of recent jobs of a stage.
+
+    :param stage: str, e.g. ``MAPPING``.
+    :param source_type: (optional) str, ImportFile.source_type to compare
+        against; narrow PM files and wide assessor files differ a lot.
+    :rtype: float, or None if there's no history.
+
+    """
+    if stage not in (RAW_SAVE, MAPPING):
+        return cache.get(get_stats_key(stage + '_history', 'last'))
+
+    field = '{0}_rows_per_second'.format(stage)
+    values = ImportFile.objects.filter(
+        **{'{0}__isnull'.format(field): False}
+    )
+    if source_type:
+        values = values.filter(source_type=source_type)
+    values = list(
+        values.order_by('-pk').values_list(field, flat=True)[:HISTORY_SIZE]
+    )
+    if not values:
+        return None
+
+    return sum(values) / len(values)
+
+
+def save_history_throughput(stage, rows_per_second):
+    """Remember the throughput of a job that has no ImportFile."""
+    if rows_per_second:
+        cache.set(
+            get_stats_key(stage + '_history', 'last'),
+            rows_per_second,
+            HISTORY_CACHE_TIMEOUT
+        )
+
+
+def get_done_chunks(file_pk, stage):
+    """Return the indexes of the chunks of a stage already committed."""
+    return set(ImportChunk.objects.filter(
+        import_file_id=file_pk, stage=stage
+    ).values_list('index', flat=True))
+
+
+def is_chunk_done(file_pk, stage, index):
+    if index is None:
+        return False
+
+    return ImportChunk.objects.filter(
+        import_file_id=file_pk, stage=stage, index=index
+    ).exists()
+
+
+def save_checkpoint(file_pk, stage, index, num_rows):
+    """Record a finished chunk; call inside the chunk's transaction.
+
+    :param index: int, the chunk's position in the stage, or None for
+        chunks that weren't dispatched as part of a resumable stage.
+
+    """
+    if index is None:
+        return
+
+    ImportChunk.objects.create(
+        import_file_id=file_pk, stage=stage, index=index, num_rows=num_rows
+    )
+
+
+def clear_checkpoints(file_pk, stage):
+    ImportChunk.objects.filter(import_file_id=file_pk, stage=stage).delete()
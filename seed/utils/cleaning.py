@@ -0,0 +1,48 @@
+# Most distinct (column, value) pairs a MemoizedCleaner remembers.
+MAX_MEMO_SIZE = 100000
+
+
+class MemoizedCleaner(object):
+    """Cleans each distinct value of a column once.
+
+    Wraps an ``mcm.cleaners.Cleaner``, and is used in its place. Imports
+    repeat the same years, dates, zip codes and flags down whole columns,
+    so across a chunk most cells are a lookup rather than another pass
+    through the cleaner's parsing. Results are the wrapped cleaner's own.
+
+    """
+    def __init__(self, cleaner, max_size=MAX_MEMO_SIZE):
+        self.cleaner = cleaner
+        self.max_size = max_size
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clean_value(self, value, column_name):
+        key = (column_name, value)
+        try:
+            cleaned = self.memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable value, nothing to remember it by.
+            return self.cleaner.clean_value(value, column_name)
+        else:
+            self.hits += 1
+            return cleaned
+
+        self.misses += 1
+        if len(self.memo) >= self.max_size:
+            self.memo.clear()
+        cleaned = self.memo[key] = self.cleaner.clean_value(
+            value, column_name
+        )
+
+        return cleaned
+
+    def __getattr__(self, name):
+        # Anything else the mapper asks of the cleaner, e.g. its schema.
+        # Looked up through __dict__ so copying an instance can't recurse.
+        if 'cleaner' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__['cleaner'], name)
@@ -6,14 +6,17 @@ EXCLUDE_FIELDS = [
     'children',
     'confidence',
     'created',
+    'duplicate_of',
     'extra_data',
     'id',
     'import_file',
     'last_modified_by',
+    'match_key',
     'match_type',
     'modified',
     'parents',
     'pk',
+    'row_fingerprint',
     'seed_org',
     'source_type',
     'super_organization',
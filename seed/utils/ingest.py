@@ -0,0 +1,341 @@
+import csv
+import hashlib
+import json
+from collections import defaultdict
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from seed.models import (
+    ASSESSED_BS,
+    ASSESSED_RAW,
+    BuildingSnapshot,
+    PORTFOLIO_BS,
+    PORTFOLIO_RAW,
+    get_sourced_attributes,
+    reserve_pks,
+)
+
+
+# Rows per INSERT statement when bulk creating snapshots.
+INSERT_BATCH_SIZE = 500
+
+# How raw rows get written to the database, see ``settings.RAW_SAVE_MODE``.
+RAW_SAVE_ORM = 'orm'
+RAW_SAVE_COPY = 'copy'
+RAW_SAVE_MODES = (RAW_SAVE_ORM, RAW_SAVE_COPY)
+
+# Session-local table we COPY raw rows into before inserting snapshots.
+STAGING_TABLE = 'seed_raw_staging'
+# Stands in for the new snapshot's PK in the staged extra_data_sources.
+# Parsed CSV can't contain NUL bytes, so no raw column name can collide.
+PK_PLACEHOLDER = u'\x00'
+
+# Mapped source type for each raw source type.
+MAPPED_SOURCE_TYPES = {
+    ASSESSED_RAW: ASSESSED_BS,
+    PORTFOLIO_RAW: PORTFOLIO_BS,
+}
+
+
+def skip_unchanged_rows():
+    """Whether rows already merged by an earlier import are skipped."""
+    return getattr(settings, 'IMPORT_SKIP_UNCHANGED_ROWS', True)
+
+
+def row_fingerprint(row):
+    """Hash a raw row so re-imports of the same data can be spotted.
+
+    :param row: dict, a parsed row from an import file.
+    :rtype: str, hex sha1 digest.
+
+    Column order and runs of whitespace around and within values don't
+    change the fingerprint; anything else does.
+
+    """
+    normalized = sorted(
+        (_normalize(key), _normalize(value)) for key, value in row.items()
+    )
+    return hashlib.sha1(
+        json.dumps(normalized, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+
+def _normalize(value):
+    if value is None:
+        return u''
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return u' '.join(value.split())
+
+
+def get_raw_save_mode(mode=None):
+    """Return the raw save mode to use, defaulting to the deployment's.
+
+    :param mode: (optional) str, one of ``RAW_SAVE_MODES``.
+
+    COPY is PostgreSQL specific, so other databases always get the ORM mode.
+
+    """
+    mode = mode or getattr(settings, 'RAW_SAVE_MODE', RAW_SAVE_ORM)
+    if mode not in RAW_SAVE_MODES:
+        raise ValueError('Unknown raw save mode: {0}'.format(mode))
+    if mode == RAW_SAVE_COPY and connection.vendor != 'postgresql':
+        mode = RAW_SAVE_ORM
+
+    return mode
+
+
+def save_raw_data_rows(rows, import_file, source_type, super_org, mode=None):
+    """Save a chunk of raw rows with the configured raw save mode."""
+    if get_raw_save_mode(mode) == RAW_SAVE_COPY:
+        return copy_raw_rows(rows, import_file, source_type, super_org)
+
+    return save_raw_rows(rows, import_file, source_type, super_org)
+
+
+def save_raw_rows(rows, import_file, source_type, super_org):
+    """Save a chunk of parsed rows as raw BuildingSnapshots in bulk.
+
+    :param rows: list of dict, parsed rows from the import file.
+    :param import_file: ImportFile inst.
+    :param source_type: int, ASSESSED_RAW or PORTFOLIO_RAW.
+    :param super_org: Organization inst, owner of the new snapshots.
+    :rtype: list of int, the PKs of the saved snapshots in row order.
+
+    Raw snapshots are their own source for every attribute, so we reserve
+    the PKs before inserting and write the ``*_source`` pointers along with
+    the rest of the row. The saved rows are the same as those produced by
+    calling ``set_initial_sources`` on each individually saved snapshot.
+
+    """
+    if not rows:
+        return []
+
+    single, plural = get_sourced_attributes(BuildingSnapshot())
+    pks = reserve_pks(BuildingSnapshot, len(rows))
+
+    snapshots = []
+    for pk, row in zip(pks, rows):
+        snapshot = BuildingSnapshot(
+            pk=pk,
+            import_file=import_file,
+            source_type=source_type,
+            super_organization=super_org,
+            extra_data=row,
+            row_fingerprint=row_fingerprint(row),
+        )
+        for attr in single:
+            setattr(snapshot, '{0}_source_id'.format(attr), pk)
+        for attr in plural:
+            values = getattr(snapshot, attr, None) or {}
+            setattr(snapshot, '{0}_sources'.format(attr), {
+                k: pk for k in values
+            })
+
+        snapshots.append(snapshot)
+
+    BuildingSnapshot.objects.bulk_create(
+        snapshots, batch_size=INSERT_BATCH_SIZE
+    )
+
+    return pks
+
+
+def copy_raw_rows(rows, import_file, source_type, super_org):
+    """Save a chunk of parsed rows as raw BuildingSnapshots using COPY.
+
+    Takes the same arguments, and produces the same rows, as
+    ``save_raw_rows``.
+
+    Rows are streamed with ``COPY ... FROM STDIN`` into a temporary staging
+    table whose ``id`` column draws from the BuildingSnapshot sequence. A
+    single ``INSERT ... SELECT`` then moves them into the snapshot table,
+    pointing every ``*_source`` column at the row's own id and substituting
+    that id into the staged ``extra_data_sources``, and the staging table is
+    emptied again.
+
+    """
+    if not rows:
+        return []
+
+    meta = BuildingSnapshot._meta
+    single = get_sourced_attributes(BuildingSnapshot())[0]
+    json_type = meta.get_field('extra_data').db_type(connection)
+    source_columns = [
+        meta.get_field('{0}_source'.format(attr)).column for attr in single
+    ]
+    columns = [meta.pk.column] + [
+        meta.get_field(name).column for name in (
+            'created',
+            'modified',
+            'import_file',
+            'source_type',
+            'super_organization',
+            'extra_data',
+            'extra_data_sources',
+            'row_fingerprint',
+        )
+    ] + source_columns
+    placeholder = json.dumps(PK_PLACEHOLDER)
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([
+            json.dumps(row),
+            json.dumps(dict.fromkeys(row, PK_PLACEHOLDER)),
+            row_fingerprint(row),
+        ])
+    buf.seek(0)
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS {0} ('
+            'id integer NOT NULL DEFAULT nextval(%s), '
+            'extra_data text NOT NULL, '
+            'extra_data_sources text NOT NULL, '
+            'row_fingerprint varchar(40) NOT NULL'
+            ') ON COMMIT DELETE ROWS'.format(STAGING_TABLE),
+            [_get_pk_sequence(cursor)]
+        )
+        cursor.copy_expert(
+            'COPY {0} (extra_data, extra_data_sources, row_fingerprint) '
+            'FROM STDIN WITH CSV'.format(STAGING_TABLE),
+            buf
+        )
+        cursor.execute(
+            'INSERT INTO {table} ({columns}) '
+            'SELECT id, now(), now(), %s, %s, %s, '
+            'extra_data::{json_type}, '
+            'replace(extra_data_sources, %s, id::text)::{json_type}, '
+            'row_fingerprint{source_ids} '
+            'FROM {staging} ORDER BY id RETURNING {pk}'.format(
+                table=meta.db_table,
+                columns=', '.join(columns),
+                json_type=json_type,
+                source_ids=', id' * len(source_columns),
+                staging=STAGING_TABLE,
+                pk=meta.pk.column,
+            ),
+            [
+                import_file.pk,
+                source_type,
+                getattr(super_org, 'pk', None),
+                placeholder,
+            ]
+        )
+        pks = [row[0] for row in cursor.fetchall()]
+        # ON COMMIT only empties the table once the outermost transaction
+        # ends; callers that save several chunks in one would insert the
+        # earlier chunks again.
+        cursor.execute('TRUNCATE {0}'.format(STAGING_TABLE))
+
+    return pks
+
+
+def flag_unchanged_rows(pks, rows, import_file, source_type, super_org):
+    """Flag raw snapshots whose rows an earlier import already merged.
+
+    :param pks: list of int, PKs of the just saved raw snapshots.
+    :param rows: list of dict, their rows, in the same order.
+    :param import_file: ImportFile inst the rows were saved from.
+    :param source_type: int, ASSESSED_RAW or PORTFOLIO_RAW.
+    :param super_org: Organization inst, owner of the snapshots.
+    :rtype: set of int, the PKs that were flagged.
+
+    A row is unchanged if a mapped snapshot from another of the org's
+    imports has the same fingerprint and belongs, itself or through a
+    match, to an active canonical building. The raw snapshot's
+    ``duplicate_of`` is pointed at that mapped snapshot, and mapping and
+    matching leave it alone.
+
+    """
+    if not pks:
+        return set()
+
+    fingerprints = [row_fingerprint(row) for row in rows]
+    merged = dict(BuildingSnapshot.objects.filter(
+        Q(canonical_building__active=True) |
+        Q(children__canonical_building__active=True),
+        super_organization=super_org,
+        source_type=MAPPED_SOURCE_TYPES[source_type],
+        row_fingerprint__in=set(fingerprints),
+    ).exclude(
+        import_file=import_file
+    ).order_by('pk').values_list('row_fingerprint', 'pk'))
+
+    # Latest merged snapshot for each fingerprint -> raw PKs to flag.
+    flagged = defaultdict(list)
+    for pk, fingerprint in zip(pks, fingerprints):
+        if fingerprint in merged:
+            flagged[merged[fingerprint]].append(pk)
+
+    for duplicate_of, ids in flagged.items():
+        BuildingSnapshot.objects.filter(pk__in=ids).update(
+            duplicate_of=duplicate_of
+        )
+
+    return set(pk for ids in flagged.values() for pk in ids)
+
+
+def update_mapped_fields(file_pk, save_type, snapshots, fields):
+    """Write some fields of re-mapped snapshots over the saved ones.
+
+    :param snapshots: dict, unsaved BuildingSnapshot inst by the
+        fingerprint of the raw row it was mapped from.
+    :param fields: list of str, names of the fields to update.
+
+    Saved snapshots are matched up by import file, source type and row
+    fingerprint, and updated with one ``UPDATE ... FROM (VALUES ...)`` per
+    batch.
+
+    """
+    meta = BuildingSnapshot._meta
+    fields = [meta.get_field(name) for name in fields]
+    row_sql = '(%s, {0})'.format(', '.join(
+        '%s::{0}'.format(field.db_type(connection)) for field in fields
+    ))
+    items = snapshots.items()
+    cursor = connection.cursor()
+    for start in range(0, len(items), INSERT_BATCH_SIZE):
+        rows = items[start:start + INSERT_BATCH_SIZE]
+        params = []
+        for fingerprint, snapshot in rows:
+            params.append(fingerprint)
+            params.extend(
+                field.get_db_prep_save(
+                    getattr(snapshot, field.attname), connection
+                ) for field in fields
+            )
+        params.extend([file_pk, save_type])
+        cursor.execute(
+            'UPDATE {table} SET {assignments} '
+            'FROM (VALUES {rows}) AS remapped (row_fingerprint, {columns}) '
+            'WHERE {table}.import_file_id = %s '
+            'AND {table}.source_type = %s '
+            'AND {table}.row_fingerprint = remapped.row_fingerprint'.format(
+                table=meta.db_table,
+                assignments=', '.join(
+                    '{0} = remapped.{0}'.format(field.column)
+                    for field in fields
+                ),
+                rows=', '.join([row_sql] * len(rows)),
+                columns=', '.join(field.column for field in fields),
+            ),
+            params
+        )
+
+
+def _get_pk_sequence(cursor):
+    """Return the name of the BuildingSnapshot PK sequence."""
+    meta = BuildingSnapshot._meta
+    cursor.execute(
+        'SELECT pg_get_serial_sequence(%s, %s)',
+        [meta.db_table, meta.pk.column]
+    )
+
+    return cursor.fetchone()[0]
@@ -1,6 +1,22 @@
-from seed.models import BuildingSnapshot
+import hashlib
+import json
+
+from django.core.cache import cache
+from mcm import mapper
+
+from seed.models import (
+    ASSESSED_RAW,
+    BuildingSnapshot,
+    get_column_mapping_index,
+    get_indexed_column_mapping,
+)
 from seed.utils import constants
 
+# Percentage match MCM requires before suggesting a column.
+SUGGESTION_THRESHOLD = 20
+# Seconds a header row's suggestions are kept.
+SUGGESTIONS_CACHE_TIMEOUT = 60 * 60 * 24
+
 
 def get_mappable_columns(exclude_fields=None):
     """Get a list of all the columns we're able to map to."""
@@ -32,3 +48,55 @@ def get_mappable_types(exclude_fields=None):
         )
 
     return results
+
+
+def get_header_signature(headers):
+    """A hash identifying a header row: its columns, in order."""
+    return hashlib.sha1(json.dumps(headers)).hexdigest()
+
+
+def suggest_column_mappings(
+    headers, organization, source_type=ASSESSED_RAW
+):
+    """Suggest a destination column, and confidence, for each raw header.
+
+    The Org's previous mappings are read with one query, and suggestions
+    are cached against the header row's signature. The cache key includes
+    the previous mappings, so saving a mapping retires the suggestions it
+    would change, and re-uploads of a known layout skip MCM entirely.
+
+    :param headers: list of str, raw column names.
+    :param organization: inst, Organization.
+    :param source_type: int, one of the ``SEED_DATA_SOURCES``.
+
+    :returns dict: raw column to ``[dest, confidence]``, ``dest`` being an
+        empty string where there's no suggestion.
+
+    """
+    index = get_column_mapping_index(organization, source_type)
+    key = 'column_mapping_suggestions__{0}'.format(hashlib.sha1(json.dumps([
+        organization.pk,
+        source_type,
+        get_header_signature(headers),
+        sorted(index.items()),
+    ])).hexdigest())
+
+    suggestions = cache.get(key)
+    if suggestions is not None:
+        return suggestions
+
+    suggestions = mapper.build_column_mapping(
+        headers,
+        get_mappable_columns(),
+        previous_mapping=get_indexed_column_mapping,
+        map_args=[index],
+        thresh=SUGGESTION_THRESHOLD
+    )
+    for m in suggestions:
+        dest, conf = suggestions[m]
+        if dest is None:
+            suggestions[m][0] = u''
+
+    cache.set(key, suggestions, SUGGESTIONS_CACHE_TIMEOUT)
+
+    return suggestions
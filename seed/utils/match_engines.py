@@ -0,0 +1,217 @@
+from django.conf import settings
+from django.db import connection
+
+from seed.models import BS_VALUES_LIST, BuildingSnapshot, make_match_key
+from seed.utils.match_index import (
+    FETCH_BATCH_SIZE,
+    MATCH_VALUES_LIST,
+    describe,
+    get_canonical_buildings,
+    get_match_index,
+    release_match_index,
+)
+
+# Names of the match engines, for ``settings.MATCH_ENGINE`` and
+# ``settings.MATCH_ENGINES_BY_ORG``.
+NGRAM = 'ngram'
+TRIGRAM = 'trigram'
+
+
+class MatchEngine(object):
+    """Searches an org's canonical buildings for unmatched buildings.
+
+    Engines only search: any number of searches of one run can go on side
+    by side, and ``tasks.finish_match_buildings`` saves what they find.
+
+    """
+    def __init__(self, org):
+        self.org = org
+
+    def prepare(self):
+        """Get ready for a matching run.
+
+        :rtype: bool, whether the org has any canonical buildings.
+
+        """
+        raise NotImplementedError
+
+    def search(self, building_pks, stats=None):
+        """Find the closest canonical snapshot for each of some buildings.
+
+        :param building_pks: list of int, unmatched BuildingSnapshot PKs.
+        :param stats: (optional) dict, totals to add these searches' stats
+            to.
+        :rtype: list of (building pk, snapshot pk, confidence) tuples, with
+            ``None`` for the snapshot and confidence where nothing matched.
+
+        Confidences are between 0 and 1, and only matches scoring at least
+        ``settings.MATCH_MIN_THRESHOLD`` are returned.
+
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """Tidy up after a run's matches are saved.
+
+        :rtype: dict, stats about the engine to report with the run's.
+
+        """
+        return {}
+
+
+class NGramEngine(MatchEngine):
+    """Searches the org's ``MatchIndex``, in the worker's memory."""
+    def prepare(self):
+        return bool(get_match_index(self.org))
+
+    def search(self, building_pks, stats=None):
+        """As ``MatchEngine.search``, see ``MatchIndex.search``.
+
+        With ``settings.MATCH_BLOCKING``, each building is only compared
+        with the canonical buildings it shares a block with.
+
+        """
+        min_threshold = settings.MATCH_MIN_THRESHOLD
+        blocking = getattr(settings, 'MATCH_BLOCKING', True)
+        index = get_match_index(self.org, refresh=False)
+        before = dict(index.stats)
+        values_list = BuildingSnapshot.objects.filter(
+            pk__in=building_pks
+        ).values_list(*MATCH_VALUES_LIST)
+
+        matches = []
+        for values in values_list:
+            # Here we want all the values not related to the BS id for comps.
+            match_string, blocks = describe(values)
+            results = index.search(
+                match_string, min_threshold, blocks if blocking else None
+            )
+            if results:
+                # We always care about closest match.
+                match_string, confidence = results[0]
+                matches.append((values[0], index[match_string], confidence))
+            else:
+                matches.append((values[0], None, None))
+
+        if stats is not None:
+            for name, value in index.stats.iteritems():
+                stats[name] = stats.get(name, 0) + value - before[name]
+
+        return matches
+
+    def finish(self):
+        # Index the canonical buildings the run made, while we're here,
+        # then free the memory until the next run.
+        stats = get_match_index(self.org).get_block_stats()
+        release_match_index(self.org)
+        return stats
+
+
+def fill_match_keys(queryset):
+    """Set ``match_key`` on the snapshots of a queryset that have none.
+
+    Snapshots get theirs when cleaned, as they're mapped; this catches
+    those mapped or merged before then.
+
+    :rtype: int, the number of snapshots updated.
+
+    """
+    pks = list(queryset.filter(match_key=None).values_list('pk', flat=True))
+    table = connection.ops.quote_name(BuildingSnapshot._meta.db_table)
+    cursor = connection.cursor()
+    for i in range(0, len(pks), FETCH_BATCH_SIZE):
+        values_list = BuildingSnapshot.objects.filter(
+            pk__in=pks[i:i + FETCH_BATCH_SIZE]
+        ).values_list(*BS_VALUES_LIST)
+        params = []
+        for values in values_list:
+            params.extend([values[0], make_match_key(values[1:])])
+        if not params:
+            continue
+        cursor.execute(
+            'UPDATE {0} SET match_key = keys.match_key '
+            'FROM (VALUES {1}) AS keys (id, match_key) '
+            'WHERE {0}.id = keys.id'.format(
+                table, ', '.join(['(%s, %s)'] * (len(params) / 2))
+            ),
+            params
+        )
+
+    return len(pks)
+
+
+class TrigramEngine(MatchEngine):
+    """Searches with PostgreSQL's pg_trgm, in the database.
+
+    Compares ``BuildingSnapshot.match_key``, the same string NGram
+    compares, through its GIN trigram index, so workers hold no index at
+    all. Confidences are pg_trgm's ``similarity()``. They are held to the
+    same thresholds, though for the same two strings they can differ a
+    little from NGram's.
+
+    """
+    def prepare(self):
+        canonical_snapshots = BuildingSnapshot.objects.filter(
+            pk__in=get_canonical_buildings(
+                self.org
+            ).values_list('canonical_snapshot_id')
+        )
+        fill_match_keys(canonical_snapshots)
+
+        return canonical_snapshots.exists()
+
+    def search(self, building_pks, stats=None):
+        if not building_pks:
+            return []
+
+        fill_match_keys(BuildingSnapshot.objects.filter(pk__in=building_pks))
+        table = connection.ops.quote_name(BuildingSnapshot._meta.db_table)
+        canonical_sql, canonical_params = get_canonical_buildings(
+            self.org
+        ).values_list('canonical_snapshot_id').query.sql_with_params()
+
+        cursor = connection.cursor()
+        # The % operator, which can use the index, compares with this.
+        cursor.execute(
+            'SELECT set_limit(%s)', [settings.MATCH_MIN_THRESHOLD]
+        )
+        cursor.execute(
+            'SELECT u.id, best.id, best.similarity FROM {table} u '
+            'LEFT JOIN LATERAL ('
+            '    SELECT c.id,'
+            '        similarity(c.match_key, u.match_key) AS similarity'
+            '    FROM {table} c'
+            '    WHERE c.match_key %% u.match_key'
+            '    AND c.id IN ({canonical_sql})'
+            '    ORDER BY similarity DESC, c.id DESC LIMIT 1'
+            ') best ON TRUE '
+            'WHERE u.id = ANY(%s) '
+            'ORDER BY u.id'.format(table=table, canonical_sql=canonical_sql),
+            list(canonical_params) + [list(building_pks)]
+        )
+        matches = cursor.fetchall()
+
+        if stats is not None:
+            stats['searches'] = stats.get('searches', 0) + len(matches)
+
+        return matches
+
+
+ENGINES = {
+    NGRAM: NGramEngine,
+    TRIGRAM: TrigramEngine,
+}
+
+
+def get_match_engine(org):
+    """Return the match engine an org is set to use.
+
+    ``settings.MATCH_ENGINES_BY_ORG`` picks engines for orgs by PK, e.g.
+    ``{42: 'trigram'}``; others use ``settings.MATCH_ENGINE``.
+
+    """
+    name = getattr(settings, 'MATCH_ENGINES_BY_ORG', {}).get(
+        org.pk, getattr(settings, 'MATCH_ENGINE', NGRAM)
+    )
+
+    return ENGINES[name](org)
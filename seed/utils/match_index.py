@@ -0,0 +1,494 @@
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+import ngram
+
+from BE.utils import get_private_dir, is_private
+from seed.decorators import get_match_key
+from seed.mappings.reconcile_mappings import break_up_address
+from seed.models import (
+    BS_VALUES_LIST,
+    PUNCT_REGEX,
+    BuildingSnapshot,
+    CanonicalBuilding,
+    make_match_key,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bump when the pickled layout changes; older files are rebuilt.
+MATCH_INDEX_VERSION = 2
+# Snapshot PKs per values query when indexing new canonical buildings.
+FETCH_BATCH_SIZE = 5000
+# What we read of a building to match it: its match key, made from
+# BS_VALUES_LIST, which its blocks also use along with the postal code.
+MATCH_VALUES_LIST = BS_VALUES_LIST + ['postal_code', 'match_key']
+# IDs that put a building in a block with others sharing their first few
+# characters, and that it is matched on outright when they equal a
+# canonical's.
+BLOCK_ID_FIELDS = ('tax_lot_id', 'pm_property_id', 'custom_id_1')
+ID_PREFIX_LENGTH = 4
+# Blocks bigger than this are too coarse to narrow a search, e.g. the
+# postal code of a dense downtown, so searches pass over them.
+MAX_BLOCK_SIZE = 1000
+
+# Most snapshots a worker keeps indexed in memory, across orgs; each
+# takes a few KB. The index in use is kept whatever its size.
+MAX_LOADED_SNAPSHOTS = 200000
+# Seconds the stamp of an org's current index is kept, see
+# ``get_match_index``.
+STAMP_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Indexes this worker has loaded, by org pk, least recently used first.
+_indexes = OrderedDict()
+
+
+def get_blocks(building):
+    """Name the blocks a building goes in for matching.
+
+    :param building: dict, values of ``MATCH_VALUES_LIST`` by field name.
+    :rtype: frozenset of str, e.g. ``num:555``, ``zip:94103``, ``id:1243``.
+
+    Candidates for a match must share at least one block. Buildings that
+    may be the same differ in spelling far more often than in their street
+    number, postal code or the start of their IDs.
+
+    """
+    blocks = set()
+    address = building.get('address_line_1')
+    if address and address.strip():
+        street_number = break_up_address(address.strip())[0]
+        if street_number:
+            blocks.add(u'num:' + (street_number.lstrip('0') or '0'))
+
+    postal_code = u''.join(
+        c for c in unicode(building.get('postal_code') or '') if c.isdigit()
+    )
+    if len(postal_code) >= 5:
+        blocks.add(u'zip:' + postal_code[:5])
+
+    for field in BLOCK_ID_FIELDS:
+        value = PUNCT_REGEX.sub('', unicode(building.get(field) or ''))
+        value = u''.join(value.lower().split())
+        if value:
+            blocks.add(u'id:' + value[:ID_PREFIX_LENGTH])
+
+    return frozenset(blocks)
+
+
+def describe(values):
+    """Return the match string and blocks of a ``MATCH_VALUES_LIST`` row."""
+    building = dict(zip(MATCH_VALUES_LIST, values))
+    match_string = building['match_key']
+    if match_string is None:
+        # Mapped before match keys were stored.
+        match_string = make_match_key(values[1:len(BS_VALUES_LIST)])
+
+    return match_string, get_blocks(building)
+
+
+def find_exact_matches(org, building_pks):
+    """Match buildings to canonical snapshots with the same IDs, in SQL.
+
+    :param org: Organization inst.
+    :param building_pks: list of int, unmatched BuildingSnapshot PKs.
+    :rtype: list of (building pk, snapshot pk, 1.0) tuples, as
+        ``MatchEngine.search`` returns.
+
+    IDs are compared lowercased, with anything but letters and digits
+    removed. A building matches a canonical snapshot of the org if one of
+    ``BLOCK_ID_FIELDS`` is the same in both and no other one of them is
+    set differently. Buildings that match more than one are left out.
+
+    """
+    if not building_pks:
+        return []
+
+    table = connection.ops.quote_name(BuildingSnapshot._meta.db_table)
+    columns = [
+        connection.ops.quote_name(
+            BuildingSnapshot._meta.get_field(field).column
+        )
+        for field in BLOCK_ID_FIELDS
+    ]
+    ids = ', '.join(
+        "NULLIF(regexp_replace(lower({0}), '[^a-z0-9]', '', 'g'), '') "
+        "AS id{1}".format(column, i)
+        for i, column in enumerate(columns)
+    )
+    pairs = ' UNION '.join(
+        'SELECT u.id AS building_id, c.id AS snapshot_id '
+        'FROM unmatched u JOIN canonical c ON u.id{0} = c.id{0}'.format(i)
+        for i in range(len(columns))
+    )
+    conflicts = ' OR '.join(
+        'COALESCE(u.id{0} <> c.id{0}, FALSE)'.format(i)
+        for i in range(len(columns))
+    )
+    canonical_sql, canonical_params = get_canonical_buildings(
+        org
+    ).values_list('canonical_snapshot_id').query.sql_with_params()
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'WITH unmatched AS ('
+        '    SELECT id, {ids} FROM {table} WHERE id = ANY(%s)'
+        '), canonical AS ('
+        '    SELECT id, {ids} FROM {table} WHERE id IN ({canonical_sql})'
+        '), pairs AS ({pairs}) '
+        'SELECT p.building_id, min(p.snapshot_id) FROM pairs p '
+        'JOIN unmatched u ON u.id = p.building_id '
+        'JOIN canonical c ON c.id = p.snapshot_id '
+        'WHERE NOT ({conflicts}) '
+        'GROUP BY p.building_id '
+        'HAVING count(DISTINCT p.snapshot_id) = 1 '
+        'ORDER BY p.building_id'.format(
+            ids=ids,
+            table=table,
+            canonical_sql=canonical_sql,
+            pairs=pairs,
+            conflicts=conflicts,
+        ),
+        [list(building_pks)] + list(canonical_params)
+    )
+
+    return [
+        (building_pk, snapshot_pk, 1.0)
+        for building_pk, snapshot_pk in cursor.fetchall()
+    ]
+
+
+def get_canonical_buildings(org):
+    """The canonical buildings ``find_canonical_building_values`` reads."""
+    users = org.users.all()
+    return CanonicalBuilding.objects.filter(
+        canonical_snapshot__import_file__import_record__owner__in=users
+    )
+
+
+def get_canonical_snapshot_keys(org):
+    """Identify the snapshots ``find_canonical_building_values`` returns.
+
+    :param org: Organization inst.
+    :rtype: set of (pk, created) tuples. PKs alone could be reused, e.g.
+        by a restored or recreated database.
+
+    """
+    return set(get_canonical_buildings(org).values_list(
+        'canonical_snapshot_id', 'canonical_snapshot__created'
+    ))
+
+
+class MatchIndex(object):
+    """An org's canonical buildings, ngram indexed for system matching.
+
+    Holds the same strings ``_match_buildings`` used to build an
+    ``ngram.NGram`` from ``find_canonical_building_values`` on every run,
+    but is kept from run to run: on disk, see ``get_path``, and in the
+    memory of the workers that last used it. ``refresh``
+    brings it up to date by comparing canonical snapshot PKs, so only
+    buildings that were created, merged, edited or deleted since are
+    stringified and indexed.
+    Search it in place of the NGram, and look up a result's snapshot pk
+    with ``index[match_string]``.
+
+    Snapshots are also grouped in blocks, see ``get_blocks``. A search
+    given the blocks of the building looked for only compares it with the
+    snapshots in them, through a small NGram per block, built when first
+    needed. NGram similarity is between two strings, so any match a
+    blocked search finds scores as it would against the whole index.
+
+    """
+    def __init__(self, org_pk):
+        self.org_pk = org_pk
+        # Snapshot key -> match string, and match string -> snapshot keys,
+        # keys being those of ``get_canonical_snapshot_keys``.
+        self.strings = {}
+        self.snapshots = {}
+        self.ngrams = ngram.NGram()
+        # Snapshot key -> block names, block name -> snapshot keys, and
+        # the snapshots in no block at all, a candidate for every search.
+        self.block_names = {}
+        self.blocks = {}
+        self.unblocked = set()
+        # NGrams of the blocks searched so far, by name; None for unblocked.
+        self._block_ngrams = {}
+        # Identifies the copy ``get_match_index`` last made current.
+        self.stamp = None
+        self.stats = {'searches': 0, 'blocked': 0, 'comparisons': 0}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, match_string):
+        """Snapshot pk for a search result, the latest of any duplicates."""
+        return max(self.snapshots[match_string])[0]
+
+    def search(self, query, threshold, blocks=None):
+        """As ``ngram.NGram.search``, most similar first.
+
+        :param blocks: (optional) the blocks of the building searched for.
+            Without them, or if all of them are too big to help, the
+            whole index is searched.
+
+        """
+        self.stats['searches'] += 1
+        usable = [
+            name for name in blocks or ()
+            if len(self.blocks.get(name, ())) <= MAX_BLOCK_SIZE
+        ]
+        if not usable:
+            self.stats['comparisons'] += len(self.ngrams)
+            return self.ngrams.search(query, threshold)
+
+        self.stats['blocked'] += 1
+        similarities = {}
+        for name in usable + [None]:
+            ngrams = self._get_block_ngrams(name)
+            self.stats['comparisons'] += len(ngrams)
+            for match_string, similarity in ngrams.search(query, threshold):
+                similarities[match_string] = similarity
+
+        return sorted(similarities.items(), key=lambda r: (-r[1], r[0]))
+
+    def _get_block_ngrams(self, name):
+        ngrams = self._block_ngrams.get(name)
+        if ngrams is None:
+            keys = self.unblocked if name is None else self.blocks.get(name)
+            ngrams = self._block_ngrams[name] = ngram.NGram(
+                set(self.strings[key] for key in keys or ())
+            )
+
+        return ngrams
+
+    def get_block_stats(self):
+        """Sizes of the blocks, and how well searches have been narrowed.
+
+        :rtype: dict, ``searches`` made, how many of them were ``blocked``
+            and the ``comparisons`` they made; the number of ``blocks``,
+            their ``mean_size`` and ``max_size``, how many are
+            ``oversized`` and how many snapshots are ``unblocked``.
+
+        """
+        sizes = [len(keys) for keys in self.blocks.itervalues()]
+        return dict(
+            self.stats,
+            blocks=len(sizes),
+            mean_size=float(sum(sizes)) / len(sizes) if sizes else 0.0,
+            max_size=max(sizes) if sizes else 0,
+            oversized=len([size for size in sizes if size > MAX_BLOCK_SIZE]),
+            unblocked=len(self.unblocked),
+        )
+
+    def add(self, key, match_string, block_names=frozenset()):
+        self.strings[key] = match_string
+        keys = self.snapshots.setdefault(match_string, set())
+        if not keys:
+            self.ngrams.add(match_string)
+        keys.add(key)
+
+        self.block_names[key] = block_names
+        for name in block_names or [None]:
+            if name is None:
+                self.unblocked.add(key)
+            else:
+                self.blocks.setdefault(name, set()).add(key)
+            self._block_ngrams.pop(name, None)
+
+    def discard(self, key):
+        match_string = self.strings.pop(key, None)
+        if match_string is None:
+            return
+        keys = self.snapshots[match_string]
+        keys.discard(key)
+        if not keys:
+            del self.snapshots[match_string]
+            # NGram.remove also drops the string's ngrams; discard doesn't.
+            self.ngrams.remove(match_string)
+
+        for name in self.block_names.pop(key) or [None]:
+            if name is None:
+                self.unblocked.discard(key)
+            else:
+                self.blocks[name].discard(key)
+                if not self.blocks[name]:
+                    del self.blocks[name]
+            self._block_ngrams.pop(name, None)
+
+    def refresh(self, org):
+        """Index the org's current canonical snapshots, drop stale ones.
+
+        :param org: Organization inst.
+        :rtype: bool, whether anything changed.
+
+        """
+        current = get_canonical_snapshot_keys(org)
+        stale = set(self.strings) - current
+        new = dict(current - set(self.strings))
+        new_pks = sorted(new)
+        for key in stale:
+            self.discard(key)
+        for i in range(0, len(new_pks), FETCH_BATCH_SIZE):
+            values_list = BuildingSnapshot.objects.filter(
+                pk__in=new_pks[i:i + FETCH_BATCH_SIZE]
+            ).values_list(*MATCH_VALUES_LIST)
+            for values in values_list:
+                key = (values[0], new[values[0]])
+                match_string, block_names = describe(values)
+                self.add(key, match_string, block_names)
+
+        return bool(stale or new)
+
+    @staticmethod
+    def get_path(org_pk):
+        """Where an org's index is kept, or None if indexes aren't kept.
+
+        In ``settings.MATCH_INDEX_DIR``, or a directory of the app user's
+        own in the system temp dir. Loading an index unpickles it, so it
+        must never come from a directory others can write to: if that's
+        the case, indexes aren't kept.
+
+        """
+        index_dir = get_private_dir(
+            getattr(settings, 'MATCH_INDEX_DIR', None), 'seed-match-indexes'
+        )
+        if index_dir is None:
+            return None
+        return os.path.join(
+            index_dir, 'seed-match-index-{0}.pickle'.format(org_pk)
+        )
+
+    @staticmethod
+    def is_trusted(path):
+        """Whether only this process's user could have written ``path``."""
+        return is_private(os.path.dirname(path)) and is_private(path)
+
+    def save(self):
+        """Write the index to disk, replacing any earlier copy at once."""
+        path = self.get_path(self.org_pk)
+        if path is None:
+            return
+        state = {
+            'version': MATCH_INDEX_VERSION,
+            'stamp': self.stamp,
+            'strings': self.strings,
+            'block_names': self.block_names,
+            'ngram_items': list(self.ngrams),
+            'ngram_state': self.ngrams.__dict__,
+        }
+        temp_path = None
+        try:
+            # Write to a scratch name first so other workers never load a
+            # partial copy.
+            with tempfile.NamedTemporaryFile(
+                mode='wb',
+                dir=os.path.dirname(path),
+                prefix=os.path.basename(path) + '.',
+                suffix='.part',
+                delete=False,
+            ) as temp_file:
+                temp_path = temp_file.name
+                pickle.dump(state, temp_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+        except (EnvironmentError, TypeError, pickle.PicklingError):
+            # Not fatal, the next run just has more to index.
+            logger.exception('could not save match index %s', path)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @classmethod
+    def load(cls, org_pk):
+        """Read an org's index from disk, or return an empty one.
+
+        NGram's own unpickling indexes every item again, which is the work
+        we're avoiding, so its ngram tables are stored and restored as is.
+
+        """
+        index = cls(org_pk)
+        path = cls.get_path(org_pk)
+        if path is None or not os.path.exists(path):
+            return index
+
+        try:
+            if not cls.is_trusted(path):
+                logger.error(
+                    'not loading match index %s, others can write to it',
+                    path
+                )
+                return index
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state.get('version') != MATCH_INDEX_VERSION:
+                return index
+            ngrams = ngram.NGram.__new__(ngram.NGram)
+            set.update(ngrams, state['ngram_items'])
+            ngrams.__dict__.update(state['ngram_state'])
+        except Exception:
+            logger.exception('could not load match index %s', path)
+            return index
+
+        index.ngrams = ngrams
+        index.stamp = state.get('stamp')
+        for key, match_string in state['strings'].iteritems():
+            index.strings[key] = match_string
+            index.snapshots.setdefault(match_string, set()).add(key)
+        for key, block_names in state['block_names'].iteritems():
+            index.block_names[key] = block_names
+            for name in block_names:
+                index.blocks.setdefault(name, set()).add(key)
+            if not block_names:
+                index.unblocked.add(key)
+
+        return index
+
+
+def get_match_index(org, refresh=True):
+    """Return an org's ``MatchIndex``.
+
+    :param org: Organization inst.
+    :param refresh: (optional) bool, bring the index up to date, save it
+        back if anything changed and make it the org's current one. Without,
+        the current index is used as it is, if this worker has it or it's
+        on disk; other copies are refreshed.
+
+    A matching run refreshes the index once, before its shards search it.
+    Workers keep the indexes they last used, least recently used first
+    out, while they hold fewer than ``MAX_LOADED_SNAPSHOTS`` snapshots.
+
+    """
+    stamp_key = get_match_key('index', org.pk)
+    index = _indexes.pop(org.pk, None)
+    if refresh:
+        if index is None:
+            index = MatchIndex.load(org.pk)
+        if index.refresh(org) or index.stamp is None:
+            index.stamp = uuid.uuid4().hex
+            index.save()
+        cache.set(stamp_key, index.stamp, STAMP_CACHE_TIMEOUT)
+    else:
+        stamp = cache.get(stamp_key)
+        if index is None or (stamp is not None and index.stamp != stamp):
+            index = MatchIndex.load(org.pk)
+        if stamp is None or index.stamp != stamp:
+            index.refresh(org)
+            # As new as the current one, if not newer.
+            index.stamp = stamp
+
+    loaded = len(index) + sum(len(other) for other in _indexes.values())
+    while _indexes and loaded > MAX_LOADED_SNAPSHOTS:
+        loaded -= len(_indexes.popitem(last=False)[1])
+    _indexes[org.pk] = index
+
+    return index
+
+
+def release_match_index(org):
+    """Drop an org's index from this worker's memory, e.g. after a run."""
+    _indexes.pop(org.pk, None)
@@ -0,0 +1,236 @@
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+from seed.mappings import mapper
+from seed.models import (
+    COMPOSITE_BS,
+    SYSTEM_MATCH,
+    AttributeOption,
+    BuildingAttributeVariant,
+    BuildingSnapshot,
+    CanonicalBuilding,
+    Meter,
+    reserve_pks,
+)
+from seed.utils.ingest import INSERT_BATCH_SIZE
+
+
+def save_snapshot_matches(matches, user=None):
+    """Save a batch of matches, as ``save_snapshot_match`` saves each.
+
+    :param matches: list of (canonical snapshot pk, incoming snapshot pk,
+        confidence, match type) tuples, saved in order.
+    :param user: (optional) User inst, last_modified_by for the new
+        snapshots.
+    :rtype: list of int, the PK of the snapshot each match made, or None
+        where a snapshot was matched with itself.
+
+    Where an earlier match of the batch merged a match's canonical
+    snapshot, the incoming snapshot merges into the snapshot that made
+    instead, so one canonical building can take several buildings at
+    once. The composite snapshots, variants, canonical links and meter
+    links are the same as saving the matches one at a time would make,
+    but are written with a fixed number of statements however many
+    matches there are.
+
+    """
+    parent_pks = set()
+    for canonical_pk, incoming_pk, confidence, match_type in matches:
+        parent_pks.update([canonical_pk, incoming_pk])
+    parents = BuildingSnapshot.objects.in_bulk(parent_pks)
+    # One instance per canonical building, so changes made to it by one
+    # match are seen by the next. Inactive ones are still linked to.
+    canonicals = CanonicalBuilding.objects.in_bulk(set(
+        parent.canonical_building_id for parent in parents.values()
+    ) - set([None]))
+    for parent in parents.values():
+        if parent.canonical_building_id is not None:
+            parent.canonical_building = canonicals[
+                parent.canonical_building_id
+            ]
+    meters = defaultdict(set)
+    MeterLink = Meter.building_snapshot.through
+    for snapshot_pk, meter_pk in MeterLink.objects.filter(
+        buildingsnapshot__in=parent_pks
+    ).values_list('buildingsnapshot', 'meter'):
+        meters[snapshot_pk].add(meter_pk)
+
+    count = len([match for match in matches if match[0] != match[1]])
+    pks = iter(reserve_pks(BuildingSnapshot, count))
+    merged_into = {}
+    results = []
+    snapshots = []
+    new_canonicals = []
+    updated_canonicals = {}
+    variants = []
+    for canonical_pk, incoming_pk, confidence, match_type in matches:
+        # No point in linking the same building together.
+        if canonical_pk == incoming_pk:
+            results.append(None)
+            continue
+
+        b1 = merged_into.get(canonical_pk) or parents[canonical_pk]
+        b2 = parents[incoming_pk]
+        snapshot = BuildingSnapshot(pk=next(pks))
+        for attr, attribute_values in mapper.merge_attributes(
+            snapshot, mapper.get_building_attrs([b1, b2]), b1
+        ):
+            variants.append((snapshot, attr, attribute_values))
+        snapshot.extra_data, snapshot.extra_data_sources = (
+            mapper.merge_extra_data(b1, b2, default=b1)
+        )
+        snapshot.match_type = match_type or SYSTEM_MATCH
+        snapshot.source_type = COMPOSITE_BS
+        snapshot.confidence = confidence
+        snapshot.last_modified_by = user
+        snapshot.super_organization_id = b2.super_organization_id
+
+        canon = b1.canonical_building or b2.canonical_building
+        if canon is None:
+            canon = CanonicalBuilding()
+            new_canonicals.append(canon)
+        snapshot.canonical_building = canon
+        canon.canonical_snapshot = snapshot
+        if canon.pk is not None:
+            updated_canonicals[canon.pk] = canon
+        # Don't leave dead limbs in the tree, as ``clean_canonicals``.
+        for parent in (b1, b2):
+            parent_canon = parent.canonical_building
+            if parent_canon is not None and parent_canon is not canon:
+                parent_canon.active = False
+                if parent_canon.pk is not None:
+                    updated_canonicals[parent_canon.pk] = parent_canon
+
+        meters[snapshot.pk] = meters[b1.pk] | meters[b2.pk]
+        snapshots.append((snapshot, b1, b2))
+        merged_into[canonical_pk] = snapshot
+        results.append(snapshot.pk)
+
+    for canon, pk in zip(
+        new_canonicals, reserve_pks(CanonicalBuilding, len(new_canonicals))
+    ):
+        canon.pk = pk
+    variants = [
+        (
+            BuildingAttributeVariant(
+                pk=pk, field_name=attr, building_snapshot=merged
+            ),
+            attr,
+            attribute_values
+        ) for pk, (merged, attr, attribute_values) in zip(
+            reserve_pks(BuildingAttributeVariant, len(variants)), variants
+        )
+    ]
+
+    options = get_new_options(variants)
+    ChildLink = BuildingSnapshot.children.through
+    child_links = []
+    meter_links = []
+    for snapshot, b1, b2 in snapshots:
+        # The canonical building may have been given its PK since.
+        snapshot.canonical_building = snapshot.canonical_building
+        child_links.extend([
+            ChildLink(
+                from_buildingsnapshot_id=parent.pk,
+                to_buildingsnapshot_id=snapshot.pk
+            ) for parent in (b1, b2)
+        ])
+        meter_links.extend([
+            MeterLink(meter_id=meter_pk, buildingsnapshot_id=snapshot.pk)
+            for meter_pk in sorted(meters[snapshot.pk])
+        ])
+
+    with transaction.atomic():
+        # Canonical buildings and their snapshots point at each other; the
+        # foreign keys are only checked once the transaction commits.
+        CanonicalBuilding.objects.bulk_create(
+            new_canonicals, batch_size=INSERT_BATCH_SIZE
+        )
+        BuildingSnapshot.objects.bulk_create(
+            [snapshot for snapshot, b1, b2 in snapshots],
+            batch_size=INSERT_BATCH_SIZE
+        )
+        update_canonicals(updated_canonicals.values())
+        ChildLink.objects.bulk_create(
+            child_links, batch_size=INSERT_BATCH_SIZE
+        )
+        MeterLink.objects.bulk_create(
+            meter_links, batch_size=INSERT_BATCH_SIZE
+        )
+        BuildingAttributeVariant.objects.bulk_create(
+            [variant for variant, attr, attribute_values in variants],
+            batch_size=INSERT_BATCH_SIZE
+        )
+        AttributeOption.objects.bulk_create(
+            options, batch_size=INSERT_BATCH_SIZE
+        )
+
+    return results
+
+
+def get_new_options(variants):
+    """Make the options ``save_variant`` would add to each of some variants.
+
+    :param variants: list of (BuildingAttributeVariant inst, attr, dict of
+        values keyed on BuildingSnapshot inst) tuples, in the order they'd
+        be saved.
+    :rtype: list of unsaved AttributeOption inst.
+
+    As in ``save_variant``, a value already saved as an option from the
+    same source, by any variant, isn't added again.
+
+    """
+    value_field = AttributeOption._meta.get_field('value')
+    candidates = []
+    for variant, attr, attribute_values in variants:
+        for data_set, value in attribute_values.items():
+            if value is None:
+                continue
+            candidates.append((
+                variant,
+                value_field.get_prep_value(value),
+                mapper.get_snapshot_source_id(data_set, attr)
+            ))
+
+    if not candidates:
+        return []
+
+    seen = set(AttributeOption.objects.filter(
+        value__in=set(value for variant, value, source in candidates)
+    ).values_list('value', 'value_source'))
+    options = []
+    for variant, value, source in candidates:
+        if (value, source) in seen:
+            continue
+        seen.add((value, source))
+        options.append(AttributeOption(
+            value=value, value_source=source, building_variant=variant
+        ))
+
+    return options
+
+
+def update_canonicals(canonicals):
+    """Save the canonical snapshot and active flag of canonical buildings.
+
+    :param canonicals: list of saved CanonicalBuilding inst.
+
+    """
+    canonicals = list(canonicals)
+    if not canonicals:
+        return
+
+    params = []
+    for canon in canonicals:
+        params.extend([canon.pk, canon.canonical_snapshot_id, canon.active])
+    table = connection.ops.quote_name(CanonicalBuilding._meta.db_table)
+    connection.cursor().execute(
+        'UPDATE {0} SET canonical_snapshot_id = canonicals.snapshot_id, '
+        'active = canonicals.active '
+        'FROM (VALUES {1}) AS canonicals (id, snapshot_id, active) '
+        'WHERE {0}.id = canonicals.id'.format(
+            table, ', '.join(['(%s, %s::integer, %s)'] * len(canonicals))
+        ),
+        params
+    )
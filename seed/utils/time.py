@@ -1,5 +1,25 @@
+from collections import OrderedDict
+from datetime import datetime
+
 import dateutil
 
+# Formats a DateConverter can learn, tried in order. Only formats that
+# strptime and dateutil read the same way belong here: no day-first
+# formats (dateutil reads 01/02 as January 2nd) and no two digit years
+# (the two pick different centuries).
+DATE_FORMATS = (
+    '%m/%d/%Y',
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%Y/%m/%d',
+    '%m-%d-%Y',
+)
+# Distinct raw strings a DateConverter remembers the parse of.
+DATE_CACHE_SIZE = 1024
+
 
 def convert_datestr(datestr):
     """Converts dates like `12/31/2010` into datetime objects."""
@@ -9,6 +29,81 @@ def convert_datestr(datestr):
         return None
 
 
+class DateConverter(object):
+    """Converts date strings, as ``convert_datestr``, learning their format.
+
+    Use one per column of dates; a column is nearly always written in a
+    single format. Once a value has been parsed by dateutil, the first of
+    ``DATE_FORMATS`` that gives the same result is used for the values
+    after it, with a strict ``strptime``. Values that don't fit go back to
+    dateutil, and may teach the converter a new format. Recent raw strings
+    and their results are kept, least recently used first out.
+
+    """
+    def __init__(self, formats=DATE_FORMATS, cache_size=DATE_CACHE_SIZE):
+        self.formats = formats
+        self.cache_size = cache_size
+        self.format = None
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.fast = 0
+        self.fallbacks = 0
+
+    def __call__(self, datestr):
+        if not isinstance(datestr, basestring):
+            return convert_datestr(datestr)
+
+        try:
+            value = self.cache.pop(datestr)
+        except KeyError:
+            value = self._parse(datestr)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self.cache[datestr] = value
+
+        return value
+
+    def _parse(self, datestr):
+        if self.format:
+            try:
+                value = datetime.strptime(datestr, self.format)
+            except ValueError:
+                pass
+            else:
+                self.fast += 1
+                return value
+
+        self.fallbacks += 1
+        value = convert_datestr(datestr)
+        if value is not None:
+            self.format = self._learn(datestr, value) or self.format
+
+        return value
+
+    def _learn(self, datestr, expected):
+        """Return the first known format that reads datestr as expected."""
+        for date_format in self.formats:
+            try:
+                if datetime.strptime(datestr, date_format) == expected:
+                    return date_format
+            except ValueError:
+                continue
+
+    @property
+    def stats(self):
+        """Counts of cache hits, strict parses and dateutil fallbacks."""
+        total = self.hits + self.fast + self.fallbacks
+        return {
+            'hits': self.hits,
+            'fast': self.fast,
+            'fallbacks': self.fallbacks,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+            'fast_rate': float(self.fast) / total if total else 0.0,
+        }
+
+
 def convert_to_js_timestamp(timestamp):
     """converts a django/python datetime object to milliseconds since epoch"""
     if timestamp:
@@ -16,8 +16,6 @@ from django.db.models import Q
 
 # vendor imports
 from annoying.decorators import render_to, ajax_request
-from mcm import mapper
-
 
 # BE imports
 from data_importer.models import ImportFile, ImportRecord, ROW_DELIMITER
@@ -32,7 +30,6 @@ from seed.tasks import (
 from superperms.orgs.decorators import has_perm
 from seed import models, tasks
 from seed.models import (
-    get_column_mapping,
     save_snapshot_match,
     BuildingSnapshot,
     ColumnMapping,
@@ -56,7 +53,10 @@ from seed.utils.projects import (
 )
 
 from seed.utils.time import convert_to_js_timestamp
-from seed.utils.mapping import get_mappable_types
+from seed.utils.mapping import (
+    get_mappable_types,
+    suggest_column_mappings,
+)
 
 from .. import search
 from .. import exporter
@@ -739,19 +739,11 @@ def get_column_mapping_suggestions(request):
     import_file = ImportFile.objects.get(pk=body.get('import_file_id'))
     result = {'status': 'success'}
     column_types = get_mappable_types()
-    suggested_mappings = mapper.build_column_mapping(
+    suggested_mappings = suggest_column_mappings(
         import_file.first_row_columns,
-        column_types.keys(),
-        previous_mapping=get_column_mapping,
-        map_args=[import_file.import_record.super_organization],
-        thresh=20  # percentage match we require
+        import_file.import_record.super_organization
     )
 
-    for m in suggested_mappings:
-        dest, conf = suggested_mappings[m]
-        if dest is None:
-            suggested_mappings[m][0] = u''
-
     result['suggested_column_mappings'] = suggested_mappings
     result['building_columns'] = column_types.keys()
     result['building_column_types'] = column_types
@@ -1140,26 +1132,40 @@ def update_dataset(request):
 @login_required
 @has_perm('can_modify_data')
 def save_raw_data(request):
-    """Initiate a save or raw data to DB for a given ImportFile."""
+    """Initiate a save or raw data to DB for a given ImportFile.
+
+    Pass ``map_on_save`` to map the rows in the same pass, when the org's
+    column mappings are already saved. Pass ``resume`` to finish a save that
+    stopped part way through.
+
+    """
     body = json.loads(request.body)
     import_file_id = body.get('file_id')
     if not import_file_id:
         return {'status': 'error'}
 
-    return task_save_raw(import_file_id)
+    return task_save_raw(
+        import_file_id,
+        map_on_save=bool(body.get('map_on_save')),
+        resume=bool(body.get('resume'))
+    )
 
 
 @ajax_request
 @login_required
 @has_perm('can_modify_data')
 def start_mapping(request):
-    """"Map raw data to mapped data."""
+    """"Map raw data to mapped data.
+
+    Pass ``resume`` to finish a mapping that stopped part way through.
+
+    """
     body = json.loads(request.body)
     import_file_id = body.get('file_id')
     if not import_file_id:
         return {'status': 'error'}
 
-    return map_data(import_file_id)
+    return map_data(import_file_id, resume=bool(body.get('resume')))
 
 
 @ajax_request
@@ -13,7 +13,7 @@ from seed.models import (
     TimeSeries
 )
 
-from seed.utils.time import convert_datestr
+from seed.utils.time import DateConverter
 
 
 @ajax_request
@@ -150,10 +150,11 @@ def add_timeseries(request):
     except Meter.DoesNotExist:
         return {'status': 'error', 'message': 'Meter ID does not match'}
 
+    convert_begin, convert_end = DateConverter(), DateConverter()
     for ts_item in ts_data:
         TimeSeries.objects.create(
-            begin_time=convert_datestr(ts_item.get('begin_time', None)),
-            end_time=convert_datestr(ts_item.get('end_time', None)),
+            begin_time=convert_begin(ts_item.get('begin_time', None)),
+            end_time=convert_end(ts_item.get('end_time', None)),
             reading=ts_item.get('reading', None),
             cost=ts_item.get('cost', None),
             meter=meter